@@ -49,10 +49,16 @@ def create_app(config_name='default'):
 
     # Set login view for Flask-Login
     login_manager.login_view = "auth.login"
+    # Registers the user loader, which reads the identity cached in the session
+    from . import identity
 
     # Initialize Flask-Migrate
     Migrate(app, db)
 
+    # Register maintenance commands (flask backfill-ratings, ...)
+    from .commands import register_commands
+    register_commands(app)
+
     # Register Blueprints
     from .auth import auth
     from .customer import customer
@@ -69,6 +75,42 @@ def create_app(config_name='default'):
     with app.app_context():
         db.create_all()
 
+        # Columns added to existing tables since older databases were created
+        from .commands import upgrade_existing_tables
+        upgrade_existing_tables()
+
+        # Query count, DB time and slow query log per request
+        from .instrumentation import init_sql_instrumentation
+        init_sql_instrumentation(app)
+
+        # Cuisine and location lists shared by the menu and listing pages
+        from .reference_data import init_reference_cache
+        init_reference_cache(app)
+
+        # Carts in a key-value store when CART_STORE is set
+        from .cart_store import init_cart_store
+        init_cart_store(app)
+
+        # Order counts per restaurant and status, filled once for older databases
+        from .order_stats import init_order_stats
+        init_order_stats(app)
+
+        # Hourly dish and daily restaurant sales, filled once for older databases
+        from .sales import init_sales_rollups
+        init_sales_rollups(app)
+
+        # In-process pub/sub of the live order feed
+        from .order_feed import init_order_feed
+        init_order_feed(app)
+
+        # Side effects of checkout and status changes, run by background consumers
+        from .order_events import init_order_events
+        init_order_events(app)
+
+        # Full-text restaurant search, built once for older databases
+        from .search import init_search
+        init_search(app)
+
     @app.route('/')
     def home():
         return redirect(url_for('auth.login')) 
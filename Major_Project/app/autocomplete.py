@@ -0,0 +1,238 @@
+"""
+In-memory autocomplete for the restaurant search box.
+
+Restaurant names, dish names, cuisines and locations are kept in a trie of
+their words, so a suggestion lookup never touches the database. Every query
+word has to start one of the words of a suggestion; words of 4+ letters may
+have one typo (8+ letters two) after their first letter, found by walking
+the trie with a Damerau-Levenshtein row per node and pruning branches that
+are already too far off. Typo matches are only looked for when the exact
+prefix matches do not fill the requested number of suggestions.
+
+The index is built from the database on first use, kept up to date from
+committed catalogue writes (app/catalogue.py) and rebuilt completely every
+AUTOCOMPLETE_REFRESH_SECONDS, which also picks up writes made by other
+processes or outside the ORM.
+"""
+import heapq
+import threading
+import time
+from flask import current_app, has_app_context
+from .catalogue import get_catalogue_view, on_catalogue_commit
+from .search import search_terms
+
+AUTOCOMPLETE_LIMIT = 8
+AUTOCOMPLETE_MAX_LIMIT = 20
+
+
+class Suggestion:
+    """One suggestion and the restaurants it comes from"""
+    __slots__ = ('text', 'kind', 'restaurant_id', 'words', 'restaurants')
+
+    def __init__(self, text, kind, restaurant_id=None):
+        self.text = text
+        self.kind = kind
+        self.restaurant_id = restaurant_id
+        self.words = tuple(set(search_terms(text)))
+        self.restaurants = set()
+
+    def as_dict(self):
+        return {'text': self.text, 'kind': self.kind, 'restaurant_id': self.restaurant_id}
+
+
+class TrieNode:
+    __slots__ = ('children', 'keys')
+
+    def __init__(self):
+        self.children = {}
+        self.keys = set()
+
+
+def allowed_typos(term):
+    if len(term) >= 8:
+        return 2
+    return 1 if len(term) >= 4 else 0
+
+
+class AutocompleteIndex:
+    """Word trie over the suggestions of the catalogue"""
+
+    def __init__(self, records=()):
+        self.root = TrieNode()
+        self.suggestions = {}
+        self.sources = {}  # restaurant id -> suggestion keys it contributes
+        self.lock = threading.RLock()
+        self.built_at = time.monotonic()
+        self.refresh(records)
+
+    def __len__(self):
+        return len(self.suggestions)
+
+    def refresh(self, records, removed_ids=()):
+        """Replaces the suggestions of the given catalogue records"""
+        with self.lock:
+            for restaurant_id in removed_ids:
+                self._remove_restaurant(restaurant_id)
+            for record in records:
+                self._remove_restaurant(record['id'])
+                self._add_restaurant(record)
+
+    def _add_restaurant(self, record):
+        contributed = [(('restaurant', record['id']), record['name'], 'restaurant', record['id'])]
+        contributed += [(('dish', name.lower()), name, 'dish', None) for name in record['dishes']]
+        contributed += [(('cuisine', name.lower()), name, 'cuisine', None) for name in record['cuisines']]
+        contributed += [(('location', name.lower()), name, 'location', None) for name in record['locations']]
+        keys = set()
+        for key, text, kind, restaurant_id in contributed:
+            suggestion = self.suggestions.get(key)
+            if suggestion is None:
+                suggestion = self.suggestions[key] = Suggestion(text, kind, restaurant_id)
+                for word in suggestion.words:
+                    self._insert_word(word, key)
+            suggestion.restaurants.add(record['id'])
+            keys.add(key)
+        self.sources[record['id']] = keys
+
+    def _remove_restaurant(self, restaurant_id):
+        for key in self.sources.pop(restaurant_id, ()):
+            suggestion = self.suggestions[key]
+            suggestion.restaurants.discard(restaurant_id)
+            if not suggestion.restaurants:
+                del self.suggestions[key]
+                for word in suggestion.words:
+                    self._delete_word(word, key)
+
+    def _insert_word(self, word, key):
+        node = self.root
+        for char in word:
+            node = node.children.setdefault(char, TrieNode())
+        node.keys.add(key)
+
+    def _delete_word(self, word, key):
+        path = [self.root]
+        for char in word:
+            node = path[-1].children.get(char)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].keys.discard(key)
+        # drop the branch when nothing is left below it
+        for depth in range(len(word), 0, -1):
+            node = path[depth]
+            if node.keys or node.children:
+                break
+            del path[depth - 1].children[word[depth - 1]]
+
+    def _collect(self, node, distance, found):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for key in node.keys:
+                if distance < found.get(key, distance + 1):
+                    found[key] = distance
+            stack.extend(node.children.values())
+
+    def _exact_matches(self, term):
+        node = self.root
+        for char in term:
+            node = node.children.get(char)
+            if node is None:
+                return {}
+        found = {}
+        self._collect(node, 0, found)
+        return found
+
+    def _fuzzy_matches(self, term):
+        """{suggestion key: typos} of suggestions with a word starting like `term`"""
+        max_typos = allowed_typos(term)
+        if not max_typos:
+            return self._exact_matches(term)
+        size = len(term)
+        far = max_typos + 1
+        found = {}
+        first_row = [min(i, far) for i in range(size + 1)]
+        # node, its char, depth, grandparent row, parent row, parent char, best prefix distance so far
+        # the first letter has to be right, which keeps the walk in one branch
+        first = self.root.children.get(term[0])
+        stack = [(first, term[0], 1, None, first_row, None, far)] if first else []
+        while stack:
+            node, char, depth, grand_row, parent_row, parent_char, best = stack.pop()
+            # only cells within max_typos of the diagonal can stay under the limit
+            row = [far] * (size + 1)
+            row[0] = lowest = depth if depth < far else far
+            for i in range(max(1, depth - max_typos), min(size, depth + max_typos) + 1):
+                cost = parent_row[i - 1] if term[i - 1] == char else parent_row[i - 1] + 1
+                if parent_row[i] + 1 < cost:
+                    cost = parent_row[i] + 1
+                if row[i - 1] + 1 < cost:
+                    cost = row[i - 1] + 1
+                if (i > 1 and grand_row is not None and term[i - 1] == parent_char
+                        and term[i - 2] == char and grand_row[i - 2] + 1 < cost):
+                    cost = grand_row[i - 2] + 1
+                if cost < far:
+                    row[i] = cost
+                    if cost < lowest:
+                        lowest = cost
+            if row[size] < best:
+                best = row[size]
+            if lowest > max_typos:
+                # nothing deeper gets closer, the words below still start like term
+                if best <= max_typos:
+                    self._collect(node, best, found)
+                continue
+            if best <= max_typos:
+                for key in node.keys:
+                    if best < found.get(key, far):
+                        found[key] = best
+            stack.extend((child, child_char, depth + 1, parent_row, row, char, best)
+                         for child_char, child in node.children.items())
+        return found
+
+    def _matches(self, terms, match_term):
+        matches = None
+        for term in terms:
+            term_matches = match_term(term)
+            if matches is None:
+                matches = term_matches
+            else:
+                matches = {key: typos + term_matches[key]
+                           for key, typos in matches.items() if key in term_matches}
+            if not matches:
+                break
+        return matches
+
+    def suggest(self, query, limit=AUTOCOMPLETE_LIMIT):
+        """
+        The `limit` best suggestions for `query`: fewest typos first, then
+        suggestions shared by more restaurants, then alphabetically.
+        """
+        terms = search_terms(query)
+        if not terms:
+            return []
+        with self.lock:
+            matches = self._matches(terms, self._exact_matches)
+            # typo matches rank below exact ones, only look for them to fill up
+            if len(matches) < limit:
+                matches = self._matches(terms, self._fuzzy_matches)
+            best = heapq.nsmallest(limit, matches.items(), key=lambda item: (
+                item[1], -len(self.suggestions[item[0]].restaurants), self.suggestions[item[0]].text.lower()))
+            return [self.suggestions[key].as_dict() for key, _ in best]
+
+
+def get_autocomplete_index():
+    """The index of the current app, (re)built when missing or expired"""
+    return get_catalogue_view('autocomplete', AutocompleteIndex,
+                              current_app.config.get('AUTOCOMPLETE_REFRESH_SECONDS'))
+
+
+def suggest(query, limit=AUTOCOMPLETE_LIMIT):
+    return get_autocomplete_index().suggest(query, limit)
+
+
+@on_catalogue_commit
+def refresh_autocomplete(records, removed_ids):
+    if not has_app_context():
+        return
+    index = current_app.extensions.get('autocomplete')
+    if index is not None:
+        index.refresh(records, removed_ids)
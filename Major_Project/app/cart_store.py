@@ -0,0 +1,248 @@
+"""
+Optional key-value store for the customers' carts.
+
+Cart clicks are the most frequent writes of the app. With CART_STORE set,
+the add/subtract/remove buttons only change the cart in the store, with
+an atomic increment, and the Cart table is written later:
+- at checkout, before the order is built from the Cart rows,
+- by the write-behind pass, which persists the carts changed since the
+  last pass once CART_WRITE_BEHIND_SECONDS have passed. It runs after
+  requests, and for a Redis store also with `flask persist-carts`.
+  The request that finds the pass due runs it before its response is sent,
+  so that request pays for the whole backlog; with busy stores run
+  `flask persist-carts` on a schedule and set CART_WRITE_BEHIND_SECONDS to
+  None. The pass uses its own session, it never commits the request's.
+
+CART_STORE = "memory" keeps the carts in a dict of the process, which only
+suits a single worker. A redis:// URL keeps them in Redis hashes (needs the
+`redis` package), shared by all workers. A cart is loaded from the Cart
+table the first time it is used. Without CART_STORE every click is written
+to the Cart table right away.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+from flask import current_app
+from sqlalchemy import bindparam, delete, func, insert, select, update
+from .extensions import db
+from .models import Cart, Food
+
+logger = logging.getLogger(__name__)
+
+# stands in for a Cart row where templates only read the quantity
+CartLine = namedtuple('CartLine', 'food_id quantity')
+
+
+class MemoryCartStore:
+    """Carts in a dict of this process, {customer_id: {food_id: quantity}}"""
+
+    def __init__(self):
+        self.carts = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def get(self, customer_id):
+        """The cart, None when it was not loaded yet"""
+        cart = self.carts.get(customer_id)
+        return None if cart is None else dict(cart)
+
+    def load(self, customer_id, lines):
+        with self.lock:
+            # a cart loaded by a concurrent request wins
+            cart = self.carts.setdefault(customer_id, dict(lines))
+            return dict(cart)
+
+    def increment(self, customer_id, food_id, amount):
+        """Adds `amount` to a line, dropping it at 0. Returns the new quantity."""
+        with self.lock:
+            cart = self.carts.setdefault(customer_id, {})
+            quantity = cart.get(food_id, 0) + amount
+            if quantity > 0:
+                cart[food_id] = quantity
+            else:
+                cart.pop(food_id, None)
+                quantity = 0
+            self.dirty.add(customer_id)
+            return quantity
+
+    def remove(self, customer_id, food_ids):
+        """Drops lines, returns how many existed"""
+        with self.lock:
+            cart = self.carts.setdefault(customer_id, {})
+            removed = sum(cart.pop(food_id, None) is not None for food_id in food_ids)
+            self.dirty.add(customer_id)
+            return removed
+
+    def take_dirty(self):
+        """Customer ids of the carts changed since the last call"""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            return dirty
+
+    def mark_dirty(self, customer_ids):
+        with self.lock:
+            self.dirty.update(customer_ids)
+
+
+class RedisCartStore:
+    """Carts as Redis hashes of food_id -> quantity, shared by all workers"""
+    prefix = 'cart:'
+    dirty_key = 'cart:dirty'
+    # present in every loaded cart, so an empty cart is not loaded again
+    loaded_field = 'loaded'
+    # marks the cart loaded and writes the lines in one step, without
+    # overwriting lines incremented by another worker meanwhile
+    load_script = """
+if redis.call('HSETNX', KEYS[1], ARGV[1], 1) == 1 then
+    for i = 2, #ARGV, 2 do
+        redis.call('HSETNX', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+"""
+
+    def __init__(self, client):
+        self.client = client
+        self._load = client.register_script(self.load_script)
+
+    @classmethod
+    def from_url(cls, url):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError('A redis:// CART_STORE needs the redis package installed') from e
+        return cls(redis.Redis.from_url(url, decode_responses=True))
+
+    def _key(self, customer_id):
+        return f'{self.prefix}{customer_id}'
+
+    def get(self, customer_id):
+        fields = self.client.hgetall(self._key(customer_id))
+        if not fields:
+            return None
+        return {int(food_id): int(quantity) for food_id, quantity in fields.items()
+                if food_id != self.loaded_field}
+
+    def load(self, customer_id, lines):
+        fields = [value for line in dict(lines).items() for value in line]
+        self._load(keys=[self._key(customer_id)], args=[self.loaded_field, *fields])
+        return self.get(customer_id)
+
+    def increment(self, customer_id, food_id, amount):
+        key = self._key(customer_id)
+        quantity = self.client.hincrby(key, food_id, amount)
+        if quantity <= 0:
+            self.client.hdel(key, food_id)
+            quantity = 0
+        self.client.sadd(self.dirty_key, customer_id)
+        return quantity
+
+    def remove(self, customer_id, food_ids):
+        removed = self.client.hdel(self._key(customer_id), *food_ids) if food_ids else 0
+        self.client.sadd(self.dirty_key, customer_id)
+        return removed
+
+    def take_dirty(self):
+        dirty = set()
+        # SPOP is atomic, a cart changed meanwhile is marked again
+        while popped := self.client.spop(self.dirty_key, 500):
+            dirty.update(int(customer_id) for customer_id in popped)
+        return dirty
+
+    def mark_dirty(self, customer_ids):
+        if customer_ids:
+            self.client.sadd(self.dirty_key, *customer_ids)
+
+
+def init_cart_store(app):
+    setting = app.config.get('CART_STORE')
+    if not setting:
+        return
+    store = MemoryCartStore() if setting == 'memory' else RedisCartStore.from_url(setting)
+    app.extensions['cart_store'] = store
+    app.extensions['cart_store_persisted_at'] = time.monotonic()
+
+    @app.after_request
+    def write_behind(response):
+        interval = app.config.get('CART_WRITE_BEHIND_SECONDS')
+        if interval is not None and time.monotonic() - app.extensions['cart_store_persisted_at'] >= interval:
+            app.extensions['cart_store_persisted_at'] = time.monotonic()
+            # an app context of its own has its own session, the request's is left alone
+            with app.app_context():
+                try:
+                    persist_dirty_carts()
+                except Exception:
+                    logger.exception('Could not persist the changed carts')
+        return response
+
+
+def get_cart_store():
+    """The cart store of the app, None when carts live in the Cart table only"""
+    return current_app.extensions.get('cart_store')
+
+
+def get_cart(customer_id):
+    """{food_id: quantity} of the customer, loaded from the Cart table on first use"""
+    store = get_cart_store()
+    cart = store.get(customer_id)
+    if cart is None:
+        lines = db.session.execute(select(Cart.food_id, func.sum(Cart.quantity)).where(
+            Cart.customer_id == customer_id).group_by(Cart.food_id).order_by(func.min(Cart.id))).all()
+        cart = store.load(customer_id, lines)
+    return cart
+
+
+def increment_cart_line(customer_id, food_id, amount):
+    get_cart(customer_id)
+    return get_cart_store().increment(customer_id, int(food_id), amount)
+
+
+def remove_cart_lines(customer_id, food_ids):
+    get_cart(customer_id)
+    return get_cart_store().remove(customer_id, [int(food_id) for food_id in food_ids])
+
+
+def persist_cart(customer_id):
+    """
+    Makes the Cart rows of the customer match the store. Does not commit.
+    Lines of dishes that no longer exist are not written.
+    """
+    cart = get_cart(customer_id)
+    rows = dict(db.session.execute(select(Cart.food_id, Cart.quantity).where(
+        Cart.customer_id == customer_id)).all())
+
+    gone = [food_id for food_id in rows if food_id not in cart]
+    if gone:
+        db.session.execute(delete(Cart).where(Cart.customer_id == customer_id, Cart.food_id.in_(gone)))
+    changed = [{'food': food_id, 'quantity': quantity} for food_id, quantity in cart.items()
+               if food_id in rows and rows[food_id] != quantity]
+    if changed:
+        db.session.execute(update(Cart.__table__).where(
+            Cart.customer_id == customer_id, Cart.food_id == bindparam('food')
+        ).values(quantity=bindparam('quantity')), changed)
+    new = [food_id for food_id in cart if food_id not in rows]
+    if new:
+        known = set(db.session.execute(select(Food.id).where(Food.id.in_(new))).scalars())
+        new_rows = [{'customer_id': customer_id, 'food_id': food_id, 'quantity': cart[food_id]}
+                    for food_id in new if food_id in known]
+        if new_rows:
+            db.session.execute(insert(Cart), new_rows)
+
+
+def persist_dirty_carts():
+    """Write-behind pass: persists the carts changed since the last pass, returns how many"""
+    store = get_cart_store()
+    if store is None:
+        return 0
+    dirty = store.take_dirty()
+    if not dirty:
+        return 0
+    try:
+        for customer_id in dirty:
+            persist_cart(customer_id)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        store.mark_dirty(dirty)
+        raise
+    return len(dirty)
@@ -0,0 +1,199 @@
+"""
+Change tracking for the restaurant catalogue.
+
+Search and the other views derived from restaurants, their addresses, menus
+and cuisines need to know which restaurants a write touched. A session
+after_flush hook works that out once per flush, loads the current record
+of every touched restaurant and hands them to
+- flush listeners, on the flush connection, so derived tables change in the
+  same transaction as the catalogue,
+- commit listeners, once the transaction committed, for in-memory views
+  that must not see writes that are rolled back.
+
+Writes that bypass the ORM session (Core inserts, bulk updates) are not
+seen; the rebuild commands of the listeners cover those.
+"""
+import threading
+import time
+from flask import current_app
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+from .extensions import db
+from .models import Address, Cuisine, Food, Restaurant, RestaurantReview
+
+_flush_listeners = []
+_commit_listeners = []
+_locks_lock = threading.Lock()
+
+
+def on_catalogue_flush(listener):
+    """
+    Registers listener(connection, records, removed_ids), called inside
+    every flush that touched the catalogue. Usable as a decorator.
+    """
+    _flush_listeners.append(listener)
+    return listener
+
+
+def on_catalogue_commit(listener):
+    """
+    Registers listener(records, removed_ids), called after a commit that
+    touched the catalogue. Usable as a decorator.
+    """
+    _commit_listeners.append(listener)
+    return listener
+
+
+def load_restaurant_records(connection, restaurant_ids=None):
+    """
+    Catalogue record per restaurant (all of them without `restaurant_ids`):
+    id, name, description, rating, locations, cuisines, dishes and the
+    price of its most expensive dish. Three queries per call.
+    """
+    query = select(Restaurant.id, Restaurant.user_id, Restaurant.name, Restaurant.description,
+                   Restaurant.rating).order_by(Restaurant.id)
+    if restaurant_ids is not None:
+        query = query.where(Restaurant.id.in_(restaurant_ids))
+    restaurants = connection.execute(query).all()
+    if not restaurants:
+        return []
+    ids = [row.id for row in restaurants]
+
+    locations = {}
+    for user_id, location in connection.execute(select(Address.user_id, Address.location).where(
+            Address.user_id.in_({row.user_id for row in restaurants})).order_by(Address.id)):
+        locations.setdefault(user_id, []).append(location)
+
+    dishes, cuisines, top_prices = {}, {}, {}
+    for restaurant_id, dish, price, cuisine in connection.execute(select(
+            Food.restaurant_id, Food.name, Food.price, Cuisine.name
+    ).join(Cuisine, Cuisine.id == Food.cuisine_id).where(Food.restaurant_id.in_(ids)).order_by(Food.id)):
+        dishes.setdefault(restaurant_id, []).append(dish)
+        cuisines.setdefault(restaurant_id, set()).add(cuisine)
+        top_prices[restaurant_id] = max(price, top_prices.get(restaurant_id, price))
+
+    return [{
+        'id': row.id,
+        'name': row.name,
+        'description': row.description or '',
+        'rating': row.rating,
+        'locations': locations.get(row.user_id, []),
+        'cuisines': sorted(cuisines.get(row.id, ())),
+        'dishes': dishes.get(row.id, []),
+        'top_price': top_prices.get(row.id),
+    } for row in restaurants]
+
+
+def _value(obj, attribute):
+    # deleted and expired rows cannot be refreshed, read what was loaded
+    state = inspect(obj)
+    value = state.dict.get(attribute)
+    if value is None:
+        history = state.attrs[attribute].history
+        value = (history.deleted or history.unchanged or [None])[0]
+    return value
+
+
+def touched_restaurants(session, connection):
+    """(changed_ids, removed_ids) of the restaurants affected by the flush"""
+    changed, removed, owner_ids, cuisine_ids = set(), set(), set(), set()
+    for obj in session.new | session.dirty | session.deleted:
+        deleted = obj in session.deleted
+        if obj in session.dirty and not session.is_modified(obj):
+            continue
+        if isinstance(obj, Restaurant):
+            (removed if deleted else changed).add(_value(obj, 'id'))
+        elif isinstance(obj, Food):
+            changed.add(_value(obj, 'restaurant_id'))
+            # a dish moved to another restaurant changes both
+            changed.update(inspect(obj).attrs.restaurant_id.history.deleted or ())
+        elif isinstance(obj, Address):
+            owner_ids.add(_value(obj, 'user_id'))
+        elif isinstance(obj, Cuisine) and obj not in session.new:
+            cuisine_ids.add(_value(obj, 'id'))
+        elif isinstance(obj, RestaurantReview) and obj in session.new:
+            # the insert hook updated the rating outside the session
+            changed.add(_value(obj, 'restaurant_id'))
+
+    if owner_ids:
+        changed.update(connection.execute(
+            select(Restaurant.id).where(Restaurant.user_id.in_(owner_ids))).scalars())
+    if cuisine_ids:
+        changed.update(connection.execute(
+            select(Food.restaurant_id).where(Food.cuisine_id.in_(cuisine_ids)).distinct()).scalars())
+    changed -= removed
+    changed.discard(None)
+    removed.discard(None)
+    return changed, removed
+
+
+@event.listens_for(Session, 'after_flush')
+def notify_catalogue_listeners(session, flush_context):
+    if not (_flush_listeners or _commit_listeners):
+        return
+    connection = session.connection()
+    changed, removed = touched_restaurants(session, connection)
+    if not (changed or removed):
+        return
+    records = load_restaurant_records(connection, changed) if changed else []
+    for listener in _flush_listeners:
+        listener(connection, records, removed)
+    if _commit_listeners:
+        # later flushes of the same transaction overwrite earlier records
+        pending = session.info.setdefault('catalogue_pending', {})
+        pending.update((record['id'], record) for record in records)
+        pending.update(dict.fromkeys(removed))
+
+
+@event.listens_for(Session, 'after_commit')
+def notify_catalogue_commit(session):
+    pending = session.info.pop('catalogue_pending', None)
+    if pending:
+        records = [record for record in pending.values() if record is not None]
+        removed = {restaurant_id for restaurant_id, record in pending.items() if record is None}
+        for listener in _commit_listeners:
+            listener(records, removed)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_catalogue_changes(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop('catalogue_pending', None)
+
+
+def get_catalogue_view(name, build, max_age=None):
+    """
+    In-memory view of the catalogue kept in app.extensions[name]. It is
+    built with build(records) on first use and again once it is older than
+    `max_age` seconds, which picks up writes of other processes. Views have
+    a `built_at` attribute (time.monotonic()).
+
+    One thread at a time builds a view. Requests wait for the first build,
+    but an expired view keeps being served while another thread rebuilds it.
+    """
+    view = current_app.extensions.get(name)
+    if view is not None and not _expired(view, max_age):
+        return view
+    lock = _view_lock(name)
+    # nothing to serve yet: wait for the build, otherwise serve the old view meanwhile
+    if not lock.acquire(blocking=view is None):
+        return view
+    try:
+        # another thread may have built it while we waited for the lock
+        view = current_app.extensions.get(name)
+        if view is None or _expired(view, max_age):
+            view = build(load_restaurant_records(db.session.connection()))
+            current_app.extensions[name] = view
+        return view
+    finally:
+        lock.release()
+
+
+def _expired(view, max_age):
+    return max_age is not None and time.monotonic() - view.built_at > max_age
+
+
+def _view_lock(name):
+    locks = current_app.extensions.setdefault('catalogue_view_locks', {})
+    with _locks_lock:
+        return locks.setdefault(name, threading.Lock())
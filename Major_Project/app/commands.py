@@ -0,0 +1,199 @@
+"""Maintenance commands, run with `flask <command>`"""
+import click
+from sqlalchemy import case, func, inspect, select, text
+from .extensions import db
+from .models import (Cart, DishReview, FavouriteRestaurant, Food, OrderDetail, Restaurant,
+                     RestaurantReview)
+from .search import rebuild_search_index
+from .cart_store import persist_dirty_carts
+from .order_stats import rebuild_order_stats
+from .sales import rebuild_sales_rollups
+
+
+def backfill_rating_aggregates():
+    """
+    Recomputes rating_sum/rating_count on Food and Restaurant from the review
+    tables. Restaurants with reviews get their rating set to the review
+    average, the others keep their current rating.
+    """
+    add_missing_columns(Food.__table__)
+    add_missing_columns(Restaurant.__table__)
+    food = Food.__table__
+    dish_reviews = DishReview.__table__
+    dish_sum = select(func.coalesce(func.sum(dish_reviews.c.rating), 0)).where(
+        dish_reviews.c.food_id == food.c.id).scalar_subquery()
+    dish_count = select(func.count(dish_reviews.c.id)).where(
+        dish_reviews.c.food_id == food.c.id).scalar_subquery()
+    db.session.execute(food.update().values(rating_sum=dish_sum, rating_count=dish_count))
+
+    restaurant = Restaurant.__table__
+    rest_reviews = RestaurantReview.__table__
+    rest_sum = select(func.coalesce(func.sum(rest_reviews.c.rating), 0)).where(
+        rest_reviews.c.restaurant_id == restaurant.c.id).scalar_subquery()
+    rest_count = select(func.count(rest_reviews.c.id)).where(
+        rest_reviews.c.restaurant_id == restaurant.c.id).scalar_subquery()
+    db.session.execute(restaurant.update().values(
+        rating_sum=rest_sum,
+        rating_count=rest_count,
+        rating=case((rest_count > 0, rest_sum * 1.0 / rest_count), else_=restaurant.c.rating)))
+
+    db.session.commit()
+
+
+@click.command('backfill-ratings')
+def backfill_ratings_command():
+    """Recompute the materialized dish and restaurant ratings"""
+    backfill_rating_aggregates()
+    click.echo('Rating aggregates recomputed.')
+
+
+def add_missing_columns(table):
+    """
+    Adds the columns declared on `table` that an existing database does not
+    have yet. Only meant for nullable columns and NOT NULL columns with a
+    server default, which fills the existing rows. Returns the names of the
+    added columns.
+    """
+    existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+    ddl = db.engine.dialect.ddl_compiler(db.engine.dialect, None)
+    added = []
+    for column in table.columns:
+        if column.name not in existing:
+            db.session.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {ddl.get_column_specification(column)}'))
+            added.append(column.name)
+    db.session.commit()
+    return added
+
+
+def backfill_order_snapshots():
+    """
+    Copies the current dish name and price into order lines written before
+    OrderDetail kept a snapshot. Returns the number of updated lines.
+    """
+    add_missing_columns(OrderDetail.__table__)
+    detail = OrderDetail.__table__
+    food = Food.__table__
+    result = db.session.execute(detail.update().where(detail.c.unit_price.is_(None)).values(
+        unit_price=select(food.c.price).where(food.c.id == detail.c.food_id).scalar_subquery(),
+        food_name=select(food.c.name).where(food.c.id == detail.c.food_id).scalar_subquery()))
+    db.session.commit()
+    return result.rowcount
+
+
+@click.command('backfill-order-snapshots')
+def backfill_order_snapshots_command():
+    """Store dish name and price on order lines that do not have them"""
+    updated = backfill_order_snapshots()
+    click.echo(f'{updated} order line(s) backfilled.')
+
+
+def upgrade_existing_tables():
+    """
+    Adds the columns that databases created by older versions lack and fills
+    them, before anything at startup queries these tables. Needs an app context.
+    """
+    if add_missing_columns(Food.__table__) + add_missing_columns(Restaurant.__table__):
+        backfill_rating_aggregates()
+    # the sales rollups are rebuilt from the order line prices
+    if add_missing_columns(OrderDetail.__table__):
+        backfill_order_snapshots()
+
+
+def deduplicate_unique_pairs():
+    """
+    Merges duplicate cart lines and drops duplicate favourites, which older
+    databases may contain, so that the unique indexes can be built.
+    """
+    duplicate_lines = db.session.query(
+        Cart.customer_id, Cart.food_id, func.min(Cart.id), func.sum(Cart.quantity)
+    ).group_by(Cart.customer_id, Cart.food_id).having(func.count(Cart.id) > 1).all()
+    for customer_id, food_id, keep_id, quantity in duplicate_lines:
+        Cart.query.filter(Cart.id == keep_id).update({Cart.quantity: quantity})
+        Cart.query.filter(Cart.customer_id == customer_id, Cart.food_id == food_id,
+                          Cart.id != keep_id).delete()
+
+    first_favourites = db.session.query(func.min(FavouriteRestaurant.id)).group_by(
+        FavouriteRestaurant.customer_id, FavouriteRestaurant.restaurant_id)
+    FavouriteRestaurant.query.filter(
+        FavouriteRestaurant.id.not_in(first_favourites)).delete(synchronize_session=False)
+
+    db.session.commit()
+
+
+def create_missing_indexes():
+    """
+    Creates the indexes declared on the models that an existing database does
+    not have yet (db.create_all only creates them with new tables), and
+    rebuilds the ones whose columns changed since they were created.
+    Returns the names of the created indexes.
+    """
+    deduplicate_unique_pairs()
+    inspector = inspect(db.engine)
+    created = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index['name']: index['column_names'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            # backend specific indexes, e.g. trigram search on Postgres
+            if index.info.get('dialects') and db.engine.dialect.name not in index.info['dialects']:
+                continue
+            columns = [column.name for column in index.columns]
+            if index.name in existing:
+                # expression indexes are not compared
+                if None in existing[index.name] or not columns or existing[index.name] == columns:
+                    continue
+                index.drop(bind=db.engine)
+            if index.info.get('extension'):
+                with db.engine.begin() as connection:
+                    connection.execute(text(f'CREATE EXTENSION IF NOT EXISTS {index.info["extension"]}'))
+            index.create(bind=db.engine)
+            created.append(index.name)
+    return created
+
+
+@click.command('create-indexes')
+def create_indexes_command():
+    """Create the indexes declared on the models that are missing"""
+    created = create_missing_indexes()
+    for name in created:
+        click.echo(f'Created index {name}')
+    click.echo(f'{len(created)} index(es) created.')
+
+
+@click.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Recreate the restaurant search documents"""
+    indexed = rebuild_search_index()
+    click.echo(f'{indexed} restaurant(s) indexed.')
+
+
+@click.command('persist-carts')
+def persist_carts_command():
+    """Write the carts changed in the cart store to the Cart table"""
+    persisted = persist_dirty_carts()
+    click.echo(f'{persisted} cart(s) persisted.')
+
+
+@click.command('rebuild-order-stats')
+def rebuild_order_stats_command():
+    """Recompute the order counts and revenue per restaurant and status"""
+    rows = rebuild_order_stats()
+    click.echo(f'{rows} order stats row(s) written.')
+
+
+@click.command('rebuild-sales-rollups')
+def rebuild_sales_rollups_command():
+    """Recompute the hourly dish sales and the daily restaurant sales"""
+    rows = rebuild_sales_rollups()
+    click.echo(f'{rows} sales rollup row(s) written.')
+
+
+def register_commands(app):
+    app.cli.add_command(backfill_ratings_command)
+    app.cli.add_command(create_indexes_command)
+    app.cli.add_command(backfill_order_snapshots_command)
+    app.cli.add_command(rebuild_search_index_command)
+    app.cli.add_command(persist_carts_command)
+    app.cli.add_command(rebuild_order_stats_command)
+    app.cli.add_command(rebuild_sales_rollups_command)
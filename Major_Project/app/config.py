@@ -6,6 +6,65 @@ class Config:
     SECRET_KEY = os.getenv("SECRET_KEY","default-key")
     TEMPLATES_AUTO_RELOAD = True
 
+    # Per-request SQL stats (app/instrumentation.py). Headers default to debug mode,
+    # otherwise every request writes one JSON log line while SQL_REQUEST_LOG is on.
+    # Slow queries are logged with their parameters (user data) only in debug mode
+    # or with SQL_LOG_PARAMETERS = True.
+    SQL_INSTRUMENTATION = True
+    SQL_STATS_HEADERS = None
+    SQL_REQUEST_LOG = True
+    SQL_LOG_PARAMETERS = None
+    SQL_SLOWEST_STATEMENTS = 3
+    SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", 200))
+
+    # In-memory search suggestions (app/autocomplete.py), fully rebuilt after this
+    # many seconds to pick up writes of other processes. None never rebuilds.
+    AUTOCOMPLETE_REFRESH_SECONDS = 300
+
+    # In-memory restaurant filter index (app/filter_index.py) for the listing and
+    # the sidebar counts, rebuilt like the autocomplete index. False uses SQL filters.
+    FILTER_INDEX = True
+    FILTER_INDEX_REFRESH_SECONDS = 300
+
+    # Cuisine and location lists (app/reference_data.py), kept per process unless
+    # REFERENCE_CACHE_URL points at a Redis server shared by all workers.
+    REFERENCE_CACHE_URL = os.getenv("REFERENCE_CACHE_URL")
+    REFERENCE_CACHE_TTL = 300
+
+    # Role, customer id and restaurant ids of the logged in user (app/identity.py),
+    # kept in the signed session cookie for this many seconds. 0 loads them per request.
+    IDENTITY_SESSION_MAX_AGE = 300
+
+    # Where cart clicks go (app/cart_store.py). None writes them to the Cart table,
+    # "memory" (single worker) or a redis:// URL keeps carts there and writes them to
+    # the Cart table at checkout and every CART_WRITE_BEHIND_SECONDS.
+    CART_STORE = os.getenv("CART_STORE")
+    CART_WRITE_BEHIND_SECONDS = 30
+
+    # Restaurant order counts and revenue (app/order_stats.py) read from the rollup
+    # table kept current with the order writes. False counts the orders instead.
+    ORDER_STATS_ROLLUP = True
+
+    # Live order feed of the restaurant order pages (app/order_feed.py): a comment line
+    # every KEEPALIVE seconds, streams end after STREAM seconds and the browser
+    # reconnects, missing up to REPLAY events. QUEUE_SIZE events wait per stream.
+    ORDER_FEED_KEEPALIVE_SECONDS = 15
+    ORDER_FEED_STREAM_SECONDS = 300
+    ORDER_FEED_QUEUE_SIZE = 100
+    ORDER_FEED_REPLAY = 1000
+
+    # Order event bus (app/order_events.py): consumers run on their own thread, with
+    # QUEUE_SIZE events waiting each. When a queue is full the request waits up to
+    # BLOCK_SECONDS, then runs the consumer itself. SYNCHRONOUS runs them all in the request.
+    ORDER_EVENT_QUEUE_SIZE = 1000
+    ORDER_EVENT_BLOCK_SECONDS = 0.5
+    ORDER_EVENTS_SYNCHRONOUS = False
+    # Dotted paths of functions getting every order event, e.g. mail or push senders
+    ORDER_NOTIFICATION_SINKS = ['app.order_events.log_notification']
+    # Restaurants a customer ordered from this many times in a month become automatic
+    # favourites. None turns it off.
+    AUTO_FAVOURITE_MIN_ORDERS = 2
+
 
 class TestingConfig(Config):
     """Testing configuration"""
@@ -14,4 +73,6 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECRET_KEY = 'test-secret-key'
-    LOGIN_DISABLED = False
\ No newline at end of file
+    LOGIN_DISABLED = False
+    SQL_REQUEST_LOG = False
+    ORDER_EVENTS_SYNCHRONOUS = True
\ No newline at end of file
@@ -2,8 +2,8 @@
 import re
 from functools import wraps
 from flask import flash, request, redirect
-from app.models import Address, Cuisine, Restaurant, User
-from sqlalchemy import distinct
+from datetime import datetime
+from app.reference_data import get_cuisines, get_restaurant_locations
 
 def check_transaction_complete(func):
     @wraps(func)
@@ -43,31 +43,22 @@ def is_valid_phone(phone):
 
 
 def get_all_locations():
-    """Get all unique locations from the addresses table"""
+    """Get all unique locations of restaurants, from the reference data cache"""
     try:
-        # Join with Restaurant to only get locations where there are active restaurants
-        locations = Address.query.join(
-            User, Address.user_id == User.id
-        ).join(
-            Restaurant, Restaurant.user_id == User.id
-        ).with_entities(
-            distinct(Address.location)
-        ).all()
-        
-        # Extract location strings from tuples
-        return [loc[0] for loc in locations if loc[0]]
+        return get_restaurant_locations()
     except Exception as e:
         print(f"Error getting locations: {str(e)}")
         return []
 
 def get_all_cuisines():
-    """Get all available cuisines"""
+    """Get all available cuisines as (id, name) tuples, from the reference data cache"""
     try:
-        cuisines = Cuisine.query.order_by(Cuisine.name).all()
-        return cuisines
+        return get_cuisines()
     except Exception as e:
         return []
 
 
-
-
+def is_open_now(opening_time, closing_time, now=None):
+    """Check whether a restaurant is open, using its already loaded timings"""
+    now = now or datetime.now().time()
+    return opening_time < now < closing_time
@@ -9,6 +9,9 @@ from flask_login import login_required, current_user
 from .forms import *  
 from app.models import DishReview, RestaurantReview
 from app.extensions import csrf
+from app.pagination import ORDER_STATUSES, get_order_status_counts
+from app.autocomplete import AUTOCOMPLETE_LIMIT, AUTOCOMPLETE_MAX_LIMIT, suggest
+from app.filter_index import get_indexed_facets, parse_minimum
 
 
 
@@ -43,38 +46,33 @@ def view_restaurants():
         min_rating = args.get('min_rating')
         cuisines = args.getlist('cuisine')
         name_filter = args.get('name_filter')
-        min_price = args.get('min_price', type=float)
-        # Get all restaurants first
-        restaurants = get_restaurant_list(customer_id) if not any([locations, min_rating, cuisines, name_filter, min_price]) else \
-                     get_restaurant_list(
-                        customer_id=customer_id,
-                        min_rating=min_rating,
-                        locations=locations,
-                        cuisines=cuisines,
-                        name_filter=name_filter,
-                        min_price=min_price
-                     )
-        
+        # finite numbers only, nan or inf would be new cache keys of the filter index
+        min_price = parse_minimum(args.get('min_price'))
         
         try:
-            # Prepare restaurant data for template
-            restaurant_data = []
-            for restaurant in restaurants:
-                restaurant_data.append({
-                    "id": restaurant.id,
-                    "name": restaurant.name,
-                    "rating": restaurant.rating,
-                    "image_url": restaurant.image_url,
-                    "location": get_location_by_restaurant_id(restaurant.id),
-                    "open_status": get_restaurant_open_and_close_time(restaurant.id),
-                    "is_favorite": is_favourite_restaurant(restaurant.id, customer_id),
-                })
+            # Restaurant cards with location, open status and favourite flag
+            restaurant_data = get_restaurant_listing(
+                customer_id=customer_id,
+                min_rating=min_rating,
+                locations=locations,
+                cuisines=cuisines,
+                name_filter=name_filter,
+                min_price=min_price
+            )
             
             all_locations = get_all_locations()
             print(f"Found {len(all_locations)} locations")
             
             all_cuisines = get_all_cuisines()
             print(f"Found {len(all_cuisines)} cuisines")
+
+            # matching restaurant counts for the sidebar choices
+            facet_filters = dict(locations=locations, min_rating=min_rating, cuisines=cuisines,
+                                 name_filter=name_filter, min_price=min_price)
+            if filter_index_enabled():
+                facets = get_indexed_facets(RATING_FACETS, PRICE_FACETS, **facet_filters)
+            else:
+                facets = get_restaurant_facets(**facet_filters)
             
             search_form = SearchForm()
             
@@ -84,6 +82,7 @@ def view_restaurants():
                 restaurants=restaurant_data,
                 locations=all_locations,
                 cuisines=all_cuisines,
+                facets=facets,
                 search_form=search_form,
                 is_favourite_restaurant=is_favourite_restaurant,
                 selected_filters={
@@ -103,6 +102,7 @@ def view_restaurants():
                 restaurants=[],
                 locations=[],
                 cuisines=[],
+                facets=None,
                 search_form=SearchForm(),
                 is_favourite_restaurant=lambda x, y: False,
                 selected_filters={}
@@ -139,11 +139,44 @@ def update_cart():
             food_id=food_id, customer_id=customer_id)
 
     flash(message, 'success' if success else 'danger')
-    print("cart", Cart.query.count())
 
     return redirect(url_for('customer.view_restaurant', restaurant_id=restaurant_id))
 
 
+@customer.route('/api/cart/<int:food_id>', methods=['POST'])
+@dont_allow_non_customers
+@login_required
+def cart_line_api(food_id):
+    """ change one cart line in place: JSON {"action": "add"|"subtract"|"remove"} """
+    data = request.get_json(silent=True) or request.form
+    action = data.get('action', 'add')
+    if action not in ('add', 'subtract', 'remove'):
+        return jsonify({'error': 'Unknown action'}), 400
+    food = db.session.get(Food, food_id)
+    if not food:
+        return jsonify({'error': 'Dish not found'}), 404
+    # read before the commit expires the row
+    price = food.price
+    customer_id = get_customer_id_from_user_id(current_user.id)
+
+    if action == 'remove':
+        success, message = remove_from_cart(food_id=food_id, customer_id=customer_id)
+        quantity = 0
+    else:
+        quantity = change_cart_quantity(customer_id, food_id, 1 if action == 'add' else -1)
+        success = quantity is not None
+        message = 'Cart updated' if success else 'No matching item found in cart'
+        quantity = quantity or 0
+
+    return jsonify({
+        'success': success,
+        'message': message,
+        'line': {'food_id': food_id, 'quantity': quantity, 'price': price,
+                 'total': round(quantity * price, 2)},
+        'cart': get_cart_totals(customer_id),
+    }), 200 if success else 404
+
+
 @customer.route('/view_cart')
 @dont_allow_non_customers
 @login_required
@@ -219,29 +252,23 @@ def view_order_history():
     """ returns order headers (orderList) for a customer """
     try:
         customer_id = get_customer_id_from_user_id(current_user.id)
-        pending_orders, delivered_orders, cancelled_orders, all_orders = get_order_headers_for_customer(customer_id)
-        
-        # Handle search functionality
+        status = request.args.get('status')
+        if status not in ORDER_STATUSES:
+            status = None
+        # restaurant name search runs in SQL, on the same pages and tab counts
         search_term = request.args.get('order_restaurant', '').strip()
+        conditions = [OrderList.customer_id == customer_id]
         if search_term:
-            # Filter orders by restaurant name
-            filtered_orders = []
-            for order in all_orders:
-                try:
-                    restaurant = Restaurant.query.get(order.restaurant_id)
-                    if restaurant and search_term.lower() in restaurant.name.lower():
-                        filtered_orders.append(order)
-                except Exception as e:
-                    print(f"Error filtering order {order.id}: {e}")
-                    continue
-            all_orders = filtered_orders
-        
+            conditions.append(orders_of_restaurants_named(search_term))
+        status_counts = get_order_status_counts(*conditions)
+        page = get_order_history_page(customer_id, status=status, cursor=request.args.get('cursor'),
+                                      restaurant_name=search_term or None)
+
         return render_template('customer/order_history.html',
-                               pending_orders=pending_orders,
-                               delivered_orders=delivered_orders,
-                               cancelled_orders=cancelled_orders,
-                               all_orders=all_orders,
-                               Restaurant=Restaurant)
+                               all_orders=page.items,
+                               page=page,
+                               status=status,
+                               status_counts=status_counts)
     except Exception as e:
         print(f"Error in view_order_history: {e}")
         flash('Unable to load order history. Please try again.', 'danger')
@@ -255,41 +282,38 @@ def view_order_history():
 def order_detail(order_id):
     """ view the details of a order and allow review submission if delivered """
     order = OrderList.query.get(order_id)
-    order_details = OrderDetail.query.filter_by(order_id=order_id).all()
-    
-    # Create combined order items with food information
-    order_items = []
-    for detail in order_details:
-        food = Food.query.get(detail.food_id)
-        if food:
-            order_items.append({
-                'food_name': food.name,
-                'quantity': detail.quantity,
-                'price': food.price,
-                'food_id': food.id
-            })
-    
+    order_details = get_order_details(order_id)
+
+    # lines are rendered from the name and price stored at order time
+    order_items = [{
+        'food_name': detail.food_name,
+        'quantity': detail.quantity,
+        'price': detail.unit_price,
+        'food_id': detail.food_id
+    } for detail in order_details]
+
     customer_id = get_customer_id_from_user_id(current_user.id)
-    food_items = [Food.query.get(od.food_id) for od in order_details]
+    existing_reviews = {review.food_id: review for review in DishReview.query.filter_by(
+        order_id=order_id, customer_id=customer_id)}
     dish_review_forms = []
     dish_reviews = {}
-    for food in food_items:
+    for item in order_items:
         # Check if review already exists for this dish in this order
-        existing_review = DishReview.query.filter_by(order_id=order_id, food_id=food.id, customer_id=customer_id).first()
-        form = DishReviewForm(prefix=f'dish_{food.id}')
+        existing_review = existing_reviews.get(item['food_id'])
+        form = DishReviewForm(prefix=f"dish_{item['food_id']}")
         if form.validate_on_submit() and not existing_review:
             new_review = DishReview(
                 customer_id=customer_id,
-                food_id=food.id,
+                food_id=item['food_id'],
                 order_id=order_id,
                 rating=form.rating.data,
                 review=form.review.data
             )
             db.session.add(new_review)
             db.session.commit()
-            flash(f'Review submitted for {food.name}', 'success')
-        dish_review_forms.append((food, form, existing_review))
-        dish_reviews[food.id] = existing_review
+            flash(f"Review submitted for {item['food_name']}", 'success')
+        dish_review_forms.append((item, form, existing_review))
+        dish_reviews[item['food_id']] = existing_review
 
     # Restaurant review
     rest_review_form = RestaurantReviewForm(prefix='rest')
@@ -306,7 +330,7 @@ def order_detail(order_id):
         db.session.commit()
         flash('Restaurant review submitted!', 'success')
 
-    return render_template('customer/order_detail.html', order=order, order_items=order_items, food_items=food_items, dish_review_forms=dish_review_forms, dish_reviews=dish_reviews, rest_review_form=rest_review_form, existing_rest_review=existing_rest_review, total_price=order.total_price)
+    return render_template('customer/order_detail.html', order=order, order_items=order_items, dish_review_forms=dish_review_forms, dish_reviews=dish_reviews, rest_review_form=rest_review_form, existing_rest_review=existing_rest_review, total_price=order.total_price)
 
 
 @customer.route('/order/cancel')
@@ -342,41 +366,40 @@ def view_restaurant():
         flash("Restaurant not found", "danger")
         return redirect(url_for('customer.home'))
     cuisines = get_cuisines_for_restaurant(restaurant_id)
-    menu = menu.order_by(Food.category).all()
-    menu_items = []
-    for item in menu:
-        cart_item = Cart.query.filter(
-            Cart.food_id == item.id, Cart.customer_id == customer_id).first()
-        # Get dish reviews and average rating
-        dish_reviews = DishReview.query.filter_by(food_id=item.id).all()
-        avg_dish_rating = round(sum([r.rating for r in dish_reviews])/len(dish_reviews), 1) if dish_reviews else None
-        menu_items.append({
-            'id': item.id,
-            'name': item.name,
-            'price': item.price,
-            'cuisine': item.cuisine_id,
-            'category': item.category,
-            'quantity': cart_item.quantity if cart_item else 0,
-            'is_special': getattr(item, 'is_special', False),
-            'is_deal_of_day': getattr(item, 'is_deal_of_day', False),
-            'dish_reviews': dish_reviews,
-            'avg_dish_rating': avg_dish_rating
-        })
+    menu_items = build_menu_view(restaurant_id, customer_id)
     # Restaurant reviews and average
-    rest_reviews = RestaurantReview.query.filter_by(restaurant_id=restaurant_id).all()
-    avg_rest_rating = round(sum([r.rating for r in rest_reviews])/len(rest_reviews), 1) if rest_reviews else None
+    avg_rest_rating, rest_review_count, rest_reviews = get_restaurant_review_summary(restaurant_id)
     return render_template('customer/restaurant_detail.html', restaurant=restaurant,
                            menu=menu_items,
                            cuisines=cuisines,
                            customer_id=customer_id,
                            restaurant_id=restaurant_id,
-                           is_favourite_food=is_favourite_food,
                            Food=Food,
                            rest_reviews=rest_reviews,
+                           rest_review_count=rest_review_count,
                            avg_rest_rating=avg_rest_rating
                            )
 
 
+@customer.route('/dish_reviews/<int:food_id>')
+@dont_allow_non_customers
+@login_required
+def dish_reviews(food_id):
+    """ one page of reviews for a dish, loaded on demand by the menu page """
+    page = request.args.get('page', 1, type=int)
+    reviews, has_next = get_dish_reviews_page(food_id, page=page)
+    return jsonify({
+        'food_id': food_id,
+        'page': page,
+        'has_next': has_next,
+        'reviews': [{
+            'rating': review.rating,
+            'review': review.review,
+            'review_time': review.review_time.isoformat()
+        } for review in reviews]
+    })
+
+
 
 @customer.route('/view_profile', methods=['GET', 'POST'])
 @check_transaction_complete
@@ -424,6 +447,16 @@ def apply_name_filter():
         return redirect(url_for('customer.view_restaurants'), search_form=search_form)
 
 
+@customer.route('/autocomplete')
+@login_required
+def autocomplete():
+    """ search box suggestions as JSON, answered from memory without queries """
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', AUTOCOMPLETE_LIMIT, type=int)
+    limit = max(1, min(limit, AUTOCOMPLETE_MAX_LIMIT))
+    return jsonify({'query': query, 'suggestions': suggest(query, limit)})
+
+
 @customer.route("add_favourite_restaurant")
 @check_transaction_complete
 @dont_allow_non_customers
@@ -503,7 +536,7 @@ def remove_favourite_food() :
 def auto_set_fav_rest() :
     """used for development purposes, currently not included in app"""
     customer_id = request.args.get('customer_id')
-    print(automatically_set_favourite_Restaurant(customer_id))
+    print(automatically_get_favourite_Restaurant(customer_id))
 
     return redirect(url_for('customer.view_restaurants'))
 
@@ -626,7 +659,6 @@ def cart_update():
             food_id=food_id, customer_id=customer_id)
 
     flash(message, 'success' if success else 'danger')
-    print("cart", Cart.query.count())
 
     return redirect(url_for('customer.view_cart'))
 
@@ -9,7 +9,19 @@ from functools import wraps
 from flask import jsonify, redirect, url_for, flash, request
 from sqlalchemy.sql import func, desc
 from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager
 from datetime import datetime, timedelta
+from app.pagination import ORDERS_PER_PAGE, paginate_orders
+from app.search import search_matches
+from app.filter_index import filter_index_enabled, match_restaurant_ids
+from app.menu import menu_item, menu_query
+from app.identity import current_identity_for, get_identity
+from app.order_stats import get_order_stats
+from app.order_events import ORDER_CANCELLED, ORDER_PLACED, order_values, publish_order_event
+from app.cart_store import (
+    CartLine, get_cart, get_cart_store, increment_cart_line, persist_cart, remove_cart_lines
+)
 
 
 def dont_allow_non_customers(function):
@@ -36,9 +48,9 @@ def dont_allow_non_customers(function):
                 return redirect(url_for('auth.logout'))
             
             # For customers, verify customer record exists
-            customer = Customer.query.filter_by(user_id=current_user.id).first()
-            print(f"Customer record found: {customer is not None}")
-            if not customer:
+            identity = get_identity()
+            print(f"Customer record found: {identity.customer_id is not None}")
+            if identity.customer_id is None:
                 flash('Customer profile not found. Please contact support.', 'danger')
                 return redirect(url_for('auth.logout'))
             
@@ -57,6 +69,10 @@ def dont_allow_non_customers(function):
 def get_customer_id_from_user_id(user_id):
     try:
         print(f"Getting customer_id for user_id: {user_id}")
+        # the logged in user's id is already known for this request
+        identity = current_identity_for(user_id)
+        if identity is not None:
+            return identity.customer_id
         customer = Customer.query.filter_by(user_id=user_id).first()
         if not customer:
             print(f"No customer found for user_id: {user_id}")
@@ -68,84 +84,68 @@ def get_customer_id_from_user_id(user_id):
         return None
 
 
+def get_restaurant_filter_conditions(locations=None, min_rating=None, cuisines=None, name_filter=None, min_price=None):
+    """
+    Builds the filter conditions on Restaurant for the given filters.
+    Address and Food are matched through subqueries so that no join multiplies
+    the restaurant rows and the result never needs a DISTINCT.
+    """
+    conditions = []
+
+    # Apply location filter first (most restrictive)
+    if locations and len(locations) > 0:
+        location_owners = db.session.query(Address.user_id).filter(
+            Address.location.in_(locations))
+        conditions.append(Restaurant.user_id.in_(location_owners))
+        print(f"Applied location filter: {locations}")
+
+    # Apply rating filter
+    if min_rating:
+        try:
+            min_rating_val = float(min_rating)
+            conditions.append(Restaurant.rating >= min_rating_val)
+            print(f"Applied rating filter: >= {min_rating_val}")
+        except (ValueError, TypeError):
+            print(f"Invalid rating value: {min_rating}")
+
+    # Apply cuisine filter
+    if cuisines and len(cuisines) > 0:
+        # restaurants that serve ANY of the selected cuisines
+        cuisine_restaurants = db.session.query(Food.restaurant_id).join(
+            Cuisine, Food.cuisine_id == Cuisine.id
+        ).filter(Cuisine.name.in_(cuisines))
+        conditions.append(Restaurant.id.in_(cuisine_restaurants))
+        print(f"Applied cuisine filter: {cuisines}")
+
+    # Apply price filter
+    if min_price is not None and min_price != '':
+        try:
+            min_price_val = float(min_price)
+            # restaurants that have at least one item at or above the minimum price
+            price_restaurants = db.session.query(Food.restaurant_id).filter(
+                Food.price >= min_price_val)
+            conditions.append(Restaurant.id.in_(price_restaurants))
+            print(f"Applied price filter: >= {min_price_val}")
+        except (ValueError, TypeError):
+            print(f"Invalid price value: {min_price}")
+
+    # Apply search filter, matched on the full-text index (app/search.py)
+    if name_filter and name_filter.strip():
+        conditions.append(Restaurant.id.in_(db.select(search_matches(name_filter).c.restaurant_id)))
+        print(f"Applied search filter: {name_filter}")
+
+    return conditions
+
+
 def get_restaurant_list(customer_id, locations=None, min_rating=None, cuisines=None, name_filter=None, min_price=None):
     """Get list of restaurants based on filters"""
     try:
         print(f"Filtering restaurants with: locations={locations}, rating={min_rating}, cuisines={cuisines}, search={name_filter}, price={min_price}")
-        
-        # Start with base query
-        query = Restaurant.query
-        
-        # Always join with Address for location info
-        query = query.join(Address, Restaurant.user_id == Address.user_id)
-        
-        # Apply location filter first (most restrictive)
-        if locations and len(locations) > 0:
-            query = query.filter(Address.location.in_(locations))
-            print(f"Applied location filter: {locations}")
-
-        # Apply rating filter
-        if min_rating:
-            try:
-                min_rating_val = float(min_rating)
-                query = query.filter(Restaurant.rating >= min_rating_val)
-                print(f"Applied rating filter: >= {min_rating_val}")
-            except (ValueError, TypeError):
-                print(f"Invalid rating value: {min_rating}")
-
-        # Apply cuisine filter
-        if cuisines and len(cuisines) > 0:
-            # Use subquery to find restaurants that serve ANY of the selected cuisines
-            cuisine_subquery = db.session.query(Food.restaurant_id).join(
-                Cuisine, Food.cuisine_id == Cuisine.id
-            ).filter(
-                Cuisine.name.in_(cuisines)
-            ).distinct().subquery()
-            
-            query = query.filter(Restaurant.id.in_(db.session.query(cuisine_subquery.c.restaurant_id)))
-            print(f"Applied cuisine filter: {cuisines}")
-
-        # Apply price filter
-        if min_price is not None and min_price != '':
-            try:
-                min_price_val = float(min_price)
-                # Find restaurants that have at least one item at or above the minimum price
-                price_subquery = db.session.query(Food.restaurant_id).filter(
-                    Food.price >= min_price_val
-                ).distinct().subquery()
-                
-                query = query.filter(Restaurant.id.in_(db.session.query(price_subquery.c.restaurant_id)))
-                print(f"Applied price filter: >= {min_price_val}")
-            except (ValueError, TypeError):
-                print(f"Invalid price value: {min_price}")
-
-        # Apply search filter
-        if name_filter and name_filter.strip():
-            search_term = f"%{name_filter.strip()}%"
-            
-            # Create search conditions
-            search_conditions = [
-                Restaurant.name.ilike(search_term),
-                Address.location.ilike(search_term)
-            ]
-            
-            # Add cuisine search if not already filtering by specific cuisines
-            if not cuisines or len(cuisines) == 0:
-                cuisine_search_subquery = db.session.query(Food.restaurant_id).join(
-                    Cuisine, Food.cuisine_id == Cuisine.id
-                ).filter(
-                    Cuisine.name.ilike(search_term)
-                ).distinct().subquery()
-                
-                search_conditions.append(
-                    Restaurant.id.in_(db.session.query(cuisine_search_subquery.c.restaurant_id))
-                )
-            
-            query = query.filter(or_(*search_conditions))
-            print(f"Applied search filter: {name_filter}")
 
-        # Get distinct restaurants
-        all_restaurants = query.distinct().all()
+        conditions = get_restaurant_filter_conditions(
+            locations=locations, min_rating=min_rating, cuisines=cuisines,
+            name_filter=name_filter, min_price=min_price)
+        all_restaurants = Restaurant.query.filter(*conditions).all()
         print(f"Found {len(all_restaurants)} restaurants after filtering")
         
         if not all_restaurants:
@@ -173,6 +173,137 @@ def get_restaurant_list(customer_id, locations=None, min_rating=None, cuisines=N
         return []
 
 
+def get_restaurant_listing(customer_id, locations=None, min_rating=None, cuisines=None, name_filter=None, min_price=None):
+    """
+    Returns the restaurant cards for the listing page in a single query.
+    Location and the favourite flag are correlated subqueries of the same
+    SELECT and the open status is computed from the loaded timings, so the
+    number of queries does not grow with the number of restaurants.
+    Favourites come first, like in get_restaurant_list, then the best search
+    matches when searching.
+    The filters are answered by the in-memory filter index when it is
+    enabled, the query then only loads the matching restaurants by id.
+    """
+    try:
+        matching_ids = None
+        if filter_index_enabled():
+            matching_ids = match_restaurant_ids(
+                locations=locations, min_rating=min_rating, cuisines=cuisines, min_price=min_price)
+        if matching_ids is not None:
+            conditions = [Restaurant.id.in_(matching_ids)]
+        else:
+            conditions = get_restaurant_filter_conditions(
+                locations=locations, min_rating=min_rating, cuisines=cuisines, min_price=min_price)
+
+        location = db.select(Address.location).where(
+            Address.user_id == Restaurant.user_id
+        ).order_by(Address.id).limit(1).scalar_subquery()
+        is_favourite = db.select(FavouriteRestaurant.id).where(
+            FavouriteRestaurant.customer_id == customer_id,
+            FavouriteRestaurant.restaurant_id == Restaurant.id
+        ).exists()
+
+        query = db.session.query(
+            Restaurant.id, Restaurant.name, Restaurant.rating, Restaurant.image_url,
+            Restaurant.opening_time, Restaurant.closing_time,
+            location.label('location'), is_favourite.label('is_favourite')
+        ).filter(*conditions)
+        order = [desc(is_favourite), Restaurant.id]
+        if name_filter and name_filter.strip():
+            # every match goes through the filters, best matches first
+            matches = search_matches(name_filter)
+            query = query.join(matches, matches.c.restaurant_id == Restaurant.id)
+            order.insert(1, desc(matches.c.score))
+        rows = query.order_by(*order).all()
+
+        now = datetime.now().time()
+        return [{
+            "id": row.id,
+            "name": row.name,
+            "rating": row.rating,
+            "image_url": row.image_url,
+            "location": row.location or "Unknown",
+            "open_status": (is_open_now(row.opening_time, row.closing_time, now),
+                            row.opening_time, row.closing_time),
+            "is_favorite": bool(row.is_favourite),
+        } for row in rows]
+
+    except Exception as e:
+        print(f"Error in get_restaurant_listing: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return []
+
+
+# lower bounds of the sidebar rating ("4+ stars") and price ("dishes from 250") choices
+RATING_FACETS = (4, 3, 2, 1)
+PRICE_FACETS = (100, 250, 500)
+
+
+def get_restaurant_facets(locations=None, min_rating=None, cuisines=None, name_filter=None, min_price=None):
+    """
+    Number of restaurants per location, cuisine, rating and price choice of
+    the filter sidebar, as one UNION ALL of grouped queries.
+    Every facet is counted with all filters except its own, so the counts
+    tell how many restaurants choosing that value would show. Rating and
+    price counts are cumulative like their filters.
+    """
+    filters = {'locations': locations, 'min_rating': min_rating, 'cuisines': cuisines, 'min_price': min_price}
+    search_conditions = []
+    if name_filter and name_filter.strip():
+        search_conditions.append(Restaurant.id.in_(db.select(search_matches(name_filter).c.restaurant_id)))
+
+    def conditions_without(facet):
+        return get_restaurant_filter_conditions(
+            **{name: value for name, value in filters.items() if name != facet}) + search_conditions
+
+    # restaurants per owner first, so only the owners' addresses are read
+    owners = db.select(Restaurant.user_id, func.count().label('restaurants')).where(
+        *conditions_without('locations')).group_by(Restaurant.user_id).subquery()
+    owner_locations = db.select(owners.c.user_id, owners.c.restaurants, Address.location).join(
+        Address, Address.user_id == owners.c.user_id).distinct().subquery()
+    by_location = db.select(
+        db.literal('location').label('facet'), owner_locations.c.location.label('value'),
+        func.sum(owner_locations.c.restaurants).label('restaurants')
+    ).group_by(owner_locations.c.location)
+
+    by_cuisine = db.select(
+        db.literal('cuisine'), Cuisine.name, func.count(db.distinct(Restaurant.id))
+    ).join(Food, Food.restaurant_id == Restaurant.id).join(Cuisine, Cuisine.id == Food.cuisine_id).where(
+        *conditions_without('cuisines')).group_by(Cuisine.name)
+
+    # buckets are computed in a subquery so the outer GROUP BY is a plain column
+    rating_bucket = db.select(Restaurant.id, db.case(
+        *[(Restaurant.rating >= bound, bound) for bound in RATING_FACETS], else_=0
+    ).label('bucket')).where(*conditions_without('min_rating')).subquery()
+    by_rating = db.select(
+        db.literal('rating'), db.cast(rating_bucket.c.bucket, db.String), func.count()
+    ).group_by(rating_bucket.c.bucket)
+
+    top_price = db.select(Food.restaurant_id, func.max(Food.price).label('price')).group_by(
+        Food.restaurant_id).subquery()
+    price_bucket = db.select(Restaurant.id, db.case(
+        *[(top_price.c.price >= bound, bound) for bound in reversed(PRICE_FACETS)], else_=0
+    ).label('bucket')).join(top_price, top_price.c.restaurant_id == Restaurant.id).where(
+        *conditions_without('min_price')).subquery()
+    by_price = db.select(
+        db.literal('price'), db.cast(price_bucket.c.bucket, db.String), func.count()
+    ).group_by(price_bucket.c.bucket)
+
+    facets = {'location': {}, 'cuisine': {},
+              'rating': dict.fromkeys(RATING_FACETS, 0), 'price': dict.fromkeys(PRICE_FACETS, 0)}
+    for facet, value, restaurants in db.session.execute(
+            db.union_all(by_location, by_cuisine, by_rating, by_price)):
+        if facet in ('rating', 'price'):
+            bucket = float(value)
+            for bound in facets[facet]:
+                if bound <= bucket:
+                    facets[facet][bound] += restaurants
+        elif value:
+            facets[facet][value] = restaurants
+    return facets
+
+
 def get_cuisines_for_restaurant(restaurant_id):
     """
     Retrieves the cuisines available for a specific restaurant.
@@ -183,69 +314,109 @@ def get_cuisines_for_restaurant(restaurant_id):
     return cuisines
 
 
-def add_to_cart(food_id, customer_id):
+def cart_upsert():
+    """INSERT ... ON CONFLICT of the session's database, None where it has none"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        return None
+    return insert(Cart.__table__)
 
-    cart_item = Cart.query.filter(
-        Cart.food_id == food_id, Cart.customer_id == customer_id).first()
 
-    if cart_item:
-        cart_item.quantity += 1
-        db.session.commit()
-        return True, "+1"
+def change_cart_quantity(customer_id, food_id, amount):
+    """
+    Adds `amount` (negative to take away) to the customer's cart line of a
+    dish in one atomic statement and drops the line when it reaches 0.
+    Adding upserts on the (customer_id, food_id) unique index, taking away
+    only updates an existing line. Returns the new quantity, None when
+    there was no line to take away from.
+    """
+    food_id = int(food_id)
+    if get_cart_store() is not None:
+        if amount < 0 and food_id not in get_cart(customer_id):
+            return None
+        return increment_cart_line(customer_id, food_id, amount)
+
+    cart = Cart.__table__
+    line = (cart.c.customer_id == customer_id) & (cart.c.food_id == food_id)
+    upsert = cart_upsert() if amount > 0 else None
+    if upsert is not None:
+        statement = upsert.values(customer_id=customer_id, food_id=food_id, quantity=amount)
+        statement = statement.on_conflict_do_update(
+            index_elements=[cart.c.customer_id, cart.c.food_id],
+            set_={'quantity': cart.c.quantity + statement.excluded.quantity})
     else:
-        cart_item = Cart(food_id=food_id, quantity=1, customer_id=customer_id)
-        db.session.add(cart_item)
-        db.session.commit()
-        return True, "Item added to cart"
+        statement = cart.update().where(line).values(quantity=cart.c.quantity + amount)
+    quantity = db.session.execute(statement.returning(cart.c.quantity)).scalar()
+    if quantity is None and amount > 0:
+        # no ON CONFLICT support on this database
+        db.session.execute(cart.insert().values(customer_id=customer_id, food_id=food_id, quantity=amount))
+        quantity = amount
+    if quantity is not None and quantity <= 0:
+        db.session.execute(cart.delete().where(line))
+        quantity = 0
+    db.session.commit()
+    return quantity
 
 
-def remove_from_cart(food_id, customer_id):
+def get_cart_totals(customer_id):
+    """Number of items and price total of the customer's cart"""
+    if get_cart_store() is not None:
+        cart = get_cart(customer_id)
+        prices = dict(db.session.query(Food.id, Food.price).filter(Food.id.in_(cart))) if cart else {}
+        lines = [(quantity, prices[food_id]) for food_id, quantity in cart.items() if food_id in prices]
+        return {'items': sum(quantity for quantity, _ in lines),
+                'total': round(sum(quantity * price for quantity, price in lines), 2)}
 
-    cart_item = Cart.query.filter(
-        Cart.food_id == food_id, Cart.customer_id == customer_id).first()
+    items, total = db.session.query(
+        func.coalesce(func.sum(Cart.quantity), 0), func.coalesce(func.sum(Cart.quantity * Food.price), 0)
+    ).join(Food, Food.id == Cart.food_id).filter(Cart.customer_id == customer_id).one()
+    return {'items': int(items), 'total': round(float(total), 2)}
 
-    if cart_item:
-        db.session.delete(cart_item)
-        db.session.commit()
 
-        return True, "removed item from cart"
-
-    else:
-        return False, "No matching item found in cart"
+def add_to_cart(food_id, customer_id):
 
+    quantity = change_cart_quantity(customer_id, food_id, 1)
+    return True, "+1" if quantity > 1 else "Item added to cart"
 
-def subtract_from_cart(food_id, customer_id):
 
-    cart_item = Cart.query.filter(
-        Cart.food_id == food_id, Cart.customer_id == customer_id).first()
+def remove_from_cart(food_id, customer_id):
 
-    if cart_item:
+    if get_cart_store() is not None:
+        removed = remove_cart_lines(customer_id, [food_id])
+    else:
+        removed = db.session.execute(Cart.__table__.delete().where(
+            Cart.customer_id == customer_id, Cart.food_id == int(food_id))).rowcount
+        db.session.commit()
 
-        if cart_item.quantity <= 1:
-            return remove_from_cart(food_id=food_id, customer_id=customer_id)
+    if removed:
+        return True, "removed item from cart"
+    else:
+        return False, "No matching item found in cart"
 
-        else:
-            cart_item.quantity -= 1
-            db.session.commit()
-            return True, "-1"
 
-    else:
+def subtract_from_cart(food_id, customer_id):
 
+    quantity = change_cart_quantity(customer_id, food_id, -1)
+    if quantity is None:
         return False, "No matching item found in cart"
+    if quantity == 0:
+        return True, "removed item from cart"
+    return True, "-1"
 
 
 def get_cart_items(customer_id):
-    cart_by_restaurant = split_cart_by_restaurant(customer_id)
+    if get_cart_store() is not None:
+        return [CartLine(food_id, quantity) for food_id, quantity in get_cart(customer_id).items()]
     cart_items = Cart.query.filter_by(customer_id=customer_id).all()
     return cart_items
 
 
 def clear_cart_for_customer(customer_id):
-    cart_items = Cart.query.filter_by(customer_id=customer_id).all()
-    for item in cart_items:
-        db.session.delete(item)
-    db.session.commit()
-    return True, "Cart cleared successfully"
+    return clear_cart_for_all_restaurants(customer_id)
 
 
 def split_cart_by_restaurant(customer_id):
@@ -254,41 +425,29 @@ def split_cart_by_restaurant(customer_id):
     Each value is a list of dictionaries containing 'cart', 'food', and 'restaurant' objects.
     """
     try:
-        print(f"Splitting cart for customer_id: {customer_id}")
-        
-        # First get all cart items for this customer
-        cart_items = Cart.query.filter_by(customer_id=customer_id).all()
-        print(f"Found {len(cart_items)} cart items")
+        if get_cart_store() is not None:
+            return split_stored_cart_by_restaurant(customer_id)
+
+        # cart lines with their dish and restaurant in one query
+        cart_rows = db.session.query(Cart, Food, Restaurant).join(
+            Food, Food.id == Cart.food_id).join(
+            Restaurant, Restaurant.id == Food.restaurant_id).filter(
+            Cart.customer_id == customer_id).order_by(Cart.id).all()
 
-        if not cart_items:
+        if not cart_rows:
             return False, "No items in the cart."
 
         # Group cart items by restaurant
         cart_by_restaurant = defaultdict(list)
-
-        for cart_item in cart_items:
-            # Get the food item
-            food = Food.query.get(cart_item.food_id)
-            if not food:
-                print(f"Food item with id {cart_item.food_id} not found")
-                continue
-                
-            # Get the restaurant
-            restaurant = Restaurant.query.get(food.restaurant_id)
-            if not restaurant:
-                print(f"Restaurant with id {food.restaurant_id} not found")
-                continue
-                
-            print(f"Processing item: {food.name} from {restaurant.name}")
+        for cart_item, food, restaurant in cart_rows:
             cart_by_restaurant[restaurant].append({
                 'cart': cart_item,
                 'food': food,
                 'restaurant': restaurant
             })
 
-        print(f"Grouped into {len(cart_by_restaurant)} restaurants")
         return True, cart_by_restaurant
-        
+
     except Exception as e:
         print(f"Error in split_cart_by_restaurant: {str(e)}")
         import traceback
@@ -296,6 +455,30 @@ def split_cart_by_restaurant(customer_id):
         return False, f"Error loading cart: {str(e)}"
 
 
+def split_stored_cart_by_restaurant(customer_id):
+    """split_cart_by_restaurant for carts kept in the cart store"""
+    cart = get_cart(customer_id)
+    if not cart:
+        return False, "No items in the cart."
+
+    rows = db.session.query(Food, Restaurant).join(
+        Restaurant, Restaurant.id == Food.restaurant_id).filter(Food.id.in_(cart)).all()
+    # lines in the order they were added
+    position = {food_id: index for index, food_id in enumerate(cart)}
+    rows.sort(key=lambda row: position[row[0].id])
+
+    cart_by_restaurant = defaultdict(list)
+    for food, restaurant in rows:
+        cart_by_restaurant[restaurant].append({
+            'cart': CartLine(food.id, cart[food.id]),
+            'food': food,
+            'restaurant': restaurant
+        })
+    if not cart_by_restaurant:
+        return False, "No items in the cart."
+    return True, cart_by_restaurant
+
+
 def clear_cart_for_restaurant(customer_id, restaurant_id):
     """
     Clears the cart for a specific restaurant for a customer.
@@ -303,7 +486,12 @@ def clear_cart_for_restaurant(customer_id, restaurant_id):
     success, cart_by_restaurant = split_cart_by_restaurant(customer_id)
     if not success:
         return False, "No items in the cart."
-    for dic_items in cart_by_restaurant[Restaurant.query.get(restaurant_id)]:
+    restaurant_items = cart_by_restaurant[Restaurant.query.get(restaurant_id)]
+    if get_cart_store() is not None:
+        remove_cart_lines(customer_id, [dic_items['food'].id for dic_items in restaurant_items])
+        return True, "Cart cleared successfully"
+
+    for dic_items in restaurant_items:
 
         cart_item = dic_items['cart']
         db.session.delete(cart_item)
@@ -313,6 +501,10 @@ def clear_cart_for_restaurant(customer_id, restaurant_id):
 
 
 def clear_cart_for_all_restaurants(customer_id):
+    if get_cart_store() is not None:
+        remove_cart_lines(customer_id, list(get_cart(customer_id)))
+        return True, "Cart cleared successfully"
+
     cart = Cart.query.filter_by(customer_id=customer_id).all()
     for item in cart:
         db.session.delete(item)
@@ -325,35 +517,77 @@ def place_order(customer_id):
     """
     Places an order for a customer by transferring cart items to the order table.
     Returns (bool, message) indicating success or failure.
+
+    The cart is read with its dish prices in one query (rows locked where the
+    database supports it), drained with a single delete and turned into one
+    bulk insert of orders and one of order details, all in one transaction.
+    If another submit drained the cart first nothing is written. Carts kept
+    in the cart store are written to the Cart table first. Everything else
+    the new orders change is left to the order event consumers.
     """
-    success, cart_by_restaurants = split_cart_by_restaurant(customer_id)
-    if not success:
+    store = get_cart_store()
+    if store is not None:
+        try:
+            persist_cart(customer_id)
+        except IntegrityError:
+            # a concurrent submit of the same cart wrote its new lines first
+            db.session.rollback()
+            return False, "This order has already been placed."
+
+    cart_lines = db.session.query(
+        Cart.id, Cart.food_id, Cart.quantity, Food.name, Food.price, Food.restaurant_id
+    ).join(Food, Food.id == Cart.food_id).filter(
+        Cart.customer_id == customer_id
+    ).order_by(Food.restaurant_id, Cart.id).with_for_update(of=Cart).all()
+    if not cart_lines:
         return False, "No items in the cart."
-    cart_items = Cart.query.filter_by(customer_id=customer_id).all()
-
-    print(cart_by_restaurants)
 
-    for restaurant, items in cart_by_restaurants.items():
-        rest_price = 0
-        for item in items:
-            rest_price += item['food'].price * item['cart'].quantity
-        order = OrderList(customer_id=customer_id,
-                          restaurant_id=restaurant.id, total_price=rest_price, status='p')
-        db.session.add(order)
-        db.session.flush()  # Ensure order ID is generated before using it
-
-        order_details = [OrderDetail(
-            order_id=order.id, food_id=item['food'].id, quantity=item['cart'].quantity) for item in items]
-
-        db.session.add_all(order_details)
-
-    # Create order details
-
-    # Remove cart items after placing order
-    Cart.query.filter_by(customer_id=customer_id).delete()
+    # claim the cart, a concurrent submit of the same cart deletes fewer rows
+    cart_ids = [line.id for line in cart_lines]
+    drained = db.session.execute(
+        Cart.__table__.delete().where(Cart.id.in_(cart_ids))).rowcount
+    if drained != len(cart_ids):
+        db.session.rollback()
+        return False, "This order has already been placed."
+
+    lines_by_restaurant = defaultdict(list)
+    for line in cart_lines:
+        lines_by_restaurant[line.restaurant_id].append(line)
+
+    order_time = datetime.now()
+    order_rows = [{
+        'customer_id': customer_id,
+        'restaurant_id': restaurant_id,
+        'total_price': sum(line.price * line.quantity for line in lines),
+        'status': 'p',
+        'order_time': order_time,
+    } for restaurant_id, lines in lines_by_restaurant.items()]
+    # one order per restaurant, so the restaurant identifies the new order
+    order_ids = dict(db.session.execute(
+        db.insert(OrderList).returning(OrderList.restaurant_id, OrderList.id), order_rows).all())
+
+    detail_rows = [
+        {'order_id': order_ids[restaurant_id], 'food_id': line.food_id, 'quantity': line.quantity,
+         'unit_price': line.price, 'food_name': line.name}
+        for restaurant_id, lines in lines_by_restaurant.items()
+        for line in lines
+    ]
+    db.session.execute(db.insert(OrderDetail), detail_rows)
 
-    
     db.session.commit()
+    if store is not None:
+        # only what was ordered, lines added meanwhile stay in the cart
+        for line in cart_lines:
+            store.increment(customer_id, line.food_id, -line.quantity)
+    # rollups, live order feed, favourites and notifications, off the request.
+    # A bulk insert skips the ORM hooks that keep the rollups current.
+    publish_order_event(ORDER_PLACED, [
+        {**row, 'id': order_ids[row['restaurant_id']], 'delivery_time': None} for row in order_rows
+    ], [
+        {'restaurant_id': line.restaurant_id, 'food_id': line.food_id, 'order_time': order_time,
+         'quantity': line.quantity, 'unit_price': line.price}
+        for line in cart_lines
+    ])
     return True, "Order placed successfully!"
 
 
@@ -367,7 +601,9 @@ def cancel_order_by_customer(order_id, customer_id):
         return False, "could not find the order"  # Order not found
 
     order.status = 'c'
+    changed = order_values(order)
     db.session.commit()
+    publish_order_event(ORDER_CANCELLED, [changed])
     return True, "cancelled the order succesfully"  # Successfully cancelled
 
 
@@ -375,20 +611,41 @@ def cancel_order_by_customer(order_id, customer_id):
 
 
 def get_order_headers_for_customer(customer_id):
-    pending_orders = OrderList.query.filter_by(
-        customer_id=customer_id, status='p').order_by(desc(OrderList.id)).all()
-    delivered_orders = OrderList.query.filter_by(
-        customer_id=customer_id, status='d').order_by(desc(OrderList.id)).all()
-    cancelled_orders = OrderList.query.filter_by(
-        customer_id=customer_id, status='c').order_by(desc(OrderList.id)).all()
+    orders = OrderList.query.filter_by(
+        customer_id=customer_id).order_by(desc(OrderList.id)).all()
+    pending_orders = [order for order in orders if order.status == 'p']
+    delivered_orders = [order for order in orders if order.status == 'd']
+    cancelled_orders = [order for order in orders if order.status == 'c']
     all_orders = pending_orders + delivered_orders + cancelled_orders
 
     return pending_orders, delivered_orders, cancelled_orders, all_orders
 
 
+def orders_of_restaurants_named(restaurant_name):
+    """OrderList condition: the restaurant's name contains `restaurant_name`, case-insensitive"""
+    return OrderList.restaurant_id.in_(db.select(Restaurant.id).where(
+        func.lower(Restaurant.name).contains(restaurant_name.lower(), autoescape=True)))
+
+
+def get_order_history_page(customer_id, status=None, cursor=None, per_page=ORDERS_PER_PAGE,
+                           restaurant_name=None):
+    """
+    One page of a customer's orders, newest first, optionally only one
+    status and only restaurants whose name contains `restaurant_name`
+    (case-insensitive). Each order comes with its restaurant loaded by the
+    same query. Returns an OrderPage (app/pagination.py).
+    """
+    query = OrderList.query.join(OrderList.restaurant).options(
+        contains_eager(OrderList.restaurant)).filter(OrderList.customer_id == customer_id)
+    if status:
+        query = query.filter(OrderList.status == status)
+    if restaurant_name:
+        query = query.filter(func.lower(Restaurant.name).contains(restaurant_name.lower(), autoescape=True))
+    return paginate_orders(query, cursor, per_page)
+
+
 def get_order_details(order_id):
-    order_details = OrderDetail.query.filter_by(order_id=order_id).all()
-    return order_details
+    return order_lines(order_id)
 
 
 def get_restaurant_details(restaurant_id):
@@ -397,15 +654,14 @@ def get_restaurant_details(restaurant_id):
         return None, None
     location = Address.query.filter(
         Address.user_id == restaurant.user_id).first().location
-    phone = User.query.filter(User.id == restaurant.user_id).first().phone
-    email = User.query.filter(User.id == restaurant.user_id).first().email
+    owner = User.query.get(restaurant.user_id)
 
     restaurant_info = {
         'id': restaurant.id,
         'name': restaurant.name,
         'location': location,
-        'phone': phone,
-        'email': email,
+        'phone': owner.phone,
+        'email': owner.email,
         'opening_time': restaurant.opening_time,
         'closing_time': restaurant.closing_time
     }
@@ -415,6 +671,73 @@ def get_restaurant_details(restaurant_id):
     return restaurant_info, menu
 
 
+DISH_REVIEWS_PER_PAGE = 5
+RECENT_RESTAURANT_REVIEWS = 8
+
+
+def build_menu_view(restaurant_id, customer_id):
+    """
+    Returns the menu items of a restaurant for the customer in a single query.
+    The shared menu projection (app/menu.py) brings cuisine names, recent
+    order counts and the materialized review count/average, cart quantities
+    come from a grouped subquery (or the cart store) and the favourite flag from a correlated
+    EXISTS, so no review rows are loaded; review text is paged in on demand
+    through get_dish_reviews_page.
+    """
+    is_favourite = db.select(FavouriteFood.id).where(
+        FavouriteFood.customer_id == customer_id,
+        FavouriteFood.food_id == Food.id
+    ).exists()
+
+    query = menu_query(restaurant_id).add_columns(is_favourite.label('is_favourite'))
+    if get_cart_store() is not None:
+        cart = get_cart(customer_id)
+    else:
+        cart = None
+        cart_quantities = db.session.query(
+            Cart.food_id, func.sum(Cart.quantity).label('quantity')
+        ).filter(Cart.customer_id == customer_id).group_by(Cart.food_id).subquery()
+        query = query.add_columns(cart_quantities.c.quantity).outerjoin(
+            cart_quantities, cart_quantities.c.food_id == Food.id
+        )
+
+    menu_items = []
+    for row in db.session.execute(query):
+        item = menu_item(row)
+        item['quantity'] = (row.quantity or 0) if cart is None else cart.get(row.id, 0)
+        item['is_favourite'] = bool(row.is_favourite)
+        menu_items.append(item)
+    return menu_items
+
+
+def get_dish_reviews_page(food_id, page=1, per_page=DISH_REVIEWS_PER_PAGE):
+    """
+    Returns one page of reviews for a dish, newest first, and whether another
+    page exists. Fetches one extra row instead of running a COUNT.
+    """
+    page = max(page, 1)
+    reviews = DishReview.query.filter(DishReview.food_id == food_id).order_by(
+        desc(DishReview.review_time), desc(DishReview.id)
+    ).offset((page - 1) * per_page).limit(per_page + 1).all()
+
+    return reviews[:per_page], len(reviews) > per_page
+
+
+def get_restaurant_review_summary(restaurant_id, limit=RECENT_RESTAURANT_REVIEWS):
+    """
+    Returns the average rating, the review count and the most recent reviews
+    of a restaurant. The average comes from the materialized rating columns.
+    """
+    restaurant = db.session.get(Restaurant, int(restaurant_id))
+    if not restaurant:
+        return None, 0, []
+
+    recent_reviews = RestaurantReview.query.filter(
+        RestaurantReview.restaurant_id == restaurant_id
+    ).order_by(desc(RestaurantReview.review_time), desc(RestaurantReview.id)).limit(limit).all()
+
+    return restaurant.average_rating, restaurant.rating_count, recent_reviews
+
 
 def get_location_by_restaurant_id(restaurant_id):
     address = Address.query.join(Restaurant, Address.user_id == Restaurant.user_id) \
@@ -434,32 +757,18 @@ def get_restaurants_by_cuisine(cuisine_name):
     return restaurants
 
 
-def get_order_count_for_customer(restaurant_id):
-    orders_for_customer = OrderList.query.join(OrderDetail, OrderDetail.order_id == OrderList.id).join(
-        Food, OrderDetail.food_id == Food.id).join(
-            Restaurant, Restaurant.id == Food.restaurant_id
-    )
-
-    pending_order_counts = orders_for_customer.filter(
-        OrderList.status == 'p').count()
-    cancelled_order_counts = orders_for_customer.filter(
-        OrderList.status == 'c').count()
-    delivered_order_counts = orders_for_customer.filter(
-        OrderList.status == 'd').count()
-
-    total_order_counts = pending_order_counts + \
-        cancelled_order_counts + delivered_order_counts
-
-    return pending_order_counts, cancelled_order_counts, delivered_order_counts, total_order_counts
+def get_order_count_for_customer(customer_id):
+    """(pending, cancelled, delivered, total) orders of the customer, in one grouped query"""
+    stats = get_order_stats(OrderList.customer_id == customer_id)
+    return stats.pending, stats.cancelled, stats.delivered, stats.total
 
 
 def get_restaurant_open_and_close_time(restaurant_id):
     restaurant = Restaurant.query.get(restaurant_id)
 
     if restaurant:
-        if datetime.now().time() > restaurant.opening_time and datetime.now().time() < restaurant.closing_time:
-            return True, restaurant.opening_time, restaurant.closing_time
-        return False, restaurant.opening_time, restaurant.closing_time
+        is_open = is_open_now(restaurant.opening_time, restaurant.closing_time)
+        return is_open, restaurant.opening_time, restaurant.closing_time
     else:
         return None, None, None
 
@@ -535,6 +844,9 @@ def add_restaurant_to_favourite(restaurant_id, customer_id):
     Adds a restaurant to the customer's favourites.
     """
     print(restaurant_id,Restaurant.query.get(restaurant_id).name)
+    if is_favourite_restaurant(restaurant_id, customer_id):
+        return True, "Restaurant already in favourites"
+
     fav_obj = FavouriteRestaurant(
         customer_id=customer_id, restaurant_id=restaurant_id, mode='m')
     db.session.add(fav_obj)
@@ -656,19 +968,35 @@ def is_favourite_restaurant(restaurant_id, customer_id):
     return fav_obj is not None
 
 
-def automatically_get_favourite_Restaurant(customer_id):
+def automatically_get_favourite_Restaurant(customer_id, restaurant_ids=None, min_orders=2):
     """
-    restaurants from which customer ordered >= 2 times in previous month
+    Restaurants the customer ordered from at least `min_orders` times in the
+    last month, cancelled orders left out, added to the favourites as
+    automatic ones (mode 'a'). Only `restaurant_ids` are checked when given.
+    Run by the order event bus after every checkout (app/order_events.py),
+    possibly by two threads at once for the same customer.
     """
-
-    restaurants = Restaurant.query.join(OrderList, OrderList.restaurant_id == Restaurant.id).join(
-        Customer, Customer.id == OrderList.customer_id).filter(OrderList.order_time + timedelta(days=30)).group_by(
-            Restaurant.id).having(func.count(OrderList.id) >= 2).all()
-
-    for restaurant in restaurants:
-        fav_obj = FavouriteRestaurant(
-            customer_id=customer_id, restaurant_id=restaurant.id, mode='a')
-        db.session.add(fav_obj)
-        db.session.commit()
+    query = Restaurant.query.join(OrderList, OrderList.restaurant_id == Restaurant.id).filter(
+        OrderList.customer_id == customer_id, OrderList.status != 'c',
+        OrderList.order_time >= datetime.now() - timedelta(days=30))
+    if restaurant_ids is not None:
+        query = query.filter(Restaurant.id.in_(restaurant_ids))
+    restaurants = query.group_by(Restaurant.id).having(func.count(OrderList.id) >= min_orders).all()
+
+    for attempt in range(2):
+        for restaurant in restaurants:
+            if is_favourite_restaurant(restaurant.id, customer_id):
+                continue
+            fav_obj = FavouriteRestaurant(
+                customer_id=customer_id, restaurant_id=restaurant.id, mode='a')
+            db.session.add(fav_obj)
+        try:
+            db.session.commit()
+            break
+        except IntegrityError:
+            # a concurrent run added one of them first, the others are added again
+            db.session.rollback()
+            if attempt:
+                raise
 
     return restaurants
@@ -0,0 +1,232 @@
+"""
+In-memory filter index for the restaurant listing.
+
+Restaurant ids are kept as bitsets (Python ints, bit n = restaurant n) per
+location and per cuisine, and restaurants are kept sorted by rating and by
+the price of their most expensive dish for the minimum rating and price
+filters. A filter combination is a handful of ORs and ANDs on those
+bitsets, so the listing and the sidebar facet counts are answered without
+SQL and the database only loads the restaurants that matched.
+
+The index follows committed catalogue writes (app/catalogue.py) and is
+rebuilt every FILTER_INDEX_REFRESH_SECONDS like the autocomplete index.
+Name searches still go through the full-text index (app/search.py).
+"""
+import bisect
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, has_app_context
+from .catalogue import get_catalogue_view, on_catalogue_commit
+from .extensions import db
+from .search import search_matches
+
+# larger results are loaded with the SQL filters instead of a huge IN list
+MAX_HYDRATED_IDS = 5000
+# minimums whose bits are kept per threshold index, least recently used dropped first
+CACHED_MINIMUMS = 16
+
+
+def to_bits(restaurant_ids):
+    bits = 0
+    for restaurant_id in restaurant_ids:
+        bits |= 1 << restaurant_id
+    return bits
+
+
+def bit_ids(bits):
+    """Ascending ids of the set bits"""
+    binary = bin(bits)[:1:-1]
+    return [position for position, bit in enumerate(binary) if bit == '1']
+
+
+def parse_minimum(value):
+    """Float of a minimum filter value, None when missing, invalid or not finite"""
+    if value is None or value == '':
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+class ThresholdIndex:
+    """Restaurants sorted by one value, for 'value >= minimum' filters"""
+
+    def __init__(self):
+        self.values = {}
+        self.order = None  # sorted (value, id), rebuilt after changes
+        self.cache = OrderedDict()  # minimum -> bits, at most CACHED_MINIMUMS
+
+    def set(self, restaurant_id, value):
+        if value is None:
+            self.discard(restaurant_id)
+        elif self.values.get(restaurant_id) != value:
+            self.values[restaurant_id] = value
+            self.order = None
+            self.cache.clear()
+
+    def discard(self, restaurant_id):
+        if self.values.pop(restaurant_id, None) is not None:
+            self.order = None
+            self.cache.clear()
+
+    def at_least(self, minimum):
+        bits = self.cache.get(minimum)
+        if bits is not None:
+            self.cache.move_to_end(minimum)
+            return bits
+        if self.order is None:
+            self.order = sorted((value, restaurant_id) for restaurant_id, value in self.values.items())
+        start = bisect.bisect_left(self.order, (minimum, -1))
+        bits = self.cache[minimum] = to_bits(restaurant_id for _, restaurant_id in self.order[start:])
+        if len(self.cache) > CACHED_MINIMUMS:
+            self.cache.popitem(last=False)
+        return bits
+
+
+class RestaurantFilterIndex:
+    """Bitsets of restaurant ids per filter value"""
+
+    def __init__(self, records=()):
+        self.all = 0
+        self.by_location = {}
+        self.by_cuisine = {}
+        self.memberships = {}  # restaurant id -> (locations, cuisines)
+        self.ratings = ThresholdIndex()
+        self.top_prices = ThresholdIndex()
+        self.lock = threading.RLock()
+        self.built_at = time.monotonic()
+        self.refresh(records)
+
+    def refresh(self, records, removed_ids=()):
+        """Replaces the entries of the given catalogue records"""
+        with self.lock:
+            for restaurant_id in removed_ids:
+                self._remove(restaurant_id)
+            for record in records:
+                self._remove(record['id'])
+                self._add(record)
+
+    def _add(self, record):
+        restaurant_id = record['id']
+        bit = 1 << restaurant_id
+        self.all |= bit
+        locations, cuisines = set(record['locations']), set(record['cuisines'])
+        for location in locations:
+            self.by_location[location] = self.by_location.get(location, 0) | bit
+        for cuisine in cuisines:
+            self.by_cuisine[cuisine] = self.by_cuisine.get(cuisine, 0) | bit
+        self.memberships[restaurant_id] = (locations, cuisines)
+        self.ratings.set(restaurant_id, record['rating'])
+        self.top_prices.set(restaurant_id, record['top_price'])
+
+    def _remove(self, restaurant_id):
+        memberships = self.memberships.pop(restaurant_id, None)
+        if memberships is None:
+            return
+        mask = ~(1 << restaurant_id)
+        self.all &= mask
+        for values, bitsets in zip(memberships, (self.by_location, self.by_cuisine)):
+            for value in values:
+                bitsets[value] &= mask
+                if not bitsets[value]:
+                    del bitsets[value]
+        self.ratings.discard(restaurant_id)
+        self.top_prices.discard(restaurant_id)
+
+    def _any_of(self, bitsets, values):
+        bits = 0
+        for value in values:
+            bits |= bitsets.get(value, 0)
+        return bits
+
+    def matching(self, locations=None, min_rating=None, cuisines=None, min_price=None):
+        """Bits of the restaurants matching all filters, same rules as the SQL filters"""
+        with self.lock:
+            bits = self.all
+            if locations:
+                bits &= self._any_of(self.by_location, locations)
+            if cuisines:
+                bits &= self._any_of(self.by_cuisine, cuisines)
+            min_rating = parse_minimum(min_rating)
+            if min_rating is not None:
+                bits &= self.ratings.at_least(min_rating)
+            min_price = parse_minimum(min_price)
+            if min_price is not None:
+                bits &= self.top_prices.at_least(min_price)
+            return bits
+
+    def facets(self, rating_bounds, price_bounds, locations=None, min_rating=None, cuisines=None,
+               min_price=None, restrict=None):
+        """
+        Same counts as customer.services.get_restaurant_facets, every facet
+        counted without its own filter. `restrict` limits everything to
+        these bits (the name search).
+        """
+        filters = {'locations': locations, 'min_rating': min_rating, 'cuisines': cuisines, 'min_price': min_price}
+
+        def without(facet):
+            bits = self.matching(**{name: value for name, value in filters.items() if name != facet})
+            return bits if restrict is None else bits & restrict
+
+        with self.lock:
+            facets = {}
+            base = without('locations')
+            facets['location'] = {location: count for location, bits in self.by_location.items()
+                                  if (count := (bits & base).bit_count())}
+            base = without('cuisines')
+            facets['cuisine'] = {cuisine: count for cuisine, bits in self.by_cuisine.items()
+                                 if (count := (bits & base).bit_count())}
+            base = without('min_rating')
+            facets['rating'] = {bound: (self.ratings.at_least(bound) & base).bit_count()
+                                for bound in rating_bounds}
+            base = without('min_price')
+            facets['price'] = {bound: (self.top_prices.at_least(bound) & base).bit_count()
+                               for bound in price_bounds}
+            return facets
+
+
+def filter_index_enabled():
+    return current_app.config.get('FILTER_INDEX', True)
+
+
+def get_filter_index():
+    """The index of the current app, (re)built when missing or expired"""
+    return get_catalogue_view('filter_index', RestaurantFilterIndex,
+                              current_app.config.get('FILTER_INDEX_REFRESH_SECONDS'))
+
+
+def match_restaurant_ids(locations=None, min_rating=None, cuisines=None, min_price=None):
+    """
+    Ascending ids of the restaurants matching the filters, None when no
+    filter is set or when there are too many to load by id.
+    """
+    if not (locations or cuisines or parse_minimum(min_rating) is not None
+            or parse_minimum(min_price) is not None):
+        return None
+    bits = get_filter_index().matching(locations, min_rating, cuisines, min_price)
+    if bits.bit_count() > MAX_HYDRATED_IDS:
+        return None
+    return bit_ids(bits)
+
+
+def get_indexed_facets(rating_bounds, price_bounds, locations=None, min_rating=None, cuisines=None,
+                       name_filter=None, min_price=None):
+    restrict = None
+    if name_filter and name_filter.strip():
+        # all the matches, the filters are applied on the index
+        restrict = to_bits(db.session.execute(db.select(search_matches(name_filter).c.restaurant_id)).scalars())
+    return get_filter_index().facets(rating_bounds, price_bounds, locations, min_rating, cuisines,
+                                     min_price, restrict)
+
+
+@on_catalogue_commit
+def refresh_filter_index(records, removed_ids):
+    if not has_app_context():
+        return
+    index = current_app.extensions.get('filter_index')
+    if index is not None:
+        index.refresh(records, removed_ids)
@@ -0,0 +1,188 @@
+"""
+Identity of the logged in user for the current request.
+
+The role, the customer id and the owned restaurant ids of current_user are
+looked up once per request and kept in flask.g, so the access decorators
+and the routes asking for "my customer id" or "my restaurant" do not query
+them again.
+
+With IDENTITY_SESSION_MAX_AGE set, the identity is also kept in the signed
+session cookie for that many seconds. Requests within that time only read
+the user's role by primary key, not the identity or the User row:
+current_user is a SessionUser that only loads the row when something other
+than its id or role is read. A deleted user is logged out and a changed
+role reloads the identity at their next request, whoever made the change.
+Commits that add or remove the user's customer or restaurant rows drop the
+cached identity of that user's own session; changes made by other sessions
+(an admin moving a restaurant) are seen within IDENTITY_SESSION_MAX_AGE.
+"""
+import time
+from flask import current_app, g, has_request_context, session
+from flask_login import UserMixin, current_user, user_logged_in, user_logged_out
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+from .extensions import db, login_manager
+from .models import Customer, Restaurant, User
+
+SESSION_KEY = 'identity'
+
+
+class Identity:
+    """Who the user is: role code, customer id and owned restaurant ids"""
+
+    def __init__(self, user_id, role, customer_id=None, restaurant_ids=()):
+        self.user_id = user_id
+        self.role = role
+        self.customer_id = customer_id
+        self.restaurant_ids = tuple(restaurant_ids)
+
+    @property
+    def is_admin(self):
+        return self.role == '0'
+
+    @property
+    def is_customer(self):
+        return self.role == '1'
+
+    @property
+    def is_restaurant(self):
+        return self.role == '2'
+
+    @property
+    def restaurant_id(self):
+        """The first restaurant of an owner, None for other users"""
+        return self.restaurant_ids[0] if self.restaurant_ids else None
+
+    def to_session(self):
+        return {'user_id': self.user_id, 'role': self.role, 'customer_id': self.customer_id,
+                'restaurant_ids': list(self.restaurant_ids), 'loaded_at': time.time()}
+
+    @classmethod
+    def from_session(cls, data):
+        return cls(data['user_id'], data['role'], data['customer_id'], data['restaurant_ids'])
+
+
+class SessionUser(UserMixin):
+    """current_user built from the session identity, loads the User row on demand"""
+
+    def __init__(self, identity):
+        self.id = identity.user_id
+        self.code = identity.role
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        user = self.__dict__.get('_user')
+        if user is None:
+            user = self.__dict__['_user'] = db.session.get(User, self.id)
+        return getattr(user, name)
+
+
+def load_identity(user_id):
+    """Identity of a user in one query, None when the user does not exist"""
+    rows = db.session.execute(select(User.code, Customer.id, Restaurant.id).outerjoin(
+        Customer, Customer.user_id == User.id
+    ).outerjoin(
+        Restaurant, Restaurant.user_id == User.id
+    ).where(User.id == user_id).order_by(Customer.id, Restaurant.id)).all()
+    if not rows:
+        return None
+    customer_ids = [customer_id for _, customer_id, _ in rows if customer_id is not None]
+    restaurant_ids = sorted({restaurant_id for _, _, restaurant_id in rows if restaurant_id is not None})
+    return Identity(user_id, rows[0].code, customer_ids[0] if customer_ids else None, restaurant_ids)
+
+
+def _session_identity(user_id):
+    """
+    The identity cached in the session cookie, None when missing, stale or
+    someone else's, or when the user was deleted or changed role since
+    """
+    max_age = current_app.config.get('IDENTITY_SESSION_MAX_AGE')
+    data = session.get(SESSION_KEY)
+    if not max_age or not data or data.get('user_id') != user_id:
+        return None
+    if time.time() - data.get('loaded_at', 0) > max_age:
+        return None
+    identity = Identity.from_session(data)
+    if db.session.scalar(select(User.code).where(User.id == user_id)) != identity.role:
+        session.pop(SESSION_KEY, None)
+        return None
+    return identity
+
+
+def _remember(identity):
+    g.identity = identity
+    if identity is not None and current_app.config.get('IDENTITY_SESSION_MAX_AGE'):
+        session[SESSION_KEY] = identity.to_session()
+
+
+@login_manager.user_loader
+def load_user(user_id):
+    identity = _session_identity(int(user_id))
+    if identity is not None:
+        g.identity = identity
+        return SessionUser(identity)
+    return db.session.get(User, int(user_id))
+
+
+def get_identity():
+    """Identity of current_user, loaded once per request. None when logged out."""
+    if 'identity' not in g:
+        if current_user.is_authenticated:
+            _remember(load_identity(int(current_user.id)))
+        else:
+            g.identity = None
+    return g.identity
+
+
+def current_identity_for(user_id):
+    """The request's identity when it belongs to `user_id`, else None"""
+    if not has_request_context():
+        return None
+    identity = get_identity()
+    if identity is not None and str(identity.user_id) == str(user_id):
+        return identity
+    return None
+
+
+def forget_identity(*args, **kwargs):
+    g.pop('identity', None)
+    session.pop(SESSION_KEY, None)
+
+
+user_logged_in.connect(forget_identity)
+user_logged_out.connect(forget_identity)
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_identity_changes(session_, flush_context):
+    user_ids = set()
+    for obj in session_.new | session_.dirty | session_.deleted:
+        if isinstance(obj, (Customer, Restaurant)):
+            history = inspect(obj).attrs.user_id.history
+            if obj in session_.new or obj in session_.deleted or history.has_changes():
+                # the owner before and after the change
+                user_ids.update(history.added or history.unchanged or ())
+                user_ids.update(history.deleted or ())
+        elif isinstance(obj, User) and inspect(obj).attrs.code.history.has_changes():
+            user_ids.add(obj.id)
+    user_ids.discard(None)
+    if user_ids:
+        session_.info.setdefault('identity_stale', set()).update(user_ids)
+
+
+@event.listens_for(Session, 'after_commit')
+def drop_stale_identity(session_):
+    user_ids = session_.info.pop('identity_stale', None)
+    if not user_ids or not has_request_context():
+        return
+    cached = session.get(SESSION_KEY)
+    identity = g.get('identity')
+    if (cached and cached.get('user_id') in user_ids) or (identity and identity.user_id in user_ids):
+        forget_identity()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_identity_changes(session_, previous_transaction):
+    if not previous_transaction.nested:
+        session_.info.pop('identity_stale', None)
@@ -0,0 +1,142 @@
+"""
+Per-request SQL instrumentation.
+
+Engine events time every statement and add it to the stats of the current
+request (kept on flask.g). When the request finishes the totals are either
+sent back as X-SQL-* response headers (debug mode, or SQL_STATS_HEADERS)
+or written as one JSON log line (SQL_REQUEST_LOG). Statements slower than
+SLOW_QUERY_THRESHOLD_MS are logged, with their bound parameters only in
+debug mode or with SQL_LOG_PARAMETERS: they hold emails, phone numbers and
+password hashes.
+"""
+import heapq
+import json
+import logging
+import re
+import time
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from .extensions import db
+
+logger = logging.getLogger(__name__)
+
+STATEMENT_LOG_LENGTH = 500
+STATEMENT_HEADER_LENGTH = 200
+
+
+class RequestSqlStats:
+    """SQL totals of a single request"""
+
+    def __init__(self, keep_slowest, slow_threshold, log_parameters=False):
+        self.keep_slowest = keep_slowest
+        self.slow_threshold = slow_threshold
+        self.log_parameters = log_parameters
+        self.started = time.perf_counter()
+        self.query_count = 0
+        self.db_time = 0.0
+        self.slowest = []  # min-heap of (duration_ms, sequence, statement)
+
+    def record(self, statement, duration_ms):
+        self.query_count += 1
+        self.db_time += duration_ms
+        entry = (duration_ms, self.query_count, statement)
+        if len(self.slowest) < self.keep_slowest:
+            heapq.heappush(self.slowest, entry)
+        elif self.slowest and duration_ms > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def slowest_statements(self):
+        return [(duration_ms, statement) for duration_ms, _, statement in sorted(self.slowest, reverse=True)]
+
+
+def compact(statement, length):
+    """Single line version of a statement, safe for headers and log lines"""
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    return statement if len(statement) <= length else statement[:length - 3] + '...'
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        return
+    duration_ms = (time.perf_counter() - starts.pop()) * 1000
+
+    if not has_request_context():
+        return
+    stats = g.get('sql_stats')
+    if stats is not None:
+        stats.record(statement, duration_ms)
+        if stats.slow_threshold is not None and duration_ms >= stats.slow_threshold:
+            if stats.log_parameters:
+                logger.warning('Slow query (%.1f ms) on %s %s: %s | params=%s',
+                               duration_ms, request.method, request.path,
+                               compact(statement, STATEMENT_LOG_LENGTH),
+                               compact(repr(parameters), STATEMENT_LOG_LENGTH))
+            else:
+                logger.warning('Slow query (%.1f ms) on %s %s: %s', duration_ms, request.method,
+                               request.path, compact(statement, STATEMENT_LOG_LENGTH))
+
+
+def handle_error(exception_context):
+    # after_cursor_execute does not run for failed statements
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('query_start'):
+        conn.info['query_start'].pop()
+
+
+def start_request_stats():
+    log_parameters = current_app.config.get('SQL_LOG_PARAMETERS')
+    if log_parameters is None:
+        log_parameters = current_app.debug
+    g.sql_stats = RequestSqlStats(current_app.config.get('SQL_SLOWEST_STATEMENTS', 3),
+                                  current_app.config.get('SLOW_QUERY_THRESHOLD_MS'), log_parameters)
+
+
+def finish_request_stats(response):
+    stats = g.pop('sql_stats', None)
+    if stats is None:
+        return response
+
+    request_ms = (time.perf_counter() - stats.started) * 1000
+    slowest = stats.slowest_statements()
+    show_headers = current_app.config.get('SQL_STATS_HEADERS')
+    if show_headers is None:
+        show_headers = current_app.debug
+
+    if show_headers:
+        response.headers['X-SQL-Query-Count'] = str(stats.query_count)
+        response.headers['X-SQL-Time-Ms'] = f'{stats.db_time:.2f}'
+        for position, (duration_ms, statement) in enumerate(slowest, start=1):
+            response.headers[f'X-SQL-Slowest-{position}'] = (
+                f'{duration_ms:.2f}ms {compact(statement, STATEMENT_HEADER_LENGTH)}')
+    elif current_app.config.get('SQL_REQUEST_LOG', True):
+        logger.info(json.dumps({
+            'event': 'request_sql',
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'queries': stats.query_count,
+            'db_ms': round(stats.db_time, 2),
+            'request_ms': round(request_ms, 2),
+            'slowest': [{'ms': round(duration_ms, 2), 'sql': compact(statement, STATEMENT_HEADER_LENGTH)}
+                        for duration_ms, statement in slowest],
+        }))
+    return response
+
+
+def init_sql_instrumentation(app):
+    """Hooks the engine of `app` and the request cycle, needs an app context"""
+    if not app.config.get('SQL_INSTRUMENTATION', True):
+        return
+    engine = db.engine
+    if not event.contains(engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(engine, 'handle_error', handle_error)
+    app.before_request(start_request_stats)
+    app.after_request(finish_request_stats)
@@ -0,0 +1,52 @@
+"""
+Menu projection shared by the restaurant and customer menu pages.
+
+One query returns every dish of a restaurant with its cuisine name, the
+number of orders it had in the last MOSTLY_ORDERED_WINDOW (read from the
+hourly sales rollup of app/sales.py) and its review aggregates (the
+materialized rating columns), so rendering a menu costs the same whether
+it has 5 dishes or 300. Pages that need more per dish, like
+the customer's cart quantities, add their columns to menu_query().
+"""
+from datetime import datetime
+from sqlalchemy import func, select
+from .extensions import db
+from .models import Cuisine, Food
+from .sales import MOSTLY_ORDERED_MIN_ORDERS, MOSTLY_ORDERED_WINDOW, recent_order_counts
+
+
+def menu_query(restaurant_id, now=None):
+    """Select of the menu rows of a restaurant, ordered by category"""
+    since = (now or datetime.now()) - MOSTLY_ORDERED_WINDOW
+    order_counts = recent_order_counts(restaurant_id, since)
+    return select(
+        Food.id, Food.name, Food.price, Food.category, Food.cuisine_id, Food.is_special,
+        Food.is_deal_of_day, Food.rating_sum, Food.rating_count,
+        Cuisine.name.label('cuisine'),
+        func.coalesce(order_counts.c.order_count, 0).label('recent_orders'),
+    ).outerjoin(Cuisine, Cuisine.id == Food.cuisine_id).outerjoin(
+        order_counts, order_counts.c.food_id == Food.id
+    ).where(Food.restaurant_id == restaurant_id).order_by(Food.category, Food.id)
+
+
+def menu_item(row):
+    """Template dict of one menu_query() row"""
+    return {
+        'id': row.id,
+        'name': row.name,
+        'price': row.price,
+        'category': row.category,
+        'cuisine_id': row.cuisine_id,
+        'cuisine': row.cuisine,
+        'is_special': row.is_special,
+        'is_deal_of_day': row.is_deal_of_day,
+        'recent_orders': row.recent_orders,
+        'is_mostly_ordered': row.recent_orders >= MOSTLY_ORDERED_MIN_ORDERS,
+        'review_count': row.rating_count,
+        'avg_dish_rating': round(row.rating_sum / row.rating_count, 1) if row.rating_count else None,
+    }
+
+
+def get_menu(restaurant_id, now=None):
+    """The menu items of a restaurant, in one query"""
+    return [menu_item(row) for row in db.session.execute(menu_query(restaurant_id, now))]
@@ -1,10 +1,9 @@
 from flask_sqlalchemy import SQLAlchemy
 from . import db
-from sqlalchemy import event
+from sqlalchemy import DDL, event, func
 from datetime import datetime, timedelta
 from sqlalchemy.orm import validates
 from flask_login import UserMixin
-from . import login_manager
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
@@ -25,11 +24,6 @@ class User(db.Model, UserMixin):
         return check_password_hash(self.password, password)
 
 
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
-
-
 class Customer(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
@@ -40,20 +34,32 @@ class Customer(db.Model):
 class Restaurant(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # owner
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)  # owner
     name = db.Column(db.String(80), nullable=False, index=True)
     description = db.Column(db.String(255))  # Optional description
     image_url = db.Column(db.String(
         255), default='https://ts2.mm.bing.net/th?id=OIP.flfRXchgvSimFVzipmTJXQAAAA&pid=15.1')
     opening_time = db.Column(db.Time, nullable=False)
     closing_time = db.Column(db.Time, nullable=False)
-    rating = db.Column(db.Float)
+    rating = db.Column(db.Float, index=True)
+    # review totals, kept current by the RestaurantReview insert hook
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     # Relationship for easy access
     foods = db.relationship('Food', backref='restaurant', lazy=True)
     orders = db.relationship('OrderList', backref='restaurant', lazy=True)
 
+    @property
+    def average_rating(self):
+        """Average of the customer reviews, None when there are no reviews"""
+        return round(self.rating_sum / self.rating_count, 1) if self.rating_count else None
+
 
 class Address(db.Model):
+    __table_args__ = (
+        # restaurant locations: listing, location filter and facet counts
+        db.Index('ix_address_user_location', 'user_id', 'location'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -62,6 +68,12 @@ class Address(db.Model):
     location = db.Column(db.String(80), nullable=False, index=True)
 
 class Food(db.Model):
+    __table_args__ = (
+        # menus, price filter and the top price per restaurant of the price facet
+        db.Index('ix_food_restaurant_price', 'restaurant_id', 'price'),
+        # cuisine filter and facet counts
+        db.Index('ix_food_cuisine_restaurant', 'cuisine_id', 'restaurant_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     restaurant_id = db.Column(db.Integer, db.ForeignKey(
@@ -74,6 +86,14 @@ class Food(db.Model):
     category = db.Column(db.String(80), nullable=False, default='All Dishes')
     is_special = db.Column(db.Boolean, default=False)  # Today's special
     is_deal_of_day = db.Column(db.Boolean, default=False)  # Deal of the day
+    # review totals, kept current by the DishReview insert hook
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    @property
+    def average_rating(self):
+        """Average of the dish reviews, None when there are no reviews"""
+        return round(self.rating_sum / self.rating_count, 1) if self.rating_count else None
 
 
 class Cuisine(db.Model):
@@ -82,27 +102,81 @@ class Cuisine(db.Model):
 
 
 class OrderList(db.Model):
+    __table_args__ = (
+        # customer order history, newest first (app/pagination.py), and its status tabs
+        db.Index('ix_order_list_customer_time', 'customer_id', 'order_time', 'id'),
+        db.Index('ix_order_list_customer_status', 'customer_id', 'status', 'order_time', 'id'),
+        # restaurant order lists, status tabs and time windowed dashboards; the
+        # trailing columns cover the window reads of app/analytics.py
+        db.Index('ix_order_list_restaurant_time', 'restaurant_id', 'order_time', 'id',
+                 'status', 'total_price', 'delivery_time'),
+        db.Index('ix_order_list_restaurant_status_time', 'restaurant_id', 'status', 'order_time', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, db.ForeignKey(
         'customer.id'), nullable=False)
-    restaurant_id = db.Column(db.Integer, db.ForeignKey(
-        'restaurant.id'), nullable=False)
-    total_price = db.Column(db.Float, nullable=False)
+    # active history: the order stats hooks (app/order_stats.py) need the
+    # values an order had before an update, even when it was expired
+    restaurant_id = db.column_property(db.Column(db.Integer, db.ForeignKey(
+        'restaurant.id'), nullable=False), active_history=True)
+    total_price = db.column_property(db.Column(db.Float, nullable=False), active_history=True)
     # d-delivered, p-pending, c-cancelled
-    status = db.Column(db.String(1), nullable=False)
+    status = db.column_property(db.Column(db.String(1), nullable=False), active_history=True)
     order_time = db.Column(db.DateTime, nullable=False, default=datetime.now)
     delivery_time = db.Column(db.DateTime)
 
 
 class OrderDetail(db.Model):
+    __table_args__ = (
+        # lines of an order, and the dishes of a restaurant's orders in a window
+        # (app/analytics.py), without reading the table rows
+        db.Index('ix_order_detail_order_food', 'order_id', 'food_id', 'quantity', 'unit_price'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey(
         'order_list.id'), nullable=False)
     food_id = db.Column(db.Integer, db.ForeignKey('food.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
+    # dish as it was sold, menu changes do not alter past orders
+    unit_price = db.Column(db.Float)
+    food_name = db.Column(db.String(80))
+
+
+class RestaurantOrderStats(db.Model):
+    """Orders and their value per restaurant and status, see app/order_stats.py"""
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurant.id'), primary_key=True)
+    status = db.Column(db.String(1), primary_key=True)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+
+
+class FoodSalesHourly(db.Model):
+    """Order lines of a dish per hour, see app/sales.py"""
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurant.id'), primary_key=True)
+    hour = db.Column(db.DateTime, primary_key=True)
+    food_id = db.Column(db.Integer, db.ForeignKey('food.id'), primary_key=True)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+
+
+class RestaurantSalesDaily(db.Model):
+    """Orders of a restaurant per day of order and status, see app/sales.py"""
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurant.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    status = db.Column(db.String(1), primary_key=True)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
 
 
 class Cart(db.Model):
+    __table_args__ = (
+        # one cart line per dish, quantity is incremented instead
+        db.Index('uq_cart_customer_food', 'customer_id', 'food_id', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, db.ForeignKey(
         'customer.id'), nullable=False)
@@ -113,6 +187,11 @@ class Cart(db.Model):
 
 # PREFERENCES
 class FavouriteRestaurant(db.Model):
+    __table_args__ = (
+        db.Index('uq_favourite_restaurant_customer_restaurant',
+                 'customer_id', 'restaurant_id', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'))
     restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurant.id'))
@@ -131,7 +210,7 @@ class FavouriteFood(db.Model):
 class DishReview(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
-    food_id = db.Column(db.Integer, db.ForeignKey('food.id'), nullable=False)
+    food_id = db.Column(db.Integer, db.ForeignKey('food.id'), nullable=False, index=True)
     order_id = db.Column(db.Integer, db.ForeignKey('order_list.id'), nullable=False)
     rating = db.Column(db.Integer, nullable=False)
     review = db.Column(db.String(255))
@@ -147,3 +226,48 @@ class RestaurantReview(db.Model):
     review = db.Column(db.String(255))
     review_time = db.Column(db.DateTime, nullable=False, default=datetime.now)
 
+
+# RESTAURANT NAME SEARCH
+# Order history is searched with lower(name) LIKE '%term%'. Postgres serves that
+# from a trigram index, other databases scan the (small) restaurant table once.
+db.Index('ix_restaurant_name_trgm', func.lower(Restaurant.name).label('name_lower'),
+         postgresql_using='gin', postgresql_ops={'name_lower': 'gin_trgm_ops'},
+         info={'dialects': ('postgresql',), 'extension': 'pg_trgm'}).ddl_if(dialect='postgresql')
+event.listen(Restaurant.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
+
+# ORDER LINES
+# Lines keep the dish name and price they were sold at. Lines written without
+# them (outside the ORM, or before the columns existed and were backfilled)
+# show the current dish instead.
+def order_lines(order_id):
+    """food_id, quantity, food_name and unit_price of the lines of an order"""
+    return db.session.query(
+        OrderDetail.food_id, OrderDetail.quantity,
+        func.coalesce(OrderDetail.food_name, Food.name).label('food_name'),
+        func.coalesce(OrderDetail.unit_price, Food.price).label('unit_price')
+    ).outerjoin(Food, Food.id == OrderDetail.food_id).filter(
+        OrderDetail.order_id == order_id).order_by(OrderDetail.id).all()
+
+
+# RATING AGGREGATES
+# Reviews are only ever inserted, so the totals are updated in the same
+# transaction as the insert. Rows written outside the ORM are picked up by
+# the `flask backfill-ratings` command.
+@event.listens_for(DishReview, 'after_insert')
+def add_dish_review_to_rating(mapper, connection, review):
+    food = Food.__table__
+    connection.execute(food.update().where(food.c.id == review.food_id).values(
+        rating_sum=food.c.rating_sum + review.rating,
+        rating_count=food.c.rating_count + 1))
+
+
+@event.listens_for(RestaurantReview, 'after_insert')
+def add_restaurant_review_to_rating(mapper, connection, review):
+    restaurant = Restaurant.__table__
+    connection.execute(restaurant.update().where(restaurant.c.id == review.restaurant_id).values(
+        rating_sum=restaurant.c.rating_sum + review.rating,
+        rating_count=restaurant.c.rating_count + 1,
+        rating=(restaurant.c.rating_sum + review.rating) * 1.0 / (restaurant.c.rating_count + 1)))
+
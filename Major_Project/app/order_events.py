@@ -0,0 +1,213 @@
+"""
+Order lifecycle events and the consumers they are dispatched to.
+
+Checkout, mark-as-delivered and customer cancellation publish one
+OrderEvent once their transaction is committed, and leave the side effects
+to the consumers of the bus:
+- the sales and order stats increments of the new orders (the rollups of
+  app/sales.py and app/order_stats.py; status changes made through the ORM
+  still update them in their own transaction),
+- the live order feed of the owners (app/order_feed.py),
+- the automatic favourites of the customer,
+- the notification sinks of ORDER_NOTIFICATION_SINKS, dotted paths of
+  functions taking the event.
+
+Every consumer has its own bounded queue and worker thread, so a slow one
+(a mail sender) never holds back the others. When a queue is full the
+publisher waits up to ORDER_EVENT_BLOCK_SECONDS, then runs the consumer
+itself: a backlog slows checkout down instead of growing without limit or
+dropping events. That run overtakes the queued events and may overlap with
+the worker's, so consumers must not depend on the order of events and must
+be safe to run concurrently (the rollup increments commute, favourites
+tolerate a concurrent insert). Each consumer runs in its own app context
+and transaction, a failing one is logged. Events still queued when the process dies are lost, the rollups are
+then fixed by `flask rebuild-order-stats` and `flask rebuild-sales-rollups`.
+
+With ORDER_EVENTS_SYNCHRONOUS (tests) consumers run in the publishing
+request, right after its commit.
+"""
+import atexit
+import logging
+import queue
+import threading
+from collections import namedtuple
+from flask import current_app
+from werkzeug.utils import import_string
+from .extensions import db
+from .order_feed import order_event_data, publish_orders
+from .order_stats import add_orders_to_stats
+from .sales import add_orders_to_sales
+
+logger = logging.getLogger(__name__)
+notification_logger = logging.getLogger('app.notifications')
+
+ORDER_PLACED, ORDER_DELIVERED, ORDER_CANCELLED = 'placed', 'delivered', 'cancelled'
+
+# `orders`: dicts of order columns (order_values), `lines`: dicts of restaurant_id,
+# food_id, order_time, quantity and unit_price of the order lines, for placed orders
+OrderEvent = namedtuple('OrderEvent', 'type orders lines')
+
+
+class Consumer:
+    """One consumer of the bus, with its queue and worker thread"""
+
+    def __init__(self, name, handle, types, queue_size):
+        self.name = name
+        self.handle = handle
+        self.types = types
+        self.events = queue.Queue(maxsize=queue_size)
+        self.thread = None
+
+
+class OrderEventBus:
+    """Dispatches order events to consumers on background threads"""
+
+    def __init__(self, app, queue_size=1000, block_seconds=0.5, synchronous=False):
+        self.app = app
+        self.queue_size = queue_size
+        self.block_seconds = block_seconds
+        self.synchronous = synchronous
+        self.consumers = []
+        # events run by the publisher because a queue was full
+        self.overflows = 0
+        self.lock = threading.Lock()
+
+    def register(self, handle, types=None, name=None):
+        """Sends the events of `types` (all when None) to `handle(event)`"""
+        self.consumers.append(Consumer(name or getattr(handle, '__name__', repr(handle)), handle,
+                                       frozenset(types) if types else None, self.queue_size))
+
+    def publish(self, event):
+        for consumer in self.consumers:
+            if consumer.types is not None and event.type not in consumer.types:
+                continue
+            if self.synchronous:
+                self._run(consumer, event)
+                continue
+            self._start(consumer)
+            try:
+                consumer.events.put(event, timeout=self.block_seconds)
+            except queue.Full:
+                with self.lock:
+                    self.overflows += 1
+                logger.warning('Order event queue of %s is full, running it in the request', consumer.name)
+                self._run(consumer, event)
+
+    def _start(self, consumer):
+        # started on first use, so processes forked after create_app get their own threads
+        if consumer.thread is None or not consumer.thread.is_alive():
+            with self.lock:
+                if consumer.thread is None or not consumer.thread.is_alive():
+                    consumer.thread = threading.Thread(target=self._work, args=(consumer,),
+                                                       name=f'order-events-{consumer.name}', daemon=True)
+                    consumer.thread.start()
+
+    def _work(self, consumer):
+        while True:
+            event = consumer.events.get()
+            try:
+                if event is None:
+                    return
+                self._run(consumer, event)
+            finally:
+                consumer.events.task_done()
+
+    def _run(self, consumer, event):
+        with self.app.app_context():
+            try:
+                consumer.handle(event)
+            except Exception:
+                db.session.rollback()
+                logger.exception('Order event consumer %s failed on a %s event', consumer.name, event.type)
+
+    def join(self):
+        """Waits until the queued events were handled"""
+        for consumer in self.consumers:
+            if consumer.thread is not None:
+                consumer.events.join()
+
+    def close(self, timeout=5):
+        """
+        Handles the queued events and stops the worker threads, giving up on
+        a consumer after `timeout` seconds so a stuck one cannot hang shutdown
+        """
+        for consumer in self.consumers:
+            if consumer.thread is not None and consumer.thread.is_alive():
+                try:
+                    consumer.events.put(None, timeout=timeout)
+                except queue.Full:
+                    logger.warning('Order event consumer %s is stuck, %d events dropped',
+                                   consumer.name, consumer.events.qsize())
+                    continue
+                consumer.thread.join(timeout)
+
+
+def order_values(order):
+    """Event data of an OrderList row, read it before a commit expires it"""
+    return {
+        'id': order.id,
+        'restaurant_id': order.restaurant_id,
+        'customer_id': order.customer_id,
+        'status': order.status,
+        'total_price': order.total_price,
+        'order_time': order.order_time,
+        'delivery_time': order.delivery_time,
+    }
+
+
+def update_rollups(event):
+    """Sales and order stats increments of the orders bulk inserted at checkout"""
+    connection = db.session.connection()
+    add_orders_to_stats(connection, event.orders)
+    add_orders_to_sales(connection, event.orders, event.lines)
+    db.session.commit()
+
+
+def update_order_feed(event):
+    publish_orders('placed' if event.type == ORDER_PLACED else 'status', [
+        order_event_data(order['id'], order['restaurant_id'], order['customer_id'], order['status'],
+                         order['total_price'], order['order_time'], order['delivery_time'])
+        for order in event.orders
+    ])
+
+
+def update_automatic_favourites(event):
+    # the customer services import this module
+    from .customer.services import automatically_get_favourite_Restaurant
+    restaurant_ids = {}
+    for order in event.orders:
+        restaurant_ids.setdefault(order['customer_id'], set()).add(order['restaurant_id'])
+    for customer_id, ids in restaurant_ids.items():
+        automatically_get_favourite_Restaurant(customer_id, ids, current_app.config['AUTO_FAVOURITE_MIN_ORDERS'])
+
+
+def log_notification(event):
+    """Notification sink writing one log line per order, a stand-in for mail or push"""
+    for order in event.orders:
+        notification_logger.info('order %s %s: restaurant %s, customer %s, total %s', order['id'], event.type,
+                                 order['restaurant_id'], order['customer_id'], order['total_price'])
+
+
+def init_order_events(app):
+    bus = OrderEventBus(app, app.config.get('ORDER_EVENT_QUEUE_SIZE', 1000),
+                        app.config.get('ORDER_EVENT_BLOCK_SECONDS', 0.5),
+                        app.config.get('ORDER_EVENTS_SYNCHRONOUS', False))
+    bus.register(update_rollups, [ORDER_PLACED])
+    bus.register(update_order_feed)
+    if app.config.get('AUTO_FAVOURITE_MIN_ORDERS'):
+        bus.register(update_automatic_favourites, [ORDER_PLACED])
+    for path in app.config.get('ORDER_NOTIFICATION_SINKS') or ():
+        bus.register(import_string(path), name=path)
+    app.extensions['order_events'] = bus
+    if not bus.synchronous:
+        atexit.register(bus.close)
+
+
+def get_order_events():
+    return current_app.extensions['order_events']
+
+
+def publish_order_event(event_type, orders, lines=()):
+    """Publishes an event of committed orders, call it after the commit"""
+    if orders:
+        get_order_events().publish(OrderEvent(event_type, list(orders), list(lines)))
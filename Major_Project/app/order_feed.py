@@ -0,0 +1,150 @@
+"""
+Live order feed for restaurant owners.
+
+Checkout, delivery and cancellation publish the orders they changed to an
+in-process pub/sub once their transaction is committed, through the order
+event bus (app/order_events.py). The owners' order pages hold a
+server-sent events stream (restaurant.order_stream) that receives the
+events of their restaurants, instead of reloading the whole order list to
+find new orders.
+
+Every event gets a sequence number, and the last ORDER_FEED_REPLAY events
+are kept, so a browser that reconnects with Last-Event-ID gets what it
+missed. Streams end after ORDER_FEED_STREAM_SECONDS to free the worker,
+EventSource reconnects by itself. The pub/sub lives in one process: with
+several workers an owner only sees the orders handled by the worker of
+their stream.
+"""
+import itertools
+import json
+import queue
+import threading
+from collections import deque
+from flask import current_app
+
+
+class Subscription:
+    """Events of some restaurants, queued for one stream"""
+
+    def __init__(self, feed, restaurant_ids, size):
+        self.feed = feed
+        self.restaurant_ids = frozenset(restaurant_ids)
+        self.events = queue.Queue(maxsize=size)
+        # set when events were dropped because the stream did not keep up
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """The next event, None when none came within `timeout` seconds"""
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.feed.unsubscribe(self)
+
+
+class OrderFeed:
+    """In-process pub/sub of order events, with a replay buffer"""
+
+    def __init__(self, queue_size=100, replay=1000):
+        self.queue_size = queue_size
+        self.recent = deque(maxlen=replay)
+        self.subscriptions = set()
+        self.sequence = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def subscribe(self, restaurant_ids, after=None):
+        """
+        Subscription to the events of `restaurant_ids`, starting with the kept
+        events numbered above `after` when it is given.
+        """
+        subscription = Subscription(self, restaurant_ids, self.queue_size)
+        with self.lock:
+            if after is not None:
+                for event in self.recent:
+                    if event['id'] > after and event['order']['restaurant_id'] in subscription.restaurant_ids:
+                        subscription.put(event)
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, event_type, orders):
+        """Numbers and sends one event per order dict, returns the events"""
+        events = []
+        with self.lock:
+            for order in orders:
+                event = {'id': next(self.sequence), 'type': event_type, 'order': order}
+                self.recent.append(event)
+                for subscription in self.subscriptions:
+                    if order['restaurant_id'] in subscription.restaurant_ids:
+                        subscription.put(event)
+                events.append(event)
+        return events
+
+
+def init_order_feed(app):
+    app.extensions['order_feed'] = OrderFeed(app.config.get('ORDER_FEED_QUEUE_SIZE', 100),
+                                             app.config.get('ORDER_FEED_REPLAY', 1000))
+
+
+def get_order_feed():
+    return current_app.extensions['order_feed']
+
+
+def order_event_data(order_id, restaurant_id, customer_id, status, total_price, order_time,
+                     delivery_time=None):
+    return {
+        'id': order_id,
+        'restaurant_id': restaurant_id,
+        'customer_id': customer_id,
+        'status': status,
+        'total_price': total_price,
+        'order_time': order_time.isoformat(),
+        'delivery_time': delivery_time.isoformat() if delivery_time else None,
+    }
+
+
+def publish_orders(event_type, orders):
+    """Publishes committed orders: 'placed' or 'status' events of order dicts"""
+    if orders:
+        get_order_feed().publish(event_type, orders)
+
+
+def format_event(event):
+    """One server-sent event"""
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['order'])}\n\n"
+
+
+def stream_events(subscription, keepalive, duration, clock):
+    """
+    Server-sent events of the subscription for `duration` seconds, with a
+    comment line every `keepalive` seconds so proxies keep the connection.
+    Closes the subscription when done or when the client goes away.
+    """
+    deadline = clock() + duration
+    try:
+        while True:
+            if subscription.overflowed:
+                # the page reloads instead of showing a feed with holes
+                yield 'event: resync\ndata: {}\n\n'
+                return
+            remaining = deadline - clock()
+            event = subscription.get(min(keepalive, remaining)) if remaining > 0 else subscription.get(0)
+            if event is not None:
+                yield format_event(event)
+            elif remaining <= 0:
+                return
+            else:
+                yield ': keepalive\n\n'
+    finally:
+        subscription.close()
@@ -0,0 +1,135 @@
+"""
+Order statistics: orders per status and revenue.
+
+get_order_stats() answers any filter with one GROUP BY status query on
+OrderList. Restaurant totals are also kept in the RestaurantOrderStats
+rollup, one row per (restaurant, status), which is updated:
+- for orders added, deleted or changing status through the ORM, in the
+  same transaction by the mapper hooks below,
+- for orders bulk inserted at checkout, right after its commit by
+  add_orders_to_stats(), from the order event bus (app/order_events.py).
+With ORDER_STATS_ROLLUP the restaurant pages read the rollup instead of
+counting their orders. Orders written outside the app are picked up by
+`flask rebuild-order-stats`.
+"""
+from flask import current_app
+from sqlalchemy import delete, event, func, insert, select
+from .extensions import db
+from .models import OrderList, RestaurantOrderStats
+from .rollup import Increments, changed_values
+
+# p-pending, d-delivered, c-cancelled
+ORDER_STATUSES = ('p', 'd', 'c')
+
+
+class OrderStats:
+    """Order count and order value per status"""
+
+    def __init__(self, rows=()):
+        self.counts = dict.fromkeys(ORDER_STATUSES, 0)
+        self.values = dict.fromkeys(ORDER_STATUSES, 0.0)
+        for status, count, value in rows:
+            self.counts[status] = self.counts.get(status, 0) + count
+            self.values[status] = self.values.get(status, 0.0) + (value or 0.0)
+
+    @property
+    def pending(self):
+        return self.counts['p']
+
+    @property
+    def delivered(self):
+        return self.counts['d']
+
+    @property
+    def cancelled(self):
+        return self.counts['c']
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    @property
+    def revenue(self):
+        """Value of the delivered orders"""
+        return round(self.values['d'], 2)
+
+    def status_counts(self):
+        """Counts of the status tabs, plus 'all'"""
+        return {**self.counts, 'all': self.total}
+
+
+def get_order_stats(*conditions):
+    """OrderStats of the orders matching `conditions`, in one grouped query"""
+    return OrderStats(db.session.execute(select(
+        OrderList.status, func.count(OrderList.id), func.sum(OrderList.total_price)
+    ).where(*conditions).group_by(OrderList.status)).all())
+
+
+def get_restaurant_order_stats(restaurant_ids):
+    """OrderStats of all orders of the restaurants, from the rollup when enabled"""
+    if not restaurant_ids:
+        return OrderStats()
+    if not current_app.config.get('ORDER_STATS_ROLLUP'):
+        return get_order_stats(OrderList.restaurant_id.in_(restaurant_ids))
+    stats = RestaurantOrderStats
+    return OrderStats(db.session.execute(select(
+        stats.status, func.sum(stats.order_count), func.sum(stats.revenue)
+    ).where(stats.restaurant_id.in_(restaurant_ids)).group_by(stats.status)).all())
+
+
+def _stats_increments():
+    return Increments(('restaurant_id', 'status'))
+
+
+def add_orders_to_stats(connection, order_rows):
+    """Counts orders inserted without the ORM, `order_rows` being their insert parameters"""
+    increments = _stats_increments()
+    for row in order_rows:
+        increments.add((row['restaurant_id'], row['status']), order_count=1, revenue=row['total_price'])
+    increments.write(connection, RestaurantOrderStats.__table__)
+
+
+def rebuild_order_stats():
+    """Recomputes the whole rollup from OrderList, returns the number of rows"""
+    table = RestaurantOrderStats.__table__
+    db.session.execute(delete(table))
+    rows = db.session.execute(insert(table).from_select(
+        ['restaurant_id', 'status', 'order_count', 'revenue'],
+        select(OrderList.restaurant_id, OrderList.status, func.count(OrderList.id),
+               func.coalesce(func.sum(OrderList.total_price), 0.0)
+               ).group_by(OrderList.restaurant_id, OrderList.status))).rowcount
+    db.session.commit()
+    return rows
+
+
+def init_order_stats(app):
+    """Fills the rollup of databases created before it existed, needs an app context"""
+    empty = db.session.execute(select(RestaurantOrderStats.restaurant_id).limit(1)).first() is None
+    if empty and db.session.execute(select(OrderList.id).limit(1)).first() is not None:
+        rebuild_order_stats()
+    db.session.commit()
+
+
+@event.listens_for(OrderList, 'after_insert')
+def add_order_to_stats(mapper, connection, order):
+    add_orders_to_stats(connection, [{'restaurant_id': order.restaurant_id, 'status': order.status,
+                                      'total_price': order.total_price}])
+
+
+@event.listens_for(OrderList, 'after_delete')
+def remove_order_from_stats(mapper, connection, order):
+    increments = _stats_increments()
+    increments.add((order.restaurant_id, order.status), -1, order_count=1, revenue=order.total_price)
+    increments.write(connection, RestaurantOrderStats.__table__)
+
+
+@event.listens_for(OrderList, 'after_update')
+def move_order_in_stats(mapper, connection, order):
+    changed = changed_values(order, 'restaurant_id', 'status', 'total_price')
+    if changed is None:
+        return
+    # the order leaves the row of its old restaurant and status, and joins the new one
+    increments = _stats_increments()
+    for (restaurant_id, status, total_price), sign in zip(changed, (-1, 1)):
+        increments.add((restaurant_id, status), sign, order_count=1, revenue=total_price)
+    increments.write(connection, RestaurantOrderStats.__table__)
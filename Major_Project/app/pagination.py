@@ -0,0 +1,61 @@
+"""
+Keyset pagination for order lists.
+
+Pages are ordered newest first on (order_time, id). Instead of an offset
+the next page starts after the last order shown, so every page is a short
+range scan of the (..., order_time, id) indexes on OrderList no matter how
+deep the customer or restaurant scrolls.
+"""
+from datetime import datetime
+from sqlalchemy import tuple_
+from .models import OrderList
+from .order_stats import ORDER_STATUSES, get_order_stats
+
+ORDERS_PER_PAGE = 20
+
+
+class OrderPage:
+    """One page of orders and the cursor of the page after it"""
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def encode_cursor(order):
+    return f'{order.order_time.isoformat()},{order.id}'
+
+
+def decode_cursor(cursor):
+    """(order_time, id) of a cursor, None for a missing or malformed one"""
+    try:
+        order_time, order_id = cursor.rsplit(',', 1)
+        return datetime.fromisoformat(order_time), int(order_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def paginate_orders(query, cursor=None, per_page=ORDERS_PER_PAGE):
+    """
+    Returns the OrderPage of `query` (an OrderList query, already filtered)
+    that starts after `cursor`.
+    """
+    position = decode_cursor(cursor)
+    if position:
+        query = query.filter(tuple_(OrderList.order_time, OrderList.id) < tuple_(*position))
+    orders = query.order_by(OrderList.order_time.desc(), OrderList.id.desc()).limit(per_page + 1).all()
+    if len(orders) > per_page:
+        return OrderPage(orders[:per_page], encode_cursor(orders[per_page - 1]))
+    return OrderPage(orders, None)
+
+
+def get_order_status_counts(*conditions):
+    """
+    Number of orders per status tab plus 'all' for the orders matching
+    `conditions`, in one grouped query over the status index.
+    """
+    return get_order_stats(*conditions).status_counts()
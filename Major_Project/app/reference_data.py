@@ -0,0 +1,164 @@
+"""
+Process-wide cache of small reference data: the cuisines and the locations
+that have restaurants.
+
+Both are read by most menu and listing pages but change rarely, so they are
+loaded once and kept for REFERENCE_CACHE_TTL seconds. Committed writes to
+cuisines, addresses and restaurants drop the affected entries right away;
+the TTL covers writes made outside the ORM session.
+
+Entries are kept in a dict of the process by default. With
+REFERENCE_CACHE_URL set to a redis:// URL they are kept in Redis instead
+(needs the `redis` package), so all gunicorn workers share one copy and an
+invalidation made by one worker is seen by the others. Cached values are
+plain JSON data, never ORM objects.
+"""
+import json
+import time
+from collections import namedtuple
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+from .extensions import db
+from .models import Address, Cuisine, Restaurant
+
+CUISINES = 'cuisines'
+LOCATIONS = 'locations'
+
+CuisineRef = namedtuple('CuisineRef', 'id name')
+
+
+class MemoryBackend:
+    """Entries in a dict of this process"""
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or (entry[0] is not None and entry[0] <= time.monotonic()):
+            return None
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        self.entries[key] = (None if ttl is None else time.monotonic() + ttl, value)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.entries.pop(key, None)
+
+
+class RedisBackend:
+    """Entries as JSON in Redis, shared by every process using the server"""
+    prefix = 'reference:'
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError('REFERENCE_CACHE_URL needs the redis package installed') from e
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return None if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, json.dumps(value), ex=None if ttl is None else max(1, int(ttl)))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*(self.prefix + key for key in keys))
+
+
+class ReferenceCache:
+    def __init__(self, backend, ttl=None):
+        self.backend = backend
+        self.ttl = ttl
+
+    def get(self, key, load):
+        """The cached value of `key`, stored from load() when missing or expired"""
+        value = self.backend.get(key)
+        if value is None:
+            value = load()
+            self.backend.set(key, value, self.ttl)
+        return value
+
+    def invalidate(self, *keys):
+        self.backend.delete(*keys)
+
+
+def init_reference_cache(app):
+    url = app.config.get('REFERENCE_CACHE_URL')
+    backend = RedisBackend.from_url(url) if url else MemoryBackend()
+    app.extensions['reference_cache'] = ReferenceCache(backend, app.config.get('REFERENCE_CACHE_TTL'))
+
+
+def get_reference_cache():
+    return current_app.extensions['reference_cache']
+
+
+def _load_cuisines():
+    return [[cuisine_id, name] for cuisine_id, name in db.session.execute(
+        select(Cuisine.id, Cuisine.name).order_by(Cuisine.name))]
+
+
+def _load_locations():
+    return list(db.session.execute(
+        select(Address.location).join(Restaurant, Restaurant.user_id == Address.user_id)
+        .where(Address.location.is_not(None), Address.location != '')
+        .distinct().order_by(Address.location)).scalars())
+
+
+def get_cuisines():
+    """All cuisines as (id, name) tuples, sorted by name"""
+    return [CuisineRef(*row) for row in get_reference_cache().get(CUISINES, _load_cuisines)]
+
+
+def get_cuisine_by_name(name):
+    return next((cuisine for cuisine in get_cuisines() if cuisine.name == name), None)
+
+
+def get_restaurant_locations():
+    """Distinct locations of the restaurant owners' addresses, sorted"""
+    return get_reference_cache().get(LOCATIONS, _load_locations)
+
+
+def _changed(session, obj, *attributes):
+    if obj in session.new or obj in session.deleted:
+        return True
+    state = inspect(obj)
+    return any(state.attrs[attribute].history.has_changes() for attribute in attributes)
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_stale_reference_data(session, flush_context):
+    stale = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Cuisine) and _changed(session, obj, 'name'):
+            stale.add(CUISINES)
+        elif isinstance(obj, Address) and _changed(session, obj, 'location', 'user_id'):
+            stale.add(LOCATIONS)
+        elif isinstance(obj, Restaurant) and _changed(session, obj, 'user_id'):
+            stale.add(LOCATIONS)
+    if stale:
+        session.info.setdefault('reference_stale', set()).update(stale)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_reference_data(session):
+    stale = session.info.pop('reference_stale', None)
+    if stale and has_app_context():
+        cache = current_app.extensions.get('reference_cache')
+        if cache is not None:
+            cache.invalidate(*stale)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_stale_reference_data(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop('reference_stale', None)
@@ -1,9 +1,17 @@
-from flask import redirect,request,render_template,url_for,flash,abort, jsonify
+import time
+from flask import redirect,request,render_template,url_for,flash,abort, jsonify, Response, current_app
 from . import restaurant
 from app.models import *
 from  .forms import UpdateItemForm, ResetPasswordForm, RestaurantForm, MenuItemForm
 from .services import *
 from flask_login import login_required, current_user
+from app.pagination import ORDER_STATUSES
+from app.order_stats import get_restaurant_order_stats
+from app.sales import get_sales_summaries
+from app.analytics import TOP_DISHES, get_restaurant_analytics, parse_window
+from app.reference_data import get_cuisines, get_cuisine_by_name
+from app.identity import get_identity
+from app.order_feed import get_order_feed, stream_events
 
 
 @restaurant.route('/')
@@ -13,11 +21,13 @@ from flask_login import login_required, current_user
 def home():
     # Show all restaurants owned by the current user
     restaurants = Restaurant.query.filter_by(user_id=current_user.id).all()
-    # Add location for each restaurant (from Address)
+    # Add location for each restaurant (from Address), the owner's address is theirs
+    address = Address.query.filter_by(user_id=current_user.id).first()
     for r in restaurants:
-        address = Address.query.filter_by(user_id=r.user_id).first()
         r.location = address.location if address else 'N/A'
-    return render_template('restaurant/dashboard.html', restaurants=restaurants)
+    # sales of the last days and best sellers of the last 24h, from the rollups
+    sales = get_sales_summaries([r.id for r in restaurants])
+    return render_template('restaurant/dashboard.html', restaurants=restaurants, sales=sales)
 
 
 @restaurant.route('/view_orders') 
@@ -28,10 +38,20 @@ def view_orders():
     # Show all orders for all restaurants owned by the current user
     restaurants = Restaurant.query.filter_by(user_id=current_user.id).all()
     restaurant_ids = [r.id for r in restaurants]
-    orders = OrderList.query.filter(OrderList.restaurant_id.in_(restaurant_ids)).order_by(OrderList.order_time.desc()).all()
+    status = request.args.get('status')
+    if status not in ORDER_STATUSES:
+        status = None
+    # name search narrows the restaurants the order query and the tab counts run on
+    search_term = request.args.get('order_restaurant', '').strip().lower()
+    if search_term:
+        restaurant_ids = [r.id for r in restaurants if search_term in r.name.lower()]
+    status_counts = get_restaurant_order_stats(restaurant_ids).status_counts()
+    page = get_orders_page_for_restaurants(restaurant_ids, status=status, cursor=request.args.get('cursor'))
     # For search/filter, get all restaurant names
     restaurant_map = {r.id: r.name for r in restaurants}
-    return render_template('restaurant/order_history.html', all_orders=orders, restaurant_map=restaurant_map, restaurants=restaurants, show_all=True)
+    return render_template('restaurant/order_history.html', all_orders=page.items, page=page,
+                           status=status, status_counts=status_counts,
+                           restaurant_map=restaurant_map, restaurants=restaurants, show_all=True)
 
 
 
@@ -47,9 +67,9 @@ def order_detail(order_id):
     for items in order_details:
         order_data.append(
             {
-                "food": Food.query.get(items.food_id).name,
+                "food": items.food_name,
                 "quantity": items.quantity,
-                "price": Food.query.get(items.food_id).price
+                "price": items.unit_price
             }
         )
     return render_template('restaurant/order_detail.html',customer_id = customer_id, order_details=order_data,total_price = OrderList.query.get(order_id).total_price)
@@ -62,16 +82,14 @@ def order_detail(order_id):
 def view_menu():
     form = UpdateItemForm()
     restaurant_id = get_restaurant_id_by_user_id(current_user.id)
+    restaurant = Restaurant.query.get(restaurant_id)
+    # each item carries its cuisine name and whether it is mostly ordered
     menu = get_menu_for_restaurant(restaurant_id = restaurant_id)
-    mostly_ordered = get_mostly_ordered_items(restaurant_id = restaurant_id)
-    
-    for item in menu :
-        print(item['id'], item['id'] in [i.id for i in mostly_ordered])
 
-    cuisine_list = [i.name for i in Cuisine.query.all()]
+    cuisine_list = [cuisine.name for cuisine in get_cuisines()]
     return render_template("restaurant/menu.html", menu=menu,
+                           restaurant = restaurant,
                            form =form,
-                           mostly_ordered = mostly_ordered,
                            cuisine_list = cuisine_list)
 
 
@@ -156,7 +174,7 @@ def update_menu():
                 food.name = request.form.get(f"food_name_{item_id}").capitalize()
                 food.price = request.form.get(f"price_{item_id}")
                 new_cuisine = request.form.get(f"cuisine_{item_id}").capitalize()
-                existing_cuisine = Cuisine.query.filter(Cuisine.name == new_cuisine).first()
+                existing_cuisine = get_cuisine_by_name(new_cuisine)
 
                 if existing_cuisine :
                     food.cuisine_id = existing_cuisine.id
@@ -292,15 +310,17 @@ def restaurant_detail(restaurant_id):
     restaurant = Restaurant.query.get_or_404(restaurant_id)
     address = Address.query.filter_by(user_id=restaurant.user_id).first()
     restaurant.location = address.location if address else 'N/A'
-    # Fetch reviews and ratings
-    rest_reviews = RestaurantReview.query.filter_by(restaurant_id=restaurant_id).all()
-    avg_rest_rating = round(sum([r.rating for r in rest_reviews])/len(rest_reviews), 1) if rest_reviews else None
-    # Fetch menu and dish reviews
+    # Fetch latest reviews, averages come from the materialized rating columns
+    rest_reviews = RestaurantReview.query.filter_by(restaurant_id=restaurant_id).order_by(
+        RestaurantReview.review_time.desc(), RestaurantReview.id.desc()).limit(5).all()
+    avg_rest_rating = restaurant.average_rating
+    # Fetch menu and the latest dish reviews
     menu = Food.query.filter_by(restaurant_id=restaurant_id).all()
+    reviews_by_food = get_recent_dish_reviews(restaurant_id)
     menu_items = []
     for item in menu:
-        dish_reviews = DishReview.query.filter_by(food_id=item.id).all()
-        avg_dish_rating = round(sum([r.rating for r in dish_reviews])/len(dish_reviews), 1) if dish_reviews else None
+        dish_reviews = reviews_by_food.get(item.id, [])
+        avg_dish_rating = item.average_rating
         menu_items.append({
             'id': item.id,
             'name': item.name,
@@ -321,8 +341,50 @@ def view_orders_for_restaurant(restaurant_id):
     restaurant = Restaurant.query.get_or_404(restaurant_id)
     if restaurant.user_id != current_user.id:
         abort(403)
-    orders = OrderList.query.filter_by(restaurant_id=restaurant_id).order_by(OrderList.order_time.desc()).all()
-    return render_template('restaurant/order_history.html', restaurant=restaurant, all_orders=orders)
+    status = request.args.get('status')
+    if status not in ORDER_STATUSES:
+        status = None
+    page = get_orders_page_for_restaurants([restaurant_id], status=status, cursor=request.args.get('cursor'))
+    status_counts = get_restaurant_order_stats([restaurant_id]).status_counts()
+    return render_template('restaurant/order_history.html', restaurant=restaurant, all_orders=page.items,
+                           page=page, status=status, status_counts=status_counts)
+
+@restaurant.route('/api/orders/stream')
+@dont_allow_non_restaurants
+@login_required
+def order_stream():
+    """ server-sent events of the new and changed orders of the owner's restaurants (?restaurant_id= for one) """
+    restaurant_ids = get_identity().restaurant_ids
+    restaurant_id = request.args.get('restaurant_id', type=int)
+    if restaurant_id is not None:
+        if restaurant_id not in restaurant_ids:
+            abort(403)
+        restaurant_ids = (restaurant_id,)
+    # sent back by EventSource when it reconnects
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    after = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+    subscription = get_order_feed().subscribe(restaurant_ids, after=after)
+    config = current_app.config
+    events = stream_events(subscription, config['ORDER_FEED_KEEPALIVE_SECONDS'],
+                           config['ORDER_FEED_STREAM_SECONDS'], time.monotonic)
+    return Response(events, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@restaurant.route('/api/restaurant/<int:restaurant_id>/analytics')
+@dont_allow_non_restaurants
+@login_required
+def restaurant_analytics_api(restaurant_id):
+    """ order analytics of one restaurant: ?start=&end= (ISO, end excluded), bucket=hour|day|week, top= """
+    restaurant = Restaurant.query.get_or_404(restaurant_id)
+    if restaurant.user_id != current_user.id:
+        abort(403)
+    try:
+        start, end, bucket = parse_window(request.args.get('start'), request.args.get('end'),
+                                          request.args.get('bucket', 'day'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    top = min(max(request.args.get('top', TOP_DISHES, type=int), 0), 50)
+    return jsonify(get_restaurant_analytics(restaurant_id, start, end, bucket, top))
 
 @restaurant.route('/restaurant/<int:restaurant_id>/menu')
 @dont_allow_non_restaurants
@@ -331,20 +393,8 @@ def view_menu_for_restaurant(restaurant_id):
     restaurant = Restaurant.query.get_or_404(restaurant_id)
     if restaurant.user_id != current_user.id:
         abort(403)
-    menu = Food.query.filter_by(restaurant_id=restaurant_id).all()
-    from datetime import datetime
-    today = datetime.now().date()
-    # Get food ids ordered more than 5 times today for this restaurant
-    mostly_ordered_query = db.session.query(
-        Food.id, db.func.count(OrderDetail.id).label('count')
-    ).join(OrderDetail, Food.id == OrderDetail.food_id) \
-    .join(OrderList, OrderList.id == OrderDetail.order_id) \
-    .filter(db.func.date(OrderList.order_time) == today, Food.restaurant_id == restaurant_id) \
-    .group_by(Food.id) \
-    .having(db.func.count(OrderDetail.id) > 5) \
-    .all()
-    mostly_ordered_ids = {item.id for item in mostly_ordered_query}
-    return render_template('restaurant/menu.html', restaurant=restaurant, menu=menu, mostly_ordered_ids=mostly_ordered_ids)
+    menu = get_menu_for_restaurant(restaurant_id)
+    return render_template('restaurant/menu.html', restaurant=restaurant, menu=menu)
 
 @restaurant.route('/restaurant/<int:restaurant_id>/menu/add', methods=['GET', 'POST'])
 @dont_allow_non_restaurants
@@ -354,7 +404,7 @@ def add_menu_item(restaurant_id):
     if restaurant.user_id != current_user.id:
         abort(403)
     form = MenuItemForm()
-    form.cuisine_id.choices = [(c.id, c.name) for c in Cuisine.query.all()]
+    form.cuisine_id.choices = [(c.id, c.name) for c in get_cuisines()]
     if form.validate_on_submit():
         food = Food(
             restaurant_id=restaurant_id,
@@ -380,7 +430,7 @@ def edit_menu_item(restaurant_id, food_id):
         abort(403)
     food = Food.query.get_or_404(food_id)
     form = MenuItemForm(obj=food)
-    form.cuisine_id.choices = [(c.id, c.name) for c in Cuisine.query.all()]
+    form.cuisine_id.choices = [(c.id, c.name) for c in get_cuisines()]
     if form.validate_on_submit():
         food.name = form.name.data
         food.price = form.price.data
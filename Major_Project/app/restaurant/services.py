@@ -1,4 +1,4 @@
-from app.models import User,Restaurant, Address, Food, Cuisine, OrderList, OrderDetail, Cart
+from app.models import User,Restaurant, Address, Food, Cuisine, OrderList, OrderDetail, Cart, DishReview, order_lines
 from app import db
 from collections import Counter
 from functools import wraps
@@ -6,11 +6,20 @@ from flask_login import current_user
 from flask import jsonify,flash
 from datetime import timedelta,datetime
 from sqlalchemy.sql import func
+from app.pagination import ORDERS_PER_PAGE, paginate_orders
+from app.reference_data import get_cuisine_by_name
+from app.identity import current_identity_for
+from app.menu import MOSTLY_ORDERED_MIN_ORDERS, MOSTLY_ORDERED_WINDOW, get_menu, recent_order_counts
+from app.order_stats import get_restaurant_order_stats
+from app.order_events import ORDER_DELIVERED, order_values, publish_order_event
 from .helper import *
 
 def dont_allow_non_restaurants(function):
     @wraps(function)
     def wrapper(*args, **kwargs) :
+        # logged out (or deleted) users are sent to the login page by login_required
+        if not current_user.is_authenticated:
+            return function(*args, **kwargs)
         if current_user.code not in ('0','2') :  # 0 for admin , 2 for restaurants
             return jsonify({"error": "Functionality not allowed for customers"}), 403
         return function(*args, **kwargs)
@@ -18,23 +27,26 @@ def dont_allow_non_restaurants(function):
 
 @check_transaction_complete
 def get_restaurant_id_by_user_id(user_id):
+    # the logged in owner's restaurants are already known for this request
+    identity = current_identity_for(user_id)
+    if identity is not None and identity.restaurant_id is not None:
+        return identity.restaurant_id
     restaurant_id = Restaurant.query.join(User,Restaurant.user_id == user_id).filter(
         User.id == user_id).first().id
     return restaurant_id
 
 @check_transaction_complete
 def get_mostly_ordered_items(restaurant_id):
-
-    ORDER_LIMIT = 3
-    
-    food_items = Food.query.join(Restaurant , Food.restaurant_id == Restaurant.id).join(
-        OrderDetail,Food.id == OrderDetail.food_id).join(
-            OrderList,OrderDetail.order_id == OrderList.id).filter(
-                OrderList.order_time > datetime.now() - timedelta(hours=24)
-            ).group_by(Food.id).having(
-                func.count(Food.id)>=ORDER_LIMIT
-            ).filter(Restaurant.id == restaurant_id).all()
-   
+    """
+    Dishes of the restaurant ordered at least MOSTLY_ORDERED_MIN_ORDERS
+    times in the last 24h, from the hourly sales rollup (app/sales.py).
+    Menu pages read the same count from get_menu.
+    """
+    order_counts = recent_order_counts(restaurant_id, datetime.now() - MOSTLY_ORDERED_WINDOW)
+    food_items = Food.query.join(order_counts, order_counts.c.food_id == Food.id).filter(
+        Food.restaurant_id == restaurant_id,
+        order_counts.c.order_count >= MOSTLY_ORDERED_MIN_ORDERS
+    ).all()
 
     print("mostly ordered",food_items)
     return food_items
@@ -54,33 +66,32 @@ def get_orders_for_restaurant(restaurant_id):
 
     return pending_orders, delivered_orders, cancelled_orders
 
+def get_orders_page_for_restaurants(restaurant_ids, status=None, cursor=None, per_page=ORDERS_PER_PAGE):
+    """
+    One page of the orders of the given restaurants, newest first,
+    optionally only one status. Returns an OrderPage (app/pagination.py).
+    """
+    query = OrderList.query.filter(OrderList.restaurant_id.in_(restaurant_ids))
+    if status:
+        query = query.filter(OrderList.status == status)
+    return paginate_orders(query, cursor, per_page)
+
 @check_transaction_complete
 def get_order_details(order_id):
     """
     Returns the details of an order.
     """
-    query = OrderDetail.query.filter_by(order_id=order_id)
-
     customer_id = OrderList.query.filter(OrderList.id == order_id).first().customer_id
 
-    return query.all(), customer_id
+    return order_lines(order_id), customer_id
 
 @check_transaction_complete
 def get_menu_for_restaurant(restaurant_id):
-
-    menu = Food.query.filter(Food.restaurant_id==restaurant_id).all()
-    menu_items = []
-    for item in menu :
-        menu_items.append(
-            {"id" : item.id,
-             "name" : item.name,
-             "price" :item.price,
-             "cuisine" : Cuisine.query.join(Food,Cuisine.id == Food.cuisine_id).filter(Food.cuisine_id == item.cuisine_id).first().name,
-             "category" : item.category
-            
-            }
-        )
-    return menu_items
+    """
+    Returns the menu items of a restaurant with cuisine name, orders of the
+    last 24h and review aggregates, in one query (app/menu.py).
+    """
+    return get_menu(restaurant_id)
 
 @check_transaction_complete
 def mark_order_delivered(order_id):
@@ -91,7 +102,9 @@ def mark_order_delivered(order_id):
     if order and order.status == 'p':
         order.status = 'd'
         order.delivery_time = datetime.now()
+        changed = order_values(order)
         db.session.commit()
+        publish_order_event(ORDER_DELIVERED, [changed])
         return True,"order marked as delivered"
     else:
         return False,"order not found or already delivered"
@@ -122,7 +135,7 @@ def add_dish_to_menu(restaurant_id, food_name, price, cuisine_name, category):
     category = category.capitalize()
     # cuisine_name = cuisine_name.split('')
 
-    cuisine= Cuisine.query.filter(Cuisine.name == cuisine_name).first()
+    cuisine = get_cuisine_by_name(cuisine_name)
 
     if not cuisine :
         return False,"Cuisine Does not exists in records"
@@ -134,17 +147,9 @@ def add_dish_to_menu(restaurant_id, food_name, price, cuisine_name, category):
     return True, "Dish added succesfully"
 
 def get_order_count_for_restaurant(restaurant_id):
-    orders_for_restaurant = OrderList.query.join(OrderDetail,OrderDetail.order_id == OrderList.id).join(
-        Food,OrderDetail.food_id == Food.id).join(
-            Restaurant,Restaurant.id == Food.restaurant_id
-        ).filter(Restaurant.id == restaurant_id)
-    
-    pending_order_counts = orders_for_restaurant.filter(OrderList.status =='p').count()
-    cancelled_order_counts = orders_for_restaurant.filter(OrderList.status =='c').count()
-    delivered_order_counts = orders_for_restaurant.filter(OrderList.status =='d').count()
-    total_order_counts = pending_order_counts + cancelled_order_counts + delivered_order_counts
-
-    return pending_order_counts, cancelled_order_counts, delivered_order_counts, total_order_counts
+    """(pending, cancelled, delivered, total) orders of the restaurant (app/order_stats.py)"""
+    stats = get_restaurant_order_stats([restaurant_id])
+    return stats.pending, stats.cancelled, stats.delivered, stats.total
 
 def delete_food_from_menu(food_id):
     food_item = Food.query.get(food_id)
@@ -192,3 +197,25 @@ def get_restaurant_details(restaurant_id):
     return restaurant_info, menu
 
 
+def get_recent_dish_reviews(restaurant_id, per_dish=2):
+    """
+    Returns {food_id: [latest reviews]} for every dish of a restaurant in one
+    query, keeping only the newest `per_dish` reviews of each dish.
+    """
+    position = func.row_number().over(
+        partition_by=DishReview.food_id,
+        order_by=(DishReview.review_time.desc(), DishReview.id.desc())
+    ).label('position')
+    ranked = db.session.query(DishReview.id, position).join(
+        Food, Food.id == DishReview.food_id
+    ).filter(Food.restaurant_id == restaurant_id).subquery()
+
+    reviews = DishReview.query.join(ranked, ranked.c.id == DishReview.id).filter(
+        ranked.c.position <= per_dish
+    ).order_by(DishReview.food_id, ranked.c.position).all()
+
+    reviews_by_food = {}
+    for review in reviews:
+        reviews_by_food.setdefault(review.food_id, []).append(review)
+    return reviews_by_food
+
@@ -0,0 +1,56 @@
+"""
+Rollup tables: counters keyed by a few columns (restaurant, status, hour...),
+kept current by adding increments in the transaction of the writes that
+change them, so reading them never scans the orders.
+"""
+from sqlalchemy import insert, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+class Increments:
+    """Counter increments per rollup key, merged so each row is written once"""
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.rows = {}
+
+    def add(self, key, sign=1, **amounts):
+        row = self.rows.setdefault(key, dict(zip(self.keys, key)))
+        for column, amount in amounts.items():
+            row[column] = row.get(column, 0) + sign * (amount or 0)
+
+    def write(self, connection, table):
+        """Adds the increments to the rows of `table`, creating the missing ones"""
+        rows = [row for row in self.rows.values()
+                if any(value for column, value in row.items() if column not in self.keys)]
+        if not rows:
+            return
+        counters = [column for column in rows[0] if column not in self.keys]
+        dialect_insert = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}.get(connection.dialect.name)
+        if dialect_insert is not None:
+            statement = dialect_insert(table)
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=[table.c[key] for key in self.keys],
+                set_={column: table.c[column] + statement.excluded[column] for column in counters}), rows)
+            return
+        for row in rows:
+            updated = connection.execute(table.update().where(
+                *[table.c[key] == row[key] for key in self.keys]
+            ).values({column: table.c[column] + row[column] for column in counters})).rowcount
+            if not updated:
+                connection.execute(insert(table), row)
+
+
+def changed_values(obj, *names):
+    """
+    (before, after) tuples of the attributes `names` of an object being
+    updated, None when none of them changed. Meant for after_update hooks.
+    """
+    attrs = inspect(obj).attrs
+    histories = [attrs[name].history for name in names]
+    if not any(history.has_changes() for history in histories):
+        return None
+    after = tuple(getattr(obj, name) for name in names)
+    before = tuple((history.deleted or history.unchanged or [value])[0]
+                   for history, value in zip(histories, after))
+    return before, after
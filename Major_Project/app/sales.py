@@ -0,0 +1,209 @@
+"""
+Sales rollups for the restaurant dashboard and the best-seller badges.
+
+FoodSalesHourly counts the order lines of every dish per hour and
+RestaurantSalesDaily the orders of every restaurant per day and status.
+Both are updated:
+- at checkout, where orders and lines are bulk inserted, right after the
+  commit by add_orders_to_sales(), from the order event bus
+  (app/order_events.py),
+- for orders and lines written through the ORM (status changes, seeds),
+  in the same transaction by the mapper hooks below.
+Orders are counted on the hour/day they were placed, a delivery moves the
+order to the 'd' row of that day. Order lines are never edited, orders
+deleted or written outside the app are picked up by
+`flask rebuild-sales-rollups`.
+
+Reading "the dishes ordered in the last 24h" is then a range over at most
+25 hourly rows per dish instead of a join over the order history.
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import Date, cast, delete, event, func, insert, select
+from .extensions import db
+from .models import Food, FoodSalesHourly, OrderDetail, OrderList, RestaurantSalesDaily
+from .rollup import Increments, changed_values
+
+MOSTLY_ORDERED_WINDOW = timedelta(hours=24)
+# order lines in the window that make a dish "mostly ordered"
+MOSTLY_ORDERED_MIN_ORDERS = 3
+# days of sales and best sellers shown per restaurant on the dashboard
+DASHBOARD_DAYS = 7
+DASHBOARD_BEST_SELLERS = 3
+
+
+def sales_hour(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def recent_order_counts(restaurant_id, since):
+    """
+    Subquery of (food_id, order_count) of the restaurant's order lines
+    since the start of the hour of `since`.
+    """
+    return select(
+        FoodSalesHourly.food_id, func.sum(FoodSalesHourly.order_count).label('order_count')
+    ).where(
+        FoodSalesHourly.restaurant_id == restaurant_id, FoodSalesHourly.hour >= sales_hour(since)
+    ).group_by(FoodSalesHourly.food_id).subquery()
+
+
+class SalesSummary:
+    """Dashboard figures of one restaurant, cancelled orders left out"""
+
+    def __init__(self, days):
+        # [(day, orders, sales)], oldest first
+        self.days = [[day, 0, 0.0] for day in days]
+        self.best_sellers = []
+
+    @property
+    def orders_today(self):
+        return self.days[-1][1]
+
+    @property
+    def sales_today(self):
+        return round(self.days[-1][2], 2)
+
+    @property
+    def sales_total(self):
+        """Sales over all the days of the summary"""
+        return round(sum(sales for _, _, sales in self.days), 2)
+
+
+def get_sales_summaries(restaurant_ids, now=None):
+    """{restaurant_id: SalesSummary} of the last DASHBOARD_DAYS, in two rollup queries"""
+    now = now or datetime.now()
+    days = [now.date() - timedelta(days=n) for n in range(DASHBOARD_DAYS - 1, -1, -1)]
+    summaries = {restaurant_id: SalesSummary(days) for restaurant_id in restaurant_ids}
+    if not summaries:
+        return summaries
+    positions = {day: position for position, day in enumerate(days)}
+
+    daily = RestaurantSalesDaily
+    for restaurant_id, day, orders, sales in db.session.execute(select(
+        daily.restaurant_id, daily.day, func.sum(daily.order_count), func.sum(daily.revenue)
+    ).where(
+        daily.restaurant_id.in_(summaries), daily.day >= days[0], daily.status != 'c'
+    ).group_by(daily.restaurant_id, daily.day)):
+        if day in positions:
+            summaries[restaurant_id].days[positions[day]][1:] = [orders, sales]
+
+    hourly = FoodSalesHourly
+    order_count = func.sum(hourly.order_count).label('order_count')
+    for row in db.session.execute(select(
+        hourly.restaurant_id, hourly.food_id, Food.name, order_count
+    ).join(Food, Food.id == hourly.food_id).where(
+        hourly.restaurant_id.in_(summaries), hourly.hour >= sales_hour(now - MOSTLY_ORDERED_WINDOW)
+    ).group_by(hourly.restaurant_id, hourly.food_id, Food.name).having(
+        order_count >= MOSTLY_ORDERED_MIN_ORDERS
+    ).order_by(order_count.desc(), hourly.food_id)):
+        best_sellers = summaries[row.restaurant_id].best_sellers
+        if len(best_sellers) < DASHBOARD_BEST_SELLERS:
+            best_sellers.append({'id': row.food_id, 'name': row.name, 'order_count': row.order_count})
+    return summaries
+
+
+def _daily_increments():
+    return Increments(('restaurant_id', 'day', 'status'))
+
+
+def _hourly_increments():
+    return Increments(('restaurant_id', 'hour', 'food_id'))
+
+
+def add_orders_to_sales(connection, order_rows, line_rows):
+    """
+    Counts orders and lines inserted without the ORM. `order_rows` are the
+    order insert parameters, `line_rows` dicts of restaurant_id, food_id,
+    order_time, quantity and unit_price.
+    """
+    daily = _daily_increments()
+    for row in order_rows:
+        daily.add((row['restaurant_id'], row['order_time'].date(), row['status']),
+                  order_count=1, revenue=row['total_price'])
+    daily.write(connection, RestaurantSalesDaily.__table__)
+
+    hourly = _hourly_increments()
+    for row in line_rows:
+        hourly.add((row['restaurant_id'], sales_hour(row['order_time']), row['food_id']),
+                   order_count=1, quantity=row['quantity'],
+                   revenue=row['quantity'] * (row['unit_price'] or 0))
+    hourly.write(connection, FoodSalesHourly.__table__)
+
+
+def _sql_hour(column, dialect_name):
+    if dialect_name == 'sqlite':
+        # SQLite's DateTime storage format, so rebuilt hours equal the ones written by the app
+        return func.strftime('%Y-%m-%d %H:00:00.000000', column)
+    return func.date_trunc('hour', column)
+
+
+def _sql_day(column, dialect_name):
+    return func.date(column) if dialect_name == 'sqlite' else cast(column, Date)
+
+
+def rebuild_sales_rollups():
+    """Recomputes both rollups from the order tables, returns their number of rows"""
+    dialect_name = db.session.connection().dialect.name
+    daily, hourly = RestaurantSalesDaily.__table__, FoodSalesHourly.__table__
+    db.session.execute(delete(daily))
+    db.session.execute(delete(hourly))
+
+    day = _sql_day(OrderList.order_time, dialect_name)
+    daily_rows = db.session.execute(insert(daily).from_select(
+        ['restaurant_id', 'day', 'status', 'order_count', 'revenue'],
+        select(OrderList.restaurant_id, day, OrderList.status, func.count(OrderList.id),
+               func.coalesce(func.sum(OrderList.total_price), 0.0)
+               ).group_by(OrderList.restaurant_id, day, OrderList.status))).rowcount
+
+    hour = _sql_hour(OrderList.order_time, dialect_name)
+    hourly_rows = db.session.execute(insert(hourly).from_select(
+        ['restaurant_id', 'hour', 'food_id', 'order_count', 'quantity', 'revenue'],
+        select(OrderList.restaurant_id, hour, OrderDetail.food_id, func.count(OrderDetail.id),
+               func.sum(OrderDetail.quantity),
+               func.coalesce(func.sum(OrderDetail.quantity * OrderDetail.unit_price), 0.0)
+               ).join(OrderList, OrderList.id == OrderDetail.order_id
+                      ).group_by(OrderList.restaurant_id, hour, OrderDetail.food_id))).rowcount
+    db.session.commit()
+    return daily_rows + hourly_rows
+
+
+def init_sales_rollups(app):
+    """Fills the rollups of databases created before they existed, needs an app context"""
+    empty = db.session.execute(select(RestaurantSalesDaily.restaurant_id).limit(1)).first() is None
+    if empty and db.session.execute(select(OrderList.id).limit(1)).first() is not None:
+        rebuild_sales_rollups()
+    db.session.commit()
+
+
+@event.listens_for(OrderList, 'after_insert')
+def add_order_to_sales(mapper, connection, order):
+    add_orders_to_sales(connection, [{'restaurant_id': order.restaurant_id, 'order_time': order.order_time,
+                                      'status': order.status, 'total_price': order.total_price}], [])
+
+
+@event.listens_for(OrderList, 'after_delete')
+def remove_order_from_sales(mapper, connection, order):
+    daily = _daily_increments()
+    daily.add((order.restaurant_id, order.order_time.date(), order.status), -1,
+              order_count=1, revenue=order.total_price)
+    daily.write(connection, RestaurantSalesDaily.__table__)
+
+
+@event.listens_for(OrderList, 'after_update')
+def move_order_in_sales(mapper, connection, order):
+    changed = changed_values(order, 'restaurant_id', 'order_time', 'status', 'total_price')
+    if changed is None:
+        return
+    daily = _daily_increments()
+    for (restaurant_id, order_time, status, total_price), sign in zip(changed, (-1, 1)):
+        daily.add((restaurant_id, order_time.date(), status), sign, order_count=1, revenue=total_price)
+    daily.write(connection, RestaurantSalesDaily.__table__)
+
+
+@event.listens_for(OrderDetail, 'after_insert')
+def add_order_line_to_sales(mapper, connection, line):
+    order = connection.execute(select(OrderList.restaurant_id, OrderList.order_time).where(
+        OrderList.id == line.order_id)).one()
+    add_orders_to_sales(connection, [], [{'restaurant_id': order.restaurant_id, 'food_id': line.food_id,
+                                          'order_time': order.order_time, 'quantity': line.quantity,
+                                          'unit_price': line.unit_price}])
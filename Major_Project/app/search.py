@@ -0,0 +1,234 @@
+"""
+Full-text search over the restaurant catalogue.
+
+Every restaurant has one search document made of its name, location,
+cuisines, dish names and description. Documents live in
+- an FTS5 virtual table on SQLite (bm25 ranking, rowid = restaurant id),
+- a tsvector table with a GIN index on Postgres (ts_rank ranking),
+and other databases fall back to LIKE matching without an index.
+
+Documents are rewritten inside the flush that changed the catalogue
+(app/catalogue.py). `flask rebuild-search-index` recreates them all, e.g.
+after Core bulk loads. Every search word is matched as a prefix, all words
+must match.
+
+search_matches() is a subquery of all the matches, meant to be joined or
+filtered on by the listing and facet queries, so their other filters apply
+to every match and not only to the best ranked ones.
+"""
+import re
+import weakref
+from sqlalchemy import Float, Integer, event, false, inspect, literal, or_, select, text
+from .catalogue import load_restaurant_records, on_catalogue_flush
+from .extensions import db
+from .models import Address, Cuisine, Food, Restaurant
+
+SEARCH_TABLE = 'restaurant_search'
+SEARCH_RESULTS_LIMIT = 500
+REBUILD_CHUNK_SIZE = 1000
+
+
+def search_terms(query):
+    """Lower case words of a search query, punctuation is dropped"""
+    return re.findall(r'\w+', (query or '').lower())
+
+
+class SqliteFtsSearch:
+    """FTS5 table, columns weighted name > location = cuisines > dishes > description"""
+    indexed = True
+    weights = (10.0, 4.0, 4.0, 2.0, 1.0)
+
+    def create(self, connection):
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+            "name, location, cuisines, dishes, description, "
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"))
+
+    def drop(self, connection):
+        connection.execute(text(f'DROP TABLE IF EXISTS {SEARCH_TABLE}'))
+
+    def delete(self, connection, restaurant_ids):
+        connection.execute(text(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = :id'),
+                           [{'id': restaurant_id} for restaurant_id in restaurant_ids])
+
+    def replace(self, connection, documents):
+        self.delete(connection, [document['id'] for document in documents])
+        connection.execute(text(
+            f'INSERT INTO {SEARCH_TABLE} (rowid, name, location, cuisines, dishes, description) '
+            'VALUES (:id, :name, :location, :cuisines, :dishes, :description)'), documents)
+
+    def matches(self, terms):
+        match = ' '.join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+        weights = ', '.join(str(weight) for weight in self.weights)
+        # bm25 is lower for better matches
+        return text(
+            f'SELECT rowid AS restaurant_id, -bm25({SEARCH_TABLE}, {weights}) AS score '
+            f'FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :match'
+        ).bindparams(match=match).columns(restaurant_id=Integer, score=Float)
+
+
+class PostgresSearch:
+    """tsvector per restaurant, weighted A (name) to D (description)"""
+    indexed = True
+
+    def create(self, connection):
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} ('
+            'restaurant_id INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)'))
+        connection.execute(text(
+            f'CREATE INDEX IF NOT EXISTS ix_{SEARCH_TABLE}_document ON {SEARCH_TABLE} USING gin (document)'))
+
+    def drop(self, connection):
+        connection.execute(text(f'DROP TABLE IF EXISTS {SEARCH_TABLE}'))
+
+    def delete(self, connection, restaurant_ids):
+        connection.execute(text(f'DELETE FROM {SEARCH_TABLE} WHERE restaurant_id = ANY(:ids)'),
+                           {'ids': list(restaurant_ids)})
+
+    def replace(self, connection, documents):
+        connection.execute(text(
+            f'INSERT INTO {SEARCH_TABLE} (restaurant_id, document) VALUES (:id, '
+            "setweight(to_tsvector('simple', :name), 'A') || "
+            "setweight(to_tsvector('simple', :location || ' ' || :cuisines), 'B') || "
+            "setweight(to_tsvector('simple', :dishes), 'C') || "
+            "setweight(to_tsvector('simple', :description), 'D')) "
+            'ON CONFLICT (restaurant_id) DO UPDATE SET document = excluded.document'), documents)
+
+    def matches(self, terms):
+        return text(
+            f'SELECT restaurant_id, ts_rank(document, query) AS score '
+            f"FROM {SEARCH_TABLE}, to_tsquery('simple', :query) AS query WHERE document @@ query"
+        ).bindparams(query=' & '.join(f'{term}:*' for term in terms)).columns(
+            restaurant_id=Integer, score=Float)
+
+
+class LikeSearch:
+    """No index, every word has to appear somewhere in the catalogue fields"""
+    indexed = False
+
+    def create(self, connection):
+        pass
+
+    def drop(self, connection):
+        pass
+
+    def delete(self, connection, restaurant_ids):
+        pass
+
+    def replace(self, connection, documents):
+        pass
+
+    def matches(self, terms):
+        query = select(Restaurant.id.label('restaurant_id'), literal(0.0).label('score'))
+        for term in terms:
+            pattern = f'%{term}%'
+            query = query.where(or_(
+                Restaurant.name.ilike(pattern),
+                Restaurant.description.ilike(pattern),
+                Restaurant.user_id.in_(select(Address.user_id).where(Address.location.ilike(pattern))),
+                Restaurant.id.in_(select(Food.restaurant_id).join(Cuisine, Cuisine.id == Food.cuisine_id).where(
+                    or_(Food.name.ilike(pattern), Cuisine.name.ilike(pattern))))))
+        return query
+
+
+_backends = weakref.WeakKeyDictionary()
+
+
+def get_search_backend(connection):
+    """The search implementation for the database behind `connection`"""
+    engine = connection.engine
+    backend = _backends.get(engine)
+    if backend is None:
+        if engine.dialect.name == 'postgresql':
+            backend = PostgresSearch()
+        elif engine.dialect.name == 'sqlite' and connection.execute(
+                text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar():
+            backend = SqliteFtsSearch()
+        else:
+            backend = LikeSearch()
+        _backends[engine] = backend
+    return backend
+
+
+def search_document(record):
+    """Row of the search table for a catalogue record"""
+    return {
+        'id': record['id'],
+        'name': record['name'],
+        'location': ' '.join(record['locations']),
+        'cuisines': ' '.join(record['cuisines']),
+        'dishes': ' '.join(record['dishes']),
+        'description': record['description'],
+    }
+
+
+@on_catalogue_flush
+def refresh_search_documents(connection, records, removed_ids):
+    backend = get_search_backend(connection)
+    if not backend.indexed:
+        return
+    if removed_ids:
+        backend.delete(connection, removed_ids)
+    if records:
+        backend.replace(connection, [search_document(record) for record in records])
+
+
+def rebuild_search_index():
+    """Recreates the search documents of all restaurants, returns their number"""
+    connection = db.session.connection()
+    backend = get_search_backend(connection)
+    if not backend.indexed:
+        return 0
+    backend.drop(connection)
+    backend.create(connection)
+    restaurant_ids = connection.execute(select(Restaurant.id).order_by(Restaurant.id)).scalars().all()
+    indexed = 0
+    for start in range(0, len(restaurant_ids), REBUILD_CHUNK_SIZE):
+        records = load_restaurant_records(connection, restaurant_ids[start:start + REBUILD_CHUNK_SIZE])
+        backend.replace(connection, [search_document(record) for record in records])
+        indexed += len(records)
+    db.session.commit()
+    return indexed
+
+
+def search_matches(query):
+    """
+    Subquery of (restaurant_id, score) of every restaurant matching the
+    query, higher scores for better matches. Matches nothing for a query
+    without words.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return select(Restaurant.id.label('restaurant_id'), literal(0.0).label('score')).where(
+            false()).subquery('search_matches')
+    return get_search_backend(db.session.connection()).matches(terms).subquery('search_matches')
+
+
+def search_restaurants(query, limit=SEARCH_RESULTS_LIMIT):
+    """
+    [(restaurant_id, score)] of the `limit` best matches, best first, empty
+    for an empty query. Filtered listings use search_matches() instead.
+    """
+    if not search_terms(query):
+        return []
+    matches = search_matches(query)
+    return [tuple(row) for row in db.session.execute(select(matches.c.restaurant_id, matches.c.score).order_by(
+        matches.c.score.desc(), matches.c.restaurant_id).limit(limit))]
+
+
+@event.listens_for(Restaurant.__table__, 'after_create')
+def create_search_table(target, connection, **kw):
+    get_search_backend(connection).create(connection)
+
+
+@event.listens_for(Restaurant.__table__, 'before_drop')
+def drop_search_table(target, connection, **kw):
+    get_search_backend(connection).drop(connection)
+
+
+def init_search(app):
+    """Builds the search index of databases created before it existed, needs an app context"""
+    connection = db.session.connection()
+    if get_search_backend(connection).indexed and not inspect(connection).has_table(SEARCH_TABLE):
+        rebuild_search_index()
+    db.session.commit()
@@ -204,3 +204,45 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 });
+
+// Search box suggestions, answered from the in-memory autocomplete index
+document.addEventListener('DOMContentLoaded', function() {
+    const searchInput = document.getElementById('restSearch');
+    const suggestionList = document.getElementById('restSuggestions');
+    if (!searchInput || !suggestionList || !searchInput.dataset.autocompleteUrl) {
+        return;
+    }
+
+    let timer = null;
+    let controller = null;
+    searchInput.addEventListener('input', function() {
+        clearTimeout(timer);
+        timer = setTimeout(function() {
+            const query = searchInput.value.trim();
+            if (!query) {
+                suggestionList.replaceChildren();
+                return;
+            }
+            if (controller) {
+                controller.abort();
+            }
+            controller = new AbortController();
+            const url = `${searchInput.dataset.autocompleteUrl}?q=${encodeURIComponent(query)}`;
+            fetch(url, {signal: controller.signal, headers: {'Accept': 'application/json'}})
+                .then(response => response.ok ? response.json() : {suggestions: []})
+                .then(data => {
+                    suggestionList.replaceChildren(...data.suggestions.map(suggestion => {
+                        const option = document.createElement('option');
+                        option.value = suggestion.text;
+                        option.label = suggestion.kind;
+                        return option;
+                    }));
+                })
+                .catch(error => {
+                    if (error.name !== 'AbortError') {
+                        console.error('Autocomplete failed:', error);
+                    }
+                });
+        }, 120);
+    });
+});
@@ -0,0 +1,287 @@
+"""
+Endpoint benchmark for the customer and restaurant pages.
+
+Seeds a database with the load data generator, logs in as a generated
+customer and as the owner of the busiest restaurant, and requests every
+benchmarked endpoint through the Flask test client. For each endpoint the
+latency percentiles, the number of SQL statements and the number of rows
+fetched per request are reported.
+
+With --baseline the results are compared to a previous run, and the script
+exits with status 1 when an endpoint runs more queries than
+--query-tolerance allows or fetches more rows than --rows-tolerance allows.
+Both do not depend on the machine, so a baseline only needs recording again
+when an endpoint's queries change on purpose. Latencies are reported, and
+only gated with --latency-tolerance, as a relative slowdown (1.0 = twice as
+slow) against a baseline recorded on the same machine. --max-queries sets an
+absolute per-request budget.
+
+    python benchmarks/endpoint_bench.py --save-baseline benchmarks/endpoint_baseline.json
+    python benchmarks/endpoint_bench.py --baseline benchmarks/endpoint_baseline.json
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, redirect_stdout
+
+# Add the project root to Python path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+
+# name, logged in as, method, url, expected status, prepare the cart first
+ENDPOINTS = [
+    ('customer.view_restaurants', 'customer', 'GET', '/customer/view_restaurants', 200, False),
+    ('customer.view_restaurants_filtered', 'customer', 'GET',
+     '/customer/view_restaurants?cuisine=Thai&cuisine=Indian&location=Saket&location=Noida&min_rating=2&min_price=300',
+     200, False),
+    ('customer.view_restaurant', 'customer', 'GET', '/customer/view_restaurant?restaurant_id={restaurant_id}', 200, False),
+    ('customer.view_cart', 'customer', 'GET', '/customer/view_cart', 200, True),
+    ('customer.update_cart', 'customer', 'GET', '/customer/update_cart?food_id={food_id}&action=add', 302, False),
+    ('customer.cart_line_api', 'customer', 'POST', '/customer/api/cart/{food_id}', 200, False),
+    ('customer.view_order_history', 'customer', 'GET', '/customer/view_order_history', 200, False),
+    ('customer.order', 'customer', 'POST', '/customer/order', 302, True),
+    ('restaurant.home', 'owner', 'GET', '/restaurant/', 200, False),
+    ('restaurant.view_orders', 'owner', 'GET', '/restaurant/view_orders', 200, False),
+    ('restaurant.view_menu', 'owner', 'GET', '/restaurant/view_menu', 200, False),
+    ('restaurant.analytics', 'owner', 'GET', '/restaurant/api/restaurant/{restaurant_id}/analytics?bucket=hour', 200, False),
+]
+
+# database shape, a baseline is only comparable with the same options
+SEED_OPTIONS = ['customers', 'restaurants', 'dishes', 'orders_per_customer', 'seed']
+
+
+class RequestStats:
+    """Counts SQL statements and fetched rows of the request thread while enabled"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.queries = 0
+        self.rows = 0
+        self.thread = None
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # the order event consumers run on their own threads
+        if threading.get_ident() == self.thread:
+            self.queries += 1
+
+    def do_orm_execute(self, orm_execute_state):
+        if not orm_execute_state.is_select or threading.get_ident() != self.thread:
+            return None
+        # buffer the result to count it, the caller gets an identical copy
+        frozen = orm_execute_state.invoke_statement().freeze()
+        self.rows += len(frozen.data)
+        return frozen()
+
+    @contextmanager
+    def collect(self):
+        self.queries = 0
+        self.rows = 0
+        self.thread = threading.get_ident()
+        event.listen(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(Session, 'do_orm_execute', self.do_orm_execute)
+        try:
+            yield self
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.remove(Session, 'do_orm_execute', self.do_orm_execute)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def pick_accounts(db):
+    """A generated customer and the busiest generated restaurant with its owner"""
+    from app.models import Customer, Food, OrderList, Restaurant, User
+
+    customer_email = db.session.query(User.email).join(Customer, Customer.user_id == User.id).filter(
+        User.email.like('load.customer%')).order_by(User.id).limit(1).scalar()
+    restaurant_id, owner_email = db.session.query(Restaurant.id, User.email).join(
+        User, User.id == Restaurant.user_id).join(OrderList, OrderList.restaurant_id == Restaurant.id).filter(
+        User.email.like('load.owner%')).group_by(Restaurant.id, User.email).order_by(
+        func.count(OrderList.id).desc(), Restaurant.id).first()
+    customer_id = db.session.query(Customer.id).join(User, User.id == Customer.user_id).filter(
+        User.email == customer_email).scalar()
+    food_id = db.session.query(func.min(Food.id)).filter(Food.restaurant_id == restaurant_id).scalar()
+    return {'customer_email': customer_email, 'customer_id': customer_id,
+            'owner_email': owner_email, 'restaurant_id': restaurant_id, 'food_id': food_id}
+
+
+def fill_cart(db, customer_id, restaurant_id, lines=3):
+    from app.models import Cart, Food
+
+    db.session.query(Cart).filter(Cart.customer_id == customer_id).delete()
+    food_ids = [food_id for (food_id,) in db.session.query(Food.id).filter(
+        Food.restaurant_id == restaurant_id).order_by(Food.id).limit(lines)]
+    db.session.execute(Cart.__table__.insert(), [
+        {'customer_id': customer_id, 'food_id': food_id, 'quantity': 2} for food_id in food_ids])
+    db.session.commit()
+
+
+def login(app, email, password):
+    client = app.test_client()
+    response = client.post('/auth/login', data={'email': email, 'password': password})
+    if response.status_code != 302:
+        raise SystemExit(f'Could not log in as {email}')
+    return client
+
+
+def run_endpoint(app, db, stats, client, accounts, endpoint, repeat, warmup):
+    name, _, method, url, expected_status, needs_cart = endpoint
+    url = url.format(**accounts)
+    latencies, queries, rows = [], [], []
+    for iteration in range(warmup + repeat):
+        if needs_cart:
+            with app.app_context():
+                fill_cart(db, accounts['customer_id'], accounts['restaurant_id'])
+        # routes print debug output, keep the report readable
+        with redirect_stdout(io.StringIO()), stats.collect():
+            started = time.perf_counter()
+            response = client.open(url, method=method)
+            elapsed = (time.perf_counter() - started) * 1000
+        # consumers of the previous request do not compete with the next one
+        app.extensions['order_events'].join()
+        if response.status_code != expected_status:
+            raise SystemExit(f'{name}: expected {expected_status}, got {response.status_code}')
+        if iteration >= warmup:
+            latencies.append(elapsed)
+            queries.append(stats.queries)
+            rows.append(stats.rows)
+    return {
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'max_ms': round(max(latencies), 3),
+        'queries': max(queries),
+        'rows': max(rows),
+    }
+
+
+def find_regressions(results, baseline, args):
+    regressions = []
+    for name, result in results.items():
+        if args.max_queries is not None and result['queries'] > args.max_queries:
+            regressions.append(f'{name}: {result["queries"]} queries, budget is {args.max_queries}')
+        previous = baseline.get('endpoints', {}).get(name)
+        if not previous:
+            continue
+        key = f'{args.latency_percentile}_ms'
+        slowdown = result[key] - previous[key]
+        if (args.latency_tolerance is not None and slowdown > args.latency_floor
+                and result[key] > previous[key] * (1 + args.latency_tolerance)):
+            regressions.append(f'{name}: {args.latency_percentile} {result[key]:.1f} ms, '
+                               f'baseline {previous[key]:.1f} ms')
+        if result['queries'] > previous['queries'] + args.query_tolerance:
+            regressions.append(f'{name}: {result["queries"]} queries, baseline {previous["queries"]}')
+        if result['rows'] > previous['rows'] * (1 + args.rows_tolerance):
+            regressions.append(f'{name}: {result["rows"]} rows, baseline {previous["rows"]}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='endpoint_bench.db', help='SQLite file or DATABASE_URL')
+    parser.add_argument('--reuse', action='store_true', help='keep an already seeded database (benchmarked orders pile up, not comparable to a baseline)')
+    parser.add_argument('--customers', type=int, default=5000)
+    parser.add_argument('--restaurants', type=int, default=100)
+    parser.add_argument('--dishes', type=int, default=20, help='dishes per restaurant')
+    parser.add_argument('--orders-per-customer', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=20, help='measured requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=2, help='unmeasured requests per endpoint')
+    parser.add_argument('--only', action='append', help='benchmark only this endpoint (repeatable)')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--save-baseline', help='write the results as JSON to this file')
+    parser.add_argument('--latency-percentile', choices=['p50', 'p95', 'p99'], default='p50',
+                        help='percentile compared against the baseline')
+    parser.add_argument('--latency-tolerance', type=float,
+                        help='also gate on latency: allowed slowdown against a baseline of the same '
+                             'machine, 1.0 = twice as slow (off by default)')
+    parser.add_argument('--latency-floor', type=float, default=5.0,
+                        help='slowdowns below this many ms are treated as noise')
+    parser.add_argument('--query-tolerance', type=int, default=0,
+                        help='allowed extra queries per request against the baseline')
+    parser.add_argument('--rows-tolerance', type=float, default=0.10,
+                        help='allowed growth of fetched rows against the baseline')
+    parser.add_argument('--max-queries', type=int, help='absolute query budget per request')
+    args = parser.parse_args()
+
+    if '://' in args.db:
+        os.environ['DATABASE_URL'] = args.db
+    else:
+        if os.path.exists(args.db) and not args.reuse:
+            os.remove(args.db)
+        os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(args.db)}'
+
+    from app import create_app, db
+    from loadgen import generate_load_data
+
+    app = create_app()
+    app.config['WTF_CSRF_ENABLED'] = False
+    # no JSON log line per benchmarked request
+    app.config['SQL_STATS_HEADERS'] = True
+
+    with app.app_context():
+        if not args.reuse:
+            db.drop_all()
+            db.create_all()
+            print('Seeding load data...')
+            generate_load_data(db, customers=args.customers, restaurants=args.restaurants,
+                               dishes_per_restaurant=args.dishes,
+                               orders_per_customer=args.orders_per_customer,
+                               seed=args.seed, verbose=False)
+        accounts = pick_accounts(db)
+        stats = RequestStats(db.engine)
+
+    clients = {'customer': login(app, accounts['customer_email'], 'cust123'),
+               'owner': login(app, accounts['owner_email'], 'rest123')}
+
+    results = {}
+    for endpoint in ENDPOINTS:
+        name, role = endpoint[0], endpoint[1]
+        if args.only and name not in args.only:
+            continue
+        results[name] = run_endpoint(app, db, stats, clients[role], accounts, endpoint,
+                                     args.repeat, args.warmup)
+
+    print(f'\n{"endpoint":<38}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}{"queries":>9}{"rows":>9}')
+    for name, result in results.items():
+        print(f'{name:<38}{result["p50_ms"]:>10.2f}{result["p95_ms"]:>10.2f}{result["p99_ms"]:>10.2f}'
+              f'{result["max_ms"]:>10.2f}{result["queries"]:>9}{result["rows"]:>9}')
+
+    options = {option: getattr(args, option) for option in SEED_OPTIONS}
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'options': options, 'endpoints': results}, f, indent=2)
+        print(f'\nBaseline written to {args.save_baseline}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('options') != options:
+            raise SystemExit(f'Baseline was recorded with {baseline.get("options")}, rerun with the same options')
+    else:
+        baseline = {}
+    regressions = find_regressions(results, baseline, args)
+    if regressions:
+        print('\nRegressions:')
+        for regression in regressions:
+            print(f'  {regression}')
+        sys.exit(1)
+    if args.baseline or args.max_queries is not None:
+        print('\nNo regressions.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Query plan benchmark for the order, cart, favourite and review indexes.
+
+Seeds a database with a large number of orders, then runs the hot queries
+of the customer and restaurant pages twice: with the composite indexes
+dropped and after `create_missing_indexes` rebuilt them. For each query the
+plan and the average latency are printed, showing the switch from table
+scans to index lookups.
+
+    python benchmarks/index_plans.py --orders 1000000 --db bench.db
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+# Add the project root to Python path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+
+BENCHMARKED_INDEXES = [
+    'ix_order_list_customer_status',
+    'ix_order_list_customer_time',
+    'ix_order_list_restaurant_time',
+    'ix_order_list_restaurant_status_time',
+    'uq_cart_customer_food',
+    'uq_favourite_restaurant_customer_restaurant',
+    'ix_dish_review_food_id',
+]
+
+HOT_QUERIES = [
+    ('customer orders by status',
+     "SELECT * FROM order_list WHERE customer_id = :customer_id AND status = 'p' ORDER BY id DESC"),
+    ('restaurant orders',
+     "SELECT * FROM order_list WHERE restaurant_id = :restaurant_id ORDER BY order_time DESC LIMIT 50"),
+    ('customer history page',
+     "SELECT * FROM order_list WHERE customer_id = :customer_id AND (order_time, id) < (:since, 1000000000) "
+     "ORDER BY order_time DESC, id DESC LIMIT 21"),
+    ('restaurant pending tab page',
+     "SELECT * FROM order_list WHERE restaurant_id = :restaurant_id AND status = 'p' "
+     "ORDER BY order_time DESC, id DESC LIMIT 21"),
+    ('restaurant orders last 24h',
+     "SELECT * FROM order_list WHERE restaurant_id = :restaurant_id AND order_time > :since"),
+    ('cart line lookup',
+     "SELECT * FROM cart WHERE customer_id = :customer_id AND food_id = :food_id"),
+    ('favourite lookup',
+     "SELECT id FROM favourite_restaurant WHERE customer_id = :customer_id AND restaurant_id = :restaurant_id"),
+    ('dish reviews',
+     "SELECT * FROM dish_review WHERE food_id = :food_id"),
+]
+
+
+def explain(db, sql, params):
+    prefix = 'EXPLAIN QUERY PLAN ' if db.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    rows = db.session.execute(text(prefix + sql), params).all()
+    return ' | '.join(str(row[-1]) for row in rows)
+
+
+def measure(db, sql, params, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        db.session.execute(text(sql), params).all()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def run_queries(db, params, repeat):
+    results = {}
+    for name, sql in HOT_QUERIES:
+        results[name] = (explain(db, sql, params), measure(db, sql, params, repeat))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='index_bench.db', help='SQLite file (recreated) or DATABASE_URL')
+    parser.add_argument('--orders', type=int, default=1000000)
+    parser.add_argument('--customers', type=int, default=20000)
+    parser.add_argument('--restaurants', type=int, default=500)
+    parser.add_argument('--dishes', type=int, default=20, help='dishes per restaurant')
+    parser.add_argument('--repeat', type=int, default=20, help='executions per query')
+    args = parser.parse_args()
+
+    if '://' in args.db:
+        os.environ['DATABASE_URL'] = args.db
+    else:
+        if os.path.exists(args.db):
+            os.remove(args.db)
+        os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(args.db)}'
+
+    from app import create_app, db
+    from app.commands import create_missing_indexes
+    from loadgen import generate_load_data
+
+    app = create_app()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        print(f'Seeding {args.orders} orders...')
+        started = time.perf_counter()
+        generate_load_data(db, customers=args.customers, restaurants=args.restaurants,
+                           dishes_per_restaurant=args.dishes,
+                           orders_per_customer=max(1, args.orders // args.customers),
+                           verbose=False)
+        print(f'Seeded in {time.perf_counter() - started:.1f}s')
+
+        params = {'customer_id': 1, 'restaurant_id': 1, 'food_id': 1,
+                  'since': datetime.now() - timedelta(hours=24)}
+
+        for name in BENCHMARKED_INDEXES:
+            db.session.execute(text(f'DROP INDEX IF EXISTS {name}'))
+        db.session.commit()
+        without = run_queries(db, params, args.repeat)
+
+        create_missing_indexes()
+        with_indexes = run_queries(db, params, args.repeat)
+
+        for name, _ in HOT_QUERIES:
+            plan_before, ms_before = without[name]
+            plan_after, ms_after = with_indexes[name]
+            print(f'\n{name}')
+            print(f'  without indexes: {ms_before:9.3f} ms  {plan_before}')
+            print(f'  with indexes:    {ms_after:9.3f} ms  {plan_after}')
+
+
+if __name__ == '__main__':
+    main()
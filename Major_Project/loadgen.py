@@ -0,0 +1,271 @@
+"""
+Synthetic load data generator.
+
+Adds customers, restaurants, menus, order history, reviews, carts and
+favourites on top of whatever is already in the database, using Core
+executemany inserts in chunks. The same seed and anchor time always produce
+the same rows, so performance problems can be reproduced locally.
+
+    python loadgen.py --customers 200000 --restaurants 5000 --orders-per-customer 15
+    python seed.py --load --customers 20000   # demo data plus load data
+"""
+
+import argparse
+import hashlib
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+
+LOCATIONS = [
+    'Gurugram', 'Paschim Vihar', 'Noida', 'Rajouri Garden', 'Connaught Place',
+    'Saket', 'Dwarka', 'Hauz Khas', 'Karol Bagh', 'Lajpat Nagar', 'Vasant Kunj',
+    'Rohini', 'Janakpuri', 'Greater Kailash', 'Mayur Vihar', 'Chanakyapuri',
+]
+CUISINES = ['Italian', 'Japanese', 'American', 'Mexican', 'Indian', 'Chinese',
+            'Thai', 'Continental', 'South Indian', 'Fast Food']
+CATEGORIES = ['Starters', 'Main Course', 'Desserts', 'Beverages', 'Breads', 'Specials']
+DISH_WORDS = ['Paneer', 'Chicken', 'Veg', 'Masala', 'Tikka', 'Biryani', 'Noodles',
+              'Pizza', 'Burger', 'Roll', 'Curry', 'Soup', 'Salad', 'Pasta', 'Taco',
+              'Sushi', 'Dosa', 'Kebab', 'Fries', 'Shake']
+RESTAURANT_WORDS = ['Spice', 'Garden', 'Express', 'Kitchen', 'Palace', 'Corner',
+                    'House', 'Bistro', 'Grill', 'Dhaba', 'Cafe', 'Diner']
+
+
+def password_hash(password, salt):
+    """
+    Werkzeug compatible pbkdf2 hash with a fixed salt and a single iteration.
+    User.password is unique, so every user needs its own salt, and hashing
+    hundreds of thousands of users with the default cost would take hours.
+    Only meant for generated data.
+    """
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), 1).hex()
+    return f'pbkdf2:sha256:1${salt}${digest}'
+
+
+class ChunkedInserter:
+    """Buffers rows per table and writes them with executemany in chunks"""
+
+    def __init__(self, session, tables, chunk_size):
+        self.session = session
+        # dependency order, parents are always written before children
+        self.tables = tables
+        self.chunk_size = chunk_size
+        self.buffers = {table.name: [] for table in tables}
+        self.counts = {table.name: 0 for table in tables}
+
+    def add(self, table, row):
+        buffer = self.buffers[table.name]
+        buffer.append(row)
+        if len(buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        for table in self.tables:
+            buffer = self.buffers[table.name]
+            if buffer:
+                self.session.execute(table.insert(), buffer)
+                self.counts[table.name] += len(buffer)
+                self.buffers[table.name] = []
+
+
+def next_id(session, model):
+    return (session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def generate_load_data(db, customers=1000, restaurants=50, dishes_per_restaurant=20,
+                       orders_per_customer=10, max_items_per_order=4, review_ratio=0.2,
+                       cart_lines=2, favourites=2, days=365, seed=42, anchor=None,
+                       chunk_size=50000, verbose=True):
+    """
+    Generates the load data and returns the number of rows written per table.
+    `anchor` is the newest order time (defaults to today at midnight), order
+    times are spread over the `days` before it.
+    """
+    from app.commands import backfill_rating_aggregates
+    from app.search import rebuild_search_index
+    from app.order_stats import rebuild_order_stats
+    from app.sales import rebuild_sales_rollups
+    from app.models import (User, Customer, Restaurant, Address, Cuisine, Food, OrderList,
+                            OrderDetail, Cart, FavouriteRestaurant, DishReview, RestaurantReview)
+
+    rng = random.Random(seed)
+    anchor = anchor or datetime.combine(datetime.now().date(), datetime.min.time())
+    started = time.perf_counter()
+    session = db.session
+
+    if db.engine.dialect.name == 'sqlite':
+        session.execute(db.text('PRAGMA synchronous = OFF'))
+
+    # reuse existing cuisines, add the missing ones
+    existing = {name for (name,) in session.query(Cuisine.name)}
+    missing = [{'name': name} for name in CUISINES if name not in existing]
+    if missing:
+        session.execute(Cuisine.__table__.insert(), missing)
+    cuisine_ids = [cuisine_id for (cuisine_id,) in session.query(Cuisine.id).order_by(Cuisine.id)]
+
+    inserter = ChunkedInserter(session, [
+        User.__table__, Customer.__table__, Restaurant.__table__, Address.__table__,
+        Food.__table__, OrderList.__table__, OrderDetail.__table__, Cart.__table__,
+        FavouriteRestaurant.__table__, DishReview.__table__, RestaurantReview.__table__,
+    ], chunk_size)
+
+    user_id = next_id(session, User)
+    customer_id = next_id(session, Customer)
+    restaurant_id = next_id(session, Restaurant)
+    food_id = next_id(session, Food)
+    order_id = next_id(session, OrderList)
+
+    # restaurants, owners and menus
+    restaurant_ids = []
+    menus = {}
+    timings = [(datetime(2000, 1, 1, 8).time(), datetime(2000, 1, 1, 22).time()),
+               (datetime(2000, 1, 1, 10).time(), datetime(2000, 1, 1, 23).time()),
+               (datetime(2000, 1, 1, 11).time(), datetime(2000, 1, 1, 23, 30).time())]
+    for _ in range(restaurants):
+        owner_id = user_id
+        user_id += 1
+        inserter.add(User.__table__, {
+            'id': owner_id, 'email': f'load.owner{owner_id}@example.com', 'code': '2',
+            'password': password_hash('rest123', f'load{owner_id}'), 'phone': str(7000000000 + owner_id)})
+        location = rng.choice(LOCATIONS)
+        inserter.add(Address.__table__, {
+            'user_id': owner_id, 'full_address': f'{rng.randint(1, 300)} {location} Market',
+            'city': 'Delhi', 'location': location})
+        opening_time, closing_time = rng.choice(timings)
+        inserter.add(Restaurant.__table__, {
+            'id': restaurant_id, 'user_id': owner_id,
+            'name': f'{rng.choice(RESTAURANT_WORDS)} {rng.choice(RESTAURANT_WORDS)} {restaurant_id}',
+            'description': f'Generated restaurant in {location}',
+            'opening_time': opening_time, 'closing_time': closing_time,
+            'rating': round(rng.uniform(3.0, 5.0), 1), 'rating_sum': 0, 'rating_count': 0})
+        menu = []
+        for _ in range(dishes_per_restaurant):
+            price = float(rng.randrange(40, 600, 10))
+            name = f'{rng.choice(DISH_WORDS)} {rng.choice(DISH_WORDS)}'
+            inserter.add(Food.__table__, {
+                'id': food_id, 'restaurant_id': restaurant_id, 'name': name, 'price': price,
+                'cuisine_id': rng.choice(cuisine_ids), 'category': rng.choice(CATEGORIES),
+                'is_special': rng.random() < 0.05, 'is_deal_of_day': rng.random() < 0.05,
+                'rating_sum': 0, 'rating_count': 0})
+            menu.append((food_id, price, name))
+            food_id += 1
+        menus[restaurant_id] = menu
+        restaurant_ids.append(restaurant_id)
+        restaurant_id += 1
+    inserter.flush()
+    if verbose:
+        print(f'{restaurants} restaurants with {restaurants * dishes_per_restaurant} dishes written')
+
+    # customers with their order history, reviews, carts and favourites
+    span = days * 24 * 60
+    for _ in range(customers):
+        customer_user_id = user_id
+        user_id += 1
+        inserter.add(User.__table__, {
+            'id': customer_user_id, 'email': f'load.customer{customer_user_id}@example.com', 'code': '1',
+            'password': password_hash('cust123', f'load{customer_user_id}'),
+            'phone': str(7000000000 + customer_user_id)})
+        inserter.add(Customer.__table__, {'id': customer_id, 'user_id': customer_user_id,
+                                          'name': f'Customer {customer_id}'})
+        location = rng.choice(LOCATIONS)
+        inserter.add(Address.__table__, {
+            'user_id': customer_user_id, 'full_address': f'House {rng.randint(1, 999)}, {location}',
+            'city': 'Delhi', 'location': location})
+
+        for _ in range(orders_per_customer):
+            rest_id = rng.choice(restaurant_ids)
+            menu = menus[rest_id]
+            order_time = anchor - timedelta(minutes=rng.randrange(span))
+            status = rng.choices('pdc', weights=(1, 8, 1))[0]
+            lines = rng.sample(menu, min(len(menu), rng.randint(1, max_items_per_order)))
+            total_price = 0.0
+            for line_food_id, price, name in lines:
+                quantity = rng.randint(1, 3)
+                total_price += price * quantity
+                inserter.add(OrderDetail.__table__, {
+                    'order_id': order_id, 'food_id': line_food_id, 'quantity': quantity,
+                    'unit_price': price, 'food_name': name})
+            inserter.add(OrderList.__table__, {
+                'id': order_id, 'customer_id': customer_id, 'restaurant_id': rest_id,
+                'total_price': total_price, 'status': status, 'order_time': order_time,
+                'delivery_time': order_time + timedelta(minutes=rng.randint(20, 60)) if status == 'd' else None})
+            if status == 'd' and rng.random() < review_ratio:
+                review_time = order_time + timedelta(hours=rng.randint(1, 48))
+                inserter.add(RestaurantReview.__table__, {
+                    'customer_id': customer_id, 'restaurant_id': rest_id, 'order_id': order_id,
+                    'rating': rng.randint(1, 5), 'review': 'Generated review', 'review_time': review_time})
+                inserter.add(DishReview.__table__, {
+                    'customer_id': customer_id, 'food_id': lines[0][0], 'order_id': order_id,
+                    'rating': rng.randint(1, 5), 'review': 'Generated review', 'review_time': review_time})
+            order_id += 1
+
+        cart_menu = menus[rng.choice(restaurant_ids)]
+        for line_food_id, _, _ in rng.sample(cart_menu, min(len(cart_menu), cart_lines)):
+            inserter.add(Cart.__table__, {'customer_id': customer_id, 'food_id': line_food_id,
+                                          'quantity': rng.randint(1, 3)})
+        for fav_restaurant_id in rng.sample(restaurant_ids, min(len(restaurant_ids), favourites)):
+            inserter.add(FavouriteRestaurant.__table__, {'customer_id': customer_id,
+                                                         'restaurant_id': fav_restaurant_id, 'mode': 'm'})
+        customer_id += 1
+
+    inserter.flush()
+    session.commit()
+
+    # reviews and orders were written outside the ORM, bring the aggregates up to date
+    backfill_rating_aggregates()
+    rebuild_search_index()
+    rebuild_order_stats()
+    rebuild_sales_rollups()
+
+    if verbose:
+        for table, count in inserter.counts.items():
+            print(f'{table:>20}: {count} rows')
+        print(f'Load data generated in {time.perf_counter() - started:.1f}s')
+    return inserter.counts
+
+
+def add_arguments(parser):
+    parser.add_argument('--customers', type=int, default=1000)
+    parser.add_argument('--restaurants', type=int, default=50)
+    parser.add_argument('--dishes-per-restaurant', type=int, default=20)
+    parser.add_argument('--orders-per-customer', type=int, default=10)
+    parser.add_argument('--max-items-per-order', type=int, default=4)
+    parser.add_argument('--review-ratio', type=float, default=0.2,
+                        help='share of delivered orders that get reviewed')
+    parser.add_argument('--cart-lines', type=int, default=2)
+    parser.add_argument('--favourites', type=int, default=2)
+    parser.add_argument('--days', type=int, default=365, help='order history span')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--chunk-size', type=int, default=50000)
+    return parser
+
+
+def options_from_args(args):
+    return {
+        'customers': args.customers,
+        'restaurants': args.restaurants,
+        'dishes_per_restaurant': args.dishes_per_restaurant,
+        'orders_per_customer': args.orders_per_customer,
+        'max_items_per_order': args.max_items_per_order,
+        'review_ratio': args.review_ratio,
+        'cart_lines': args.cart_lines,
+        'favourites': args.favourites,
+        'days': args.days,
+        'seed': args.seed,
+        'chunk_size': args.chunk_size,
+    }
+
+
+if __name__ == '__main__':
+    parser = add_arguments(argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter))
+    args = parser.parse_args()
+
+    from app import create_app, db
+
+    app = create_app()
+    with app.app_context():
+        generate_load_data(db, **options_from_args(args))
@@ -1,8 +1,15 @@
 from app import db, create_app
 from app.models import User, Customer, Restaurant, Food, Cuisine, OrderList, OrderDetail, Address, DishReview, RestaurantReview
 from datetime import datetime, timedelta
+import argparse
 import random
 from werkzeug.security import generate_password_hash
+from loadgen import add_arguments, options_from_args, generate_load_data
+
+# Load data options, e.g. python seed.py --load --customers 100000 --orders-per-customer 20
+parser = add_arguments(argparse.ArgumentParser(description="Seed demo data, optionally with synthetic load data"))
+parser.add_argument('--load', action='store_true', help='add synthetic load data after the demo data')
+args = parser.parse_args()
 
 app = create_app()
 app.app_context().push() 
@@ -152,4 +159,7 @@ addresses = [
 db.session.add_all(addresses)
 db.session.commit()
 
-print("Seeding completed successfully!")
\ No newline at end of file
+print("Seeding completed successfully!")
+
+if args.load:
+    generate_load_data(db, **options_from_args(args))
\ No newline at end of file
@@ -4,8 +4,14 @@ Simple unit tests for customer routes (UI layer)
 
 import unittest
 from app import create_app, db
-from app.models import User, Customer, Restaurant, Food, Cart, OrderList, Address, Cuisine
-from datetime import time
+from app.models import User, Customer, Restaurant, Food, Cart, OrderList, OrderDetail, Address, Cuisine
+from app.models import FoodSalesHourly, RestaurantSalesDaily
+from app.commands import backfill_order_snapshots, upgrade_existing_tables
+from app.sales import init_sales_rollups, rebuild_sales_rollups
+from app.order_feed import get_order_feed, order_event_data, publish_orders
+from tests.utils import count_queries
+from sqlalchemy import text
+from datetime import time, datetime, timedelta
 
 
 class TestRoutes(unittest.TestCase):
@@ -134,3 +140,398 @@ class TestRoutes(unittest.TestCase):
         # Check order was cancelled
         cancelled_order = OrderList.query.get(order.id)
         self.assertEqual(cancelled_order.status, 'c')
+
+    def test_13_view_restaurants_query_budget(self):
+        """Test 13: Restaurants page query count does not grow with restaurants"""
+        self.login()
+        db.session.expire_all()
+        with count_queries() as queries:
+            self.client.get('/customer/view_restaurants')
+        baseline = len(queries)
+
+        for i in range(30):
+            db.session.add(Restaurant(
+                user_id=self.rest_user.id, name=f'Restaurant {i}',
+                opening_time=time(9, 0), closing_time=time(22, 0), rating=4.0
+            ))
+        db.session.commit()
+
+        with count_queries() as queries:
+            response = self.client.get('/customer/view_restaurants')
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(queries), baseline)
+
+    def test_18_sql_instrumentation(self):
+        """Test 18: Requests report their SQL stats and log slow queries"""
+        self.login()
+        self.app.config['SQL_STATS_HEADERS'] = True
+        db.session.expire_all()
+        with count_queries() as queries:
+            response = self.client.get('/customer/view_restaurants')
+        self.assertEqual(int(response.headers['X-SQL-Query-Count']), len(queries))
+        self.assertGreaterEqual(float(response.headers['X-SQL-Time-Ms']), 0)
+        self.assertIn('X-SQL-Slowest-1', response.headers)
+
+        # tests keep the per-request line off, bound values are only logged on request
+        self.app.config['SQL_STATS_HEADERS'] = False
+        self.app.config['SLOW_QUERY_THRESHOLD_MS'] = 0
+        with self.assertLogs('app.instrumentation', level='INFO') as logs:
+            response = self.client.get('/customer/view_restaurants')
+        self.assertNotIn('X-SQL-Query-Count', response.headers)
+        self.assertTrue(any('Slow query' in line for line in logs.output))
+        self.assertFalse(any('params=' in line or 'request_sql' in line for line in logs.output))
+
+        self.app.config['SQL_REQUEST_LOG'] = True
+        self.app.config['SQL_LOG_PARAMETERS'] = True
+        with self.assertLogs('app.instrumentation', level='INFO') as logs:
+            self.client.get('/customer/view_restaurants')
+        self.assertTrue(any('Slow query' in line and 'params=' in line for line in logs.output))
+        self.assertTrue(any('"event": "request_sql"' in line for line in logs.output))
+
+    def test_20_order_detail_price_snapshot(self):
+        """Test 20: Order details show the dish as it was sold"""
+        self.login()
+        db.session.add(Cart(customer_id=self.customer.id, food_id=self.food.id, quantity=2))
+        db.session.commit()
+        self.client.post('/customer/order')
+        order = OrderList.query.filter_by(customer_id=self.customer.id).first()
+
+        self.food.name = 'Renamed Pizza'
+        self.food.price = 99.0
+        db.session.commit()
+
+        response = self.client.get(f'/customer/order_detail/{order.id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Pizza', response.data)
+        self.assertIn('₹10.0'.encode(), response.data)
+        self.assertNotIn(b'Renamed Pizza', response.data)
+
+        # lines written before the snapshot columns get the current dish
+        db.session.add(OrderDetail(order_id=order.id, food_id=self.food.id, quantity=1))
+        db.session.commit()
+        self.assertIn(b'Renamed Pizza', self.client.get(f'/customer/order_detail/{order.id}').data)
+        self.assertEqual(backfill_order_snapshots(), 1)
+        legacy = OrderDetail.query.filter_by(order_id=order.id).order_by(OrderDetail.id.desc()).first()
+        self.assertEqual((legacy.food_name, legacy.unit_price), ('Renamed Pizza', 99.0))
+
+        # databases created before the snapshot columns get them, filled, at startup,
+        # before the empty sales rollups are rebuilt from them
+        db.session.execute(text('DROP INDEX ix_order_detail_order_food'))
+        for column in ('unit_price', 'food_name'):
+            db.session.execute(text(f'ALTER TABLE order_detail DROP COLUMN {column}'))
+        db.session.execute(FoodSalesHourly.__table__.delete())
+        db.session.execute(RestaurantSalesDaily.__table__.delete())
+        db.session.commit()
+        upgrade_existing_tables()
+        init_sales_rollups(self.app)
+        self.assertEqual(db.session.query(db.func.sum(FoodSalesHourly.revenue)).scalar(), 3 * 99.0)
+
+    def test_22_order_history_search_in_sql(self):
+        """Test 22: Restaurant name search is one query per page, not one per order"""
+        other = Restaurant(user_id=self.rest_user.id, name='Other Diner',
+                           opening_time=time(9, 0), closing_time=time(22, 0), rating=4.0)
+        db.session.add(other)
+        db.session.flush()
+        start = datetime(2025, 1, 1, 12, 0)
+        for i in range(60):
+            db.session.add(OrderList(customer_id=self.customer.id,
+                                     restaurant_id=(self.restaurant.id, other.id)[i % 2],
+                                     total_price=10.0 + i, status='d',
+                                     order_time=start + timedelta(minutes=i)))
+        db.session.commit()
+        self.login()
+
+        db.session.expire_all()
+        with count_queries() as queries:
+            response = self.client.get('/customer/view_order_history?order_restaurant=oTHER')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.count(b'order-row'), 20)
+        self.assertEqual(response.data.count(b'Other Diner'), 20)
+        self.assertNotIn(b'Test Restaurant', response.data)
+        self.assertIn(b'cursor=', response.data)
+        self.assertLess(len(queries), 15)
+
+        response = self.client.get('/customer/view_order_history?order_restaurant=nothing')
+        self.assertEqual(response.data.count(b'order-row'), 0)
+        # the tab counts follow the search
+        self.assertIn(b'<span class="badge bg-secondary-subtle text-secondary ms-1">0</span>', response.data)
+        self.assertNotIn(b'>60</span>', response.data)
+
+        self.client.get('/auth/logout')
+        self.client.post('/auth/login', data={'email': 'rest@test.com', 'password': 'test'})
+        response = self.client.get('/restaurant/view_orders?order_restaurant=oTHER')
+        self.assertIn(b'>30</span>', response.data)
+        self.assertNotIn(b'>60</span>', response.data)
+
+    def test_24_autocomplete_from_memory(self):
+        """Test 24: Autocomplete suggestions come from memory and follow menu edits"""
+        self.login()
+        response = self.client.get('/customer/autocomplete?q=piz')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['suggestions'],
+                         [{'text': 'Pizza', 'kind': 'dish', 'restaurant_id': None}])
+
+        # no catalogue query per keystroke, typos within a word are tolerated
+        db.session.expire_all()
+        with count_queries() as queries:
+            suggestions = self.client.get('/customer/autocomplete?q=tset+resta').get_json()['suggestions']
+        self.assertEqual([s['restaurant_id'] for s in suggestions], [self.restaurant.id])
+        self.assertEqual([q for q in queries if 'FROM user' not in q], [])
+
+        # committed menu edits show up, rolled back ones do not
+        db.session.add(Food(restaurant_id=self.restaurant.id, name='Pizza Bianca', price=12.0,
+                            cuisine_id=self.cuisine.id, category='Main'))
+        db.session.commit()
+        self.food.name = 'Calzone'
+        db.session.flush()
+        db.session.rollback()
+        response = self.client.get('/customer/autocomplete?q=PIZZ&limit=1')
+        self.assertEqual([s['text'] for s in response.get_json()['suggestions']], ['Pizza'])
+        response = self.client.get('/customer/autocomplete?q=pizza+bia')
+        self.assertEqual([s['text'] for s in response.get_json()['suggestions']], ['Pizza Bianca'])
+        response = self.client.get('/customer/autocomplete?q=calz')
+        self.assertEqual(response.get_json()['suggestions'], [])
+        self.assertEqual(self.client.get('/customer/autocomplete').get_json()['suggestions'], [])
+
+    def test_28_menu_projection_query_budget(self):
+        """Test 28: Restaurant menu pages cost the same number of queries for any menu size"""
+        self.client.post('/auth/login', data={'email': 'rest@test.com', 'password': 'test'})
+        restaurant_id = self.restaurant.id
+        db.session.expire_all()
+        with count_queries() as queries:
+            self.client.get('/restaurant/view_menu')
+        baseline = len(queries)
+
+        dishes = [Food(restaurant_id=restaurant_id, name=f'Dish {i}', price=5.0 + i,
+                       cuisine_id=self.cuisine.id, category='Main') for i in range(30)]
+        db.session.add_all(dishes)
+        db.session.flush()
+        # three order lines in the last 24h make a dish mostly ordered, older ones do not count
+        for hours_ago in (1, 2, 3, 30):
+            order = OrderList(customer_id=self.customer.id, restaurant_id=restaurant_id, total_price=6.0,
+                              status='d', order_time=datetime.now() - timedelta(hours=hours_ago))
+            db.session.add(order)
+            db.session.flush()
+            db.session.add(OrderDetail(order_id=order.id, food_id=dishes[1 if hours_ago < 24 else 2].id,
+                                       quantity=1))
+        db.session.commit()
+
+        db.session.expire_all()
+        for url in ('/restaurant/view_menu', f'/restaurant/restaurant/{restaurant_id}/menu'):
+            with count_queries() as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(queries), baseline)
+            page = response.get_data(as_text=True)
+            self.assertIn('Italian', page)
+            self.assertEqual(page.count('bi-graph-up'), 1)
+
+    def test_29_identity_from_session(self):
+        """Test 29: Logged in requests take the user's role and ids from the signed session"""
+        self.login()
+        self.client.get('/customer/view_cart')
+        # a fresh app context per request, as on the server
+        with self.app.app_context(), count_queries() as queries:
+            response = self.client.get('/customer/view_cart')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([q for q in queries if 'FROM customer' in q], [])
+        self.assertEqual(len([q for q in queries if 'FROM user' in q]), 1)
+
+        # without the session cache the user and its identity are loaded once per request
+        self.app.config['IDENTITY_SESSION_MAX_AGE'] = 0
+        with self.app.app_context(), count_queries() as queries:
+            self.client.get('/customer/view_cart')
+        self.assertEqual(len([q for q in queries if 'FROM user' in q or 'FROM customer' in q]), 2)
+        self.app.config['IDENTITY_SESSION_MAX_AGE'] = 300
+
+        # an owner adding a restaurant gets a fresh identity, logging out drops it
+        self.client.get('/auth/logout')
+        self.client.post('/auth/login', data={'email': 'rest@test.com', 'password': 'test'})
+        with self.app.app_context():
+            self.client.get('/restaurant/view_menu')
+        with self.client.session_transaction() as session:
+            self.assertEqual(session['identity']['restaurant_ids'], [self.restaurant.id])
+        with self.app.app_context():
+            self.client.post('/restaurant/restaurant/add', data={
+                'name': 'Second Place', 'opening_time': '09:00', 'closing_time': '22:00', 'location': 'Uptown'})
+            self.client.get('/restaurant/view_menu')
+        second = Restaurant.query.filter_by(name='Second Place').one()
+        with self.client.session_transaction() as session:
+            self.assertEqual(session['identity']['restaurant_ids'], [self.restaurant.id, second.id])
+        self.client.get('/auth/logout')
+        with self.client.session_transaction() as session:
+            self.assertNotIn('identity', session)
+
+        # a role change or a deletion made by another session is seen at the next request
+        self.client.post('/auth/login', data={'email': 'rest@test.com', 'password': 'test'})
+        with self.app.app_context():
+            self.assertEqual(self.client.get('/restaurant/view_menu').status_code, 200)
+        db.session.execute(db.update(User).where(User.id == self.rest_user.id).values(code='1'))
+        db.session.commit()
+        with self.app.app_context():
+            self.assertEqual(self.client.get('/restaurant/view_menu').status_code, 403)
+        db.session.execute(db.delete(User).where(User.id == self.rest_user.id))
+        db.session.commit()
+        with self.app.app_context():
+            response = self.client.get('/restaurant/view_menu')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/auth/login', response.location)
+
+    def test_31_cart_json_api(self):
+        """Test 31: Cart buttons update the line in place through the JSON cart API"""
+        self.login()
+        food_id = self.food.id
+        self.assertIn(f'/customer/api/cart/{food_id}',
+                      self.client.get(f'/customer/view_restaurant?restaurant_id={self.restaurant.id}').get_data(as_text=True))
+
+        with count_queries() as queries:
+            response = self.client.post(f'/customer/api/cart/{food_id}', json={'action': 'add'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['line'], {'food_id': food_id, 'quantity': 1, 'price': 10.0, 'total': 10.0})
+        self.assertLessEqual(len([q for q in queries if 'INSERT INTO cart' in q or 'FROM cart' in q]), 2)
+
+        data = self.client.post(f'/customer/api/cart/{food_id}', json={'action': 'add'}).get_json()
+        self.assertEqual((data['line']['quantity'], data['cart']), (2, {'items': 2, 'total': 20.0}))
+        self.assertEqual(Cart.query.filter_by(customer_id=self.customer.id).one().quantity, 2)
+        data = self.client.post(f'/customer/api/cart/{food_id}', json={'action': 'subtract'}).get_json()
+        self.assertEqual(data['cart'], {'items': 1, 'total': 10.0})
+        data = self.client.post(f'/customer/api/cart/{food_id}', json={'action': 'subtract'}).get_json()
+        self.assertEqual((data['line']['quantity'], data['cart']['items']), (0, 0))
+        self.assertEqual(Cart.query.filter_by(customer_id=self.customer.id).count(), 0)
+
+        response = self.client.post(f'/customer/api/cart/{food_id}', json={'action': 'subtract'})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.post('/customer/api/cart/9999').status_code, 404)
+        self.assertEqual(self.client.post(f'/customer/api/cart/{food_id}', json={'action': 'x'}).status_code, 400)
+
+    def test_33_dashboard_sales_rollups(self):
+        """Test 33: The dashboard reads sales and best sellers from the rollups kept by the order writes"""
+        self.client.post('/auth/login', data={'email': 'rest@test.com', 'password': 'test'})
+        db.session.expire_all()
+        with count_queries() as queries:
+            self.client.get('/restaurant/')
+        baseline = len(queries)
+
+        now = datetime.now()
+        for order_time, price, status in [(now, 10.0, 'p'), (now, 10.0, 'p'), (now, 10.0, 'p'),
+                                          (now, 7.0, 'c'), (now - timedelta(days=3), 20.0, 'd')]:
+            order = OrderList(customer_id=self.customer.id, restaurant_id=self.restaurant.id,
+                              total_price=price, status=status, order_time=order_time)
+            db.session.add(order)
+            db.session.flush()
+            db.session.add(OrderDetail(order_id=order.id, food_id=self.food.id, quantity=1, unit_price=price))
+        db.session.commit()
+        OrderList.query.filter_by(status='p').first().status = 'd'
+        db.session.commit()
+
+        db.session.expire_all()
+        with count_queries() as queries:
+            page = self.client.get('/restaurant/').get_data(as_text=True)
+        self.assertLessEqual(len(queries), baseline)
+        # cancelled orders are not sales, their lines still count for the best sellers
+        self.assertIn('<strong>3</strong> orders today', page)
+        self.assertIn('Today <strong>₹30.0</strong>', page)
+        self.assertIn('7 days <strong>₹50.0</strong>', page)
+        self.assertIn('Pizza (4)', page)
+
+        # incremental rollups agree with a rebuild from the order tables
+        def rollups():
+            return (sorted(db.session.query(RestaurantSalesDaily.day, RestaurantSalesDaily.status,
+                                            RestaurantSalesDaily.order_count, RestaurantSalesDaily.revenue
+                                            ).filter(RestaurantSalesDaily.order_count != 0)),
+                    sorted(db.session.query(FoodSalesHourly.hour, FoodSalesHourly.food_id,
+                                            FoodSalesHourly.order_count, FoodSalesHourly.quantity)))
+        incremental = rollups()
+        rebuild_sales_rollups()
+        self.assertEqual(rollups(), incremental)
+
+    def test_34_restaurant_analytics_api(self):
+        """Test 34: Restaurant analytics are computed over any window from the order columns"""
+        self.client.post('/auth/login', data={'email': 'rest@test.com', 'password': 'test'})
+        restaurant_id = self.restaurant.id
+        salad = Food(restaurant_id=restaurant_id, name='Salad', price=4.0, cuisine_id=self.cuisine.id,
+                     category='Starter')
+        db.session.add(salad)
+        day = datetime(2026, 3, 2, 12, 0)
+        # (placed, minutes to deliver, status, [(dish, quantity)])
+        for placed, minutes, status, dishes in [
+                (day, 30, 'd', [(self.food, 2)]),
+                (day + timedelta(hours=1), 50, 'd', [(self.food, 1), (salad, 3)]),
+                (day + timedelta(days=1), None, 'p', [(salad, 1)]),
+                (day + timedelta(days=1), None, 'c', [(self.food, 5)]),
+                (day + timedelta(days=9), 10, 'd', [(salad, 1)])]:
+            order = OrderList(customer_id=self.customer.id, restaurant_id=restaurant_id, status=status,
+                              total_price=sum(food.price * quantity for food, quantity in dishes),
+                              order_time=placed,
+                              delivery_time=placed + timedelta(minutes=minutes) if minutes else None)
+            db.session.add(order)
+            db.session.flush()
+            db.session.add_all([OrderDetail(order_id=order.id, food_id=food.id, quantity=quantity,
+                                            unit_price=food.price) for food, quantity in dishes])
+        db.session.commit()
+        food_id, salad_id = self.food.id, salad.id
+        url = f'/restaurant/api/restaurant/{restaurant_id}/analytics'
+
+        with count_queries() as queries:
+            data = self.client.get(f'{url}?start=2026-03-01&end=2026-03-05').get_json()
+        self.assertLessEqual(len([q for q in queries if 'order_list' in q]), 2)
+        self.assertEqual(data['orders'], {'p': 1, 'd': 2, 'c': 1, 'total': 4})
+        self.assertEqual((data['revenue'], data['sales']), (42.0, 46.0))
+        self.assertEqual(data['average_basket_size'], 2.33)
+        self.assertEqual(data['delivery_minutes'], {'average': 40.0, 'median': 40.0, 'p90': 48.0})
+        self.assertEqual([(bucket['orders'], bucket['sales']) for bucket in data['series']],
+                         [(0, 0.0), (2, 42.0), (1, 4.0), (0, 0.0)])
+        # the cancelled order's pizzas are not sold
+        self.assertEqual([(dish['food_id'], dish['quantity'], dish['sales']) for dish in data['top_dishes']],
+                         [(salad_id, 4, 16.0), (food_id, 3, 30.0)])
+
+        data = self.client.get(f'{url}?start=2026-03-02T12:30:00&end=2026-03-02T14:00:00&bucket=hour').get_json()
+        self.assertEqual([bucket['orders'] for bucket in data['series']], [1, 0])
+        self.assertEqual(self.client.get(f'{url}?start=2026-03-20&end=2026-03-01').status_code, 400)
+        self.assertEqual(self.client.get(f'{url}?start=yesterday').status_code, 400)
+        self.assertEqual(self.client.get(f'{url}?bucket=minute').status_code, 400)
+        self.assertEqual(self.client.get(f'{url}?start=2000-01-01&bucket=hour').status_code, 400)
+
+        # customers are turned away
+        self.client.get('/auth/logout')
+        self.login()
+        self.assertNotEqual(self.client.get(url).status_code, 200)
+
+    def test_35_live_order_feed(self):
+        """Test 35: Checkout, delivery and cancellation are pushed to the owner's order stream"""
+        restaurant_id = self.restaurant.id
+        other_user = User(email='other@test.com', code='2', phone='5550001111', password='x')
+        db.session.add(other_user)
+        db.session.flush()
+        other = Restaurant(user_id=other_user.id, name='Other', opening_time=time(9, 0), closing_time=time(22, 0))
+        db.session.add(other)
+        db.session.add(Cart(customer_id=self.customer.id, food_id=self.food.id, quantity=2))
+        db.session.commit()
+        other_id = other.id
+        live = get_order_feed().subscribe([restaurant_id])
+
+        self.login()
+        self.client.post('/customer/order')
+        order_id = OrderList.query.one().id
+        self.client.get('/auth/logout')
+        publish_orders('placed', [order_event_data(999, other_id, self.customer.id, 'p', 5.0, datetime.now())])
+        self.client.post('/auth/login', data={'email': 'rest@test.com', 'password': 'test'})
+        self.client.get(f'/restaurant/mark_order_as_delivered?order_id={order_id}')
+
+        placed, delivered = live.get(1), live.get(1)
+        self.assertEqual((placed['type'], placed['order']['id'], placed['order']['total_price']), ('placed', order_id, 20.0))
+        self.assertEqual((delivered['type'], delivered['order']['status']), ('status', 'd'))
+        self.assertIsNone(live.get(0))
+        live.close()
+
+        # a reconnecting browser gets what it missed, then the stream ends
+        self.app.config['ORDER_FEED_STREAM_SECONDS'] = 0
+        response = self.client.get('/restaurant/api/orders/stream', headers={'Last-Event-ID': '0'})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        body = response.get_data(as_text=True)
+        self.assertEqual(body.count('event: placed'), 1)
+        self.assertIn(f'id: {delivered["id"]}\nevent: status\n', body)
+        body = self.client.get(f'/restaurant/api/orders/stream?last_event_id={placed["id"]}').get_data(as_text=True)
+        self.assertNotIn('event: placed', body)
+        self.assertEqual(self.client.get(f'/restaurant/api/orders/stream?restaurant_id={other_id}').status_code, 403)
+        self.assertIn('/restaurant/api/orders/stream', self.client.get('/restaurant/view_orders').get_data(as_text=True))
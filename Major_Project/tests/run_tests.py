@@ -15,31 +15,62 @@ from tests.services.test_services import TestServices
 
 
 def run_all_tests():
-    """Run all 11 essential customer tests"""
+    """Run all essential customer tests"""
     
     print("="*60)
-    print("RUNNING 11 ESSENTIAL CUSTOMER TESTS")
+    print("RUNNING ESSENTIAL CUSTOMER TESTS")
     print("="*60)
     
     # Create test suite
     suite = unittest.TestSuite()
     
-    # Add UI tests (4 tests)
+    # Add UI tests (7 tests)
     suite.addTest(TestRoutes('test_1_view_restaurants_needs_auth'))
     suite.addTest(TestRoutes('test_2_view_restaurants_success'))
     suite.addTest(TestRoutes('test_3_add_to_cart'))
     suite.addTest(TestRoutes('test_4_place_order'))
-
-    # Add new restaurant-related UI tests (3 tests)
     suite.addTest(TestRoutes('test_5_view_restaurant_detail'))
     suite.addTest(TestRoutes('test_6_view_order_history'))
     suite.addTest(TestRoutes('test_7_cancel_order'))
 
-    # Add service tests (4 tests)  
+    # Add page query budget tests (3 tests)
+    suite.addTest(TestRoutes('test_13_view_restaurants_query_budget'))
+    suite.addTest(TestRoutes('test_28_menu_projection_query_budget'))
+    suite.addTest(TestRoutes('test_33_dashboard_sales_rollups'))
+
+    # Add route feature tests (8 tests)
+    suite.addTest(TestRoutes('test_18_sql_instrumentation'))
+    suite.addTest(TestRoutes('test_20_order_detail_price_snapshot'))
+    suite.addTest(TestRoutes('test_22_order_history_search_in_sql'))
+    suite.addTest(TestRoutes('test_24_autocomplete_from_memory'))
+    suite.addTest(TestRoutes('test_29_identity_from_session'))
+    suite.addTest(TestRoutes('test_31_cart_json_api'))
+    suite.addTest(TestRoutes('test_34_restaurant_analytics_api'))
+    suite.addTest(TestRoutes('test_35_live_order_feed'))
+
+    # Add service tests (4 tests)
     suite.addTest(TestServices('test_8_get_customer_id'))
     suite.addTest(TestServices('test_9_get_restaurant_list'))
     suite.addTest(TestServices('test_10_add_to_cart_service'))
     suite.addTest(TestServices('test_11_place_order_service'))
+
+    # Add service query budget tests (5 tests)
+    suite.addTest(TestServices('test_12_restaurant_listing_single_query'))
+    suite.addTest(TestServices('test_14_menu_view_batched_aggregates'))
+    suite.addTest(TestServices('test_19_place_order_set_based'))
+    suite.addTest(TestServices('test_25_filter_facet_counts'))
+    suite.addTest(TestServices('test_32_order_stats_rollup'))
+
+    # Add data layer and cache tests (9 tests)
+    suite.addTest(TestServices('test_15_rating_aggregates_maintained_on_review'))
+    suite.addTest(TestServices('test_16_hot_path_indexes'))
+    suite.addTest(TestServices('test_17_load_generator_deterministic'))
+    suite.addTest(TestServices('test_21_order_history_keyset_pagination'))
+    suite.addTest(TestServices('test_23_full_text_search_index'))
+    suite.addTest(TestServices('test_26_filter_index_matches_sql'))
+    suite.addTest(TestServices('test_27_reference_data_cache'))
+    suite.addTest(TestServices('test_30_cart_store_write_behind'))
+    suite.addTest(TestServices('test_36_order_event_bus'))
     
     # Run tests
     runner = unittest.TextTestRunner(verbosity=2)
@@ -2,13 +2,39 @@
 Simple unit tests for services (Business logic)
 """
 
+import threading
 import unittest
 from app import create_app, db
-from app.models import User, Customer, Restaurant, Food, Cart, OrderList, Address, Cuisine
+from app.models import (
+    User, Customer, Restaurant, Food, Cart, OrderList, Address, Cuisine,
+    FavouriteRestaurant, DishReview, RestaurantReview
+)
+from app.models import OrderDetail
+from app.commands import backfill_rating_aggregates, upgrade_existing_tables
+from loadgen import generate_load_data
+from app.customer.services import (
+    get_customer_id_from_user_id, add_to_cart, place_order, get_restaurant_list,
+    get_restaurant_listing, build_menu_view, get_dish_reviews_page,
+    add_restaurant_to_favourite, get_order_history_page, get_restaurant_facets,
+    subtract_from_cart, remove_from_cart, split_cart_by_restaurant, cancel_order_by_customer
+)
+from app.pagination import get_order_status_counts
+from app.search import rebuild_search_index, search_restaurants
+from app.filter_index import CACHED_MINIMUMS, get_filter_index, get_indexed_facets, match_restaurant_ids
+from app.cart_store import get_cart, init_cart_store, persist_dirty_carts
+from app.order_stats import get_restaurant_order_stats, rebuild_order_stats
+from app.order_events import ORDER_PLACED, OrderEvent, OrderEventBus, get_order_events
+from app.restaurant.services import get_order_count_for_restaurant
+from app.models import RestaurantOrderStats
+from app.reference_data import (
+    RedisBackend, ReferenceCache, get_cuisine_by_name, get_cuisines, get_restaurant_locations
+)
 from app.customer.services import (
-    get_customer_id_from_user_id, add_to_cart, place_order, get_restaurant_list
+    RATING_FACETS, PRICE_FACETS, get_restaurant_filter_conditions
 )
-from datetime import time
+from sqlalchemy import event, text
+from tests.utils import count_queries
+from datetime import time, datetime, timedelta
 
 
 class TestServices(unittest.TestCase):
@@ -100,3 +126,588 @@ class TestServices(unittest.TestCase):
         order = OrderList.query.filter_by(customer_id=self.customer.id).first()
         self.assertIsNotNone(order)
         self.assertEqual(order.total_price, 10.0)
+
+    def test_12_restaurant_listing_single_query(self):
+        """Test 12: Restaurant listing is one query regardless of restaurant count"""
+        for i in range(20):
+            db.session.add(Restaurant(
+                user_id=self.rest_user.id, name=f'Restaurant {i}',
+                opening_time=time(0, 0), closing_time=time(23, 59), rating=4.0
+            ))
+        db.session.flush()
+        last = Restaurant.query.order_by(Restaurant.id.desc()).first()
+        db.session.add(FavouriteRestaurant(
+            customer_id=self.customer.id, restaurant_id=last.id, mode='m'))
+        db.session.commit()
+        customer_id, last_id = self.customer.id, last.id
+
+        with count_queries() as queries:
+            listing = get_restaurant_listing(customer_id)
+
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(len(listing), 21)
+        self.assertEqual(listing[0]['id'], last_id)
+        self.assertTrue(listing[0]['is_favorite'])
+        self.assertFalse(listing[1]['is_favorite'])
+        self.assertEqual(listing[1]['location'], 'Downtown')
+
+    def test_14_menu_view_batched_aggregates(self):
+        """Test 14: Menu view loads cart and review aggregates in one query"""
+        order = OrderList(customer_id=self.customer.id, restaurant_id=self.restaurant.id,
+                          total_price=10.0, status='d')
+        db.session.add(order)
+        for i in range(10):
+            db.session.add(Food(restaurant_id=self.restaurant.id, name=f'Dish {i}',
+                                price=5.0, cuisine_id=self.cuisine.id, category='Main'))
+        db.session.flush()
+        for rating in (4, 5, 5):
+            db.session.add(DishReview(customer_id=self.customer.id, food_id=self.food.id,
+                                      order_id=order.id, rating=rating, review='good'))
+        db.session.add(Cart(customer_id=self.customer.id, food_id=self.food.id, quantity=2))
+        db.session.commit()
+        restaurant_id, customer_id, food_id = self.restaurant.id, self.customer.id, self.food.id
+
+        with count_queries() as queries:
+            menu = build_menu_view(restaurant_id, customer_id)
+
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(len(menu), 11)
+        pizza = next(item for item in menu if item['id'] == food_id)
+        self.assertEqual(pizza['quantity'], 2)
+        self.assertEqual(pizza['review_count'], 3)
+        self.assertEqual(pizza['avg_dish_rating'], 4.7)
+
+        reviews, has_next = get_dish_reviews_page(food_id, page=1, per_page=2)
+        self.assertEqual(len(reviews), 2)
+        self.assertTrue(has_next)
+        reviews, has_next = get_dish_reviews_page(food_id, page=2, per_page=2)
+        self.assertEqual(len(reviews), 1)
+        self.assertFalse(has_next)
+
+    def test_15_rating_aggregates_maintained_on_review(self):
+        """Test 15: Reviews keep the materialized ratings current"""
+        order = OrderList(customer_id=self.customer.id, restaurant_id=self.restaurant.id,
+                          total_price=10.0, status='d')
+        db.session.add(order)
+        db.session.flush()
+        for rating in (2, 3):
+            db.session.add(RestaurantReview(customer_id=self.customer.id, order_id=order.id,
+                                            restaurant_id=self.restaurant.id, rating=rating))
+            db.session.add(DishReview(customer_id=self.customer.id, order_id=order.id,
+                                      food_id=self.food.id, rating=rating + 2))
+        db.session.commit()
+
+        self.assertEqual((self.restaurant.rating_sum, self.restaurant.rating_count), (5, 2))
+        self.assertEqual(self.restaurant.rating, 2.5)
+        self.assertEqual(self.food.average_rating, 4.5)
+        self.assertEqual(get_restaurant_list(self.customer.id, min_rating=3), [])
+
+        # rows written outside the ORM are fixed up by the backfill
+        db.session.execute(RestaurantReview.__table__.delete().where(RestaurantReview.rating == 2))
+        db.session.commit()
+        backfill_rating_aggregates()
+        self.assertEqual((self.restaurant.rating_count, self.restaurant.rating), (1, 3.0))
+        self.assertEqual(self.food.rating_count, 2)
+
+        # databases created before the aggregates get the columns, filled, at startup
+        for table in ('food', 'restaurant'):
+            for column in ('rating_sum', 'rating_count'):
+                db.session.execute(text(f'ALTER TABLE {table} DROP COLUMN {column}'))
+        db.session.commit()
+        upgrade_existing_tables()
+        db.session.expire_all()
+        self.assertEqual((self.food.rating_sum, self.food.rating_count), (9, 2))
+        self.assertEqual(self.restaurant.rating_count, 1)
+
+    def test_16_hot_path_indexes(self):
+        """Test 16: Hot path lookups use the composite indexes"""
+        plan = db.session.execute(text(
+            "EXPLAIN QUERY PLAN SELECT * FROM order_list WHERE customer_id = 1 AND status = 'p'"
+        )).all()
+        self.assertIn('ix_order_list_customer_status', str(plan))
+        plan = db.session.execute(text(
+            "EXPLAIN QUERY PLAN SELECT * FROM cart WHERE customer_id = 1 AND food_id = 1"
+        )).all()
+        self.assertIn('uq_cart_customer_food', str(plan))
+
+        # favourites are unique per customer and restaurant
+        add_restaurant_to_favourite(self.restaurant.id, self.customer.id)
+        success, _ = add_restaurant_to_favourite(self.restaurant.id, self.customer.id)
+        self.assertTrue(success)
+        self.assertEqual(FavouriteRestaurant.query.count(), 1)
+
+    def test_17_load_generator_deterministic(self):
+        """Test 17: Load generator writes the requested rows, same seed same data"""
+        options = dict(customers=5, restaurants=2, dishes_per_restaurant=3,
+                       orders_per_customer=4, seed=7, anchor=datetime(2025, 1, 1), verbose=False)
+
+        runs = []
+        for _ in range(2):
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+            counts = generate_load_data(db, **options)
+            self.assertEqual(counts['order_list'], 20)
+            self.assertEqual(counts['food'], 6)
+            self.assertEqual(OrderDetail.query.count(), counts['order_detail'])
+            runs.append([tuple(row) for row in db.session.execute(
+                db.select(OrderList.__table__).order_by(OrderList.id)).all()])
+        self.assertEqual(runs[0], runs[1])
+
+    def test_19_place_order_set_based(self):
+        """Test 19: Checkout is a fixed number of queries and drains the cart once"""
+        other = Restaurant(user_id=self.rest_user.id, name='Other Restaurant',
+                           opening_time=time(9, 0), closing_time=time(22, 0), rating=4.0)
+        db.session.add(other)
+        db.session.flush()
+        dishes = [Food(restaurant_id=restaurant_id, name=f'Dish {i}', price=5.0,
+                       cuisine_id=self.cuisine.id, category='Main')
+                  for i, restaurant_id in enumerate([self.restaurant.id, other.id] * 3)]
+        db.session.add_all(dishes)
+        db.session.flush()
+        db.session.add(Cart(customer_id=self.customer.id, food_id=self.food.id, quantity=2))
+        db.session.add_all([Cart(customer_id=self.customer.id, food_id=dish.id, quantity=1)
+                            for dish in dishes])
+        db.session.commit()
+        customer_id, restaurant_id, other_id = self.customer.id, self.restaurant.id, other.id
+
+        # the event consumers run after the checkout, off the request outside tests
+        bus = get_order_events()
+        consumers, published = bus.consumers, []
+        bus.consumers = []
+        bus.register(published.append)
+        try:
+            with count_queries() as queries:
+                success, message = place_order(customer_id)
+        finally:
+            bus.consumers = consumers
+        self.assertTrue(success)
+        # cart read, cart drain, order insert, detail insert
+        self.assertLessEqual(len(queries), 4)
+        with count_queries() as queries:
+            bus.publish(published[0])
+        # order stats, daily and hourly sales upserts, automatic favourites
+        self.assertLessEqual(len(queries), 4)
+        self.assertEqual(get_restaurant_order_stats([restaurant_id, other_id]).pending, 2)
+
+        totals = dict(db.session.query(OrderList.restaurant_id, OrderList.total_price).all())
+        self.assertEqual(totals, {restaurant_id: 35.0, other_id: 15.0})
+        self.assertEqual(OrderDetail.query.count(), 7)
+        self.assertEqual(Cart.query.filter_by(customer_id=customer_id).count(), 0)
+
+        # a second submit drains part of the cart between our read and our delete
+        db.session.add_all([Cart(customer_id=customer_id, food_id=dish.id, quantity=1)
+                            for dish in dishes[:2]])
+        db.session.commit()
+
+        def concurrent_checkout(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('DELETE FROM cart'):
+                cursor.connection.execute('DELETE FROM cart WHERE food_id = ?', (dishes[0].id,))
+
+        event.listen(db.engine, 'before_cursor_execute', concurrent_checkout)
+        try:
+            success, message = place_order(customer_id)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', concurrent_checkout)
+        self.assertFalse(success)
+        self.assertEqual(OrderList.query.count(), 2)
+
+    def test_21_order_history_keyset_pagination(self):
+        """Test 21: Order history pages walk all orders newest first, per status"""
+        start = datetime(2025, 1, 1, 12, 0)
+        for i in range(45):
+            # pairs of orders share an order time, the id breaks the tie
+            db.session.add(OrderList(customer_id=self.customer.id, restaurant_id=self.restaurant.id,
+                                     total_price=10.0, status='pdc'[i % 3],
+                                     order_time=start + timedelta(minutes=i // 2)))
+        db.session.commit()
+        customer_id = self.customer.id
+
+        seen, cursor = [], None
+        while True:
+            page = get_order_history_page(customer_id, cursor=cursor)
+            self.assertLessEqual(len(page.items), 20)
+            seen.extend((order.order_time, order.id) for order in page.items)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(len(seen), 45)
+        self.assertEqual(seen, sorted(seen, reverse=True))
+
+        pending = get_order_history_page(customer_id, status='p', per_page=100)
+        self.assertEqual(len(pending.items), 15)
+        self.assertTrue(all(order.status == 'p' for order in pending.items))
+        self.assertEqual(get_order_status_counts(OrderList.customer_id == customer_id),
+                         {'p': 15, 'd': 15, 'c': 15, 'all': 45})
+
+        # status tabs and later pages are index range scans without a sort
+        plan = str(db.session.execute(text(
+            "EXPLAIN QUERY PLAN SELECT * FROM order_list WHERE customer_id = 1 AND status = 'p' "
+            "AND (order_time, id) < ('2025-01-01 12:10:00', 20) ORDER BY order_time DESC, id DESC LIMIT 21"
+        )).all())
+        self.assertIn('ix_order_list_customer_status', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_23_full_text_search_index(self):
+        """Test 23: Search index ranks prefix matches and follows catalogue writes"""
+        mario = Restaurant(user_id=self.rest_user.id, name='Mario Pizzeria',
+                           description='Wood fired', opening_time=time(0, 0),
+                           closing_time=time(23, 59), rating=4.0)
+        db.session.add(mario)
+        db.session.commit()
+        mario_id, test_id = mario.id, self.restaurant.id
+
+        # name beats dish name, matching is on word prefixes, all words must match
+        self.assertEqual([rid for rid, _ in search_restaurants('pizz')], [mario_id, test_id])
+        self.assertEqual([rid for rid, _ in search_restaurants('ital down')], [test_id])
+        self.assertEqual(search_restaurants('pizza sushi'), [])
+        self.assertEqual(search_restaurants(' !? '), [])
+
+        listing = get_restaurant_listing(self.customer.id, name_filter='pizz')
+        self.assertEqual([card['id'] for card in listing], [mario_id, test_id])
+        # the other filters apply to every match, not to a top-N of them
+        listing = get_restaurant_listing(self.customer.id, name_filter='pizz', min_rating='4.5')
+        self.assertEqual([card['id'] for card in listing], [test_id])
+        self.assertEqual(get_restaurant_facets(name_filter='pizz')['rating'][4], 2)
+
+        # dish, cuisine and address writes refresh the documents in the same flush
+        sushi = Cuisine(name='Japanese')
+        db.session.add(sushi)
+        db.session.flush()
+        db.session.add(Food(restaurant_id=mario_id, name='Salmon Nigiri', price=8.0,
+                            cuisine_id=sushi.id, category='Main'))
+        self.cuisine.name = 'Neapolitan'
+        self.address.location = 'Harbour'
+        db.session.commit()
+        self.assertEqual([rid for rid, _ in search_restaurants('nigiri')], [mario_id])
+        self.assertEqual([rid for rid, _ in search_restaurants('neapol')], [test_id])
+        self.assertEqual(search_restaurants('ital'), [])
+        self.assertEqual(len(search_restaurants('harb')), 2)
+
+        db.session.delete(Food.query.filter_by(name='Salmon Nigiri').one())
+        db.session.commit()
+        self.assertEqual(search_restaurants('nigiri'), [])
+        db.session.delete(mario)
+        db.session.commit()
+        self.assertEqual(search_restaurants('mario'), [])
+
+        # Core writes bypass the hooks until the index is rebuilt
+        db.session.execute(Restaurant.__table__.update().where(
+            Restaurant.id == test_id).values(name='Trattoria'))
+        db.session.commit()
+        self.assertEqual(search_restaurants('tratt'), [])
+        self.assertEqual(rebuild_search_index(), 1)
+        self.assertEqual([rid for rid, _ in search_restaurants('tratt')], [test_id])
+
+    def test_25_filter_facet_counts(self):
+        """Test 25: Sidebar facet counts come from one query and skip their own filter"""
+        other_user = User(email='rest2@test.com', code='2', phone='1112223334')
+        other_user.set_password('test')
+        db.session.add(other_user)
+        db.session.flush()
+        db.session.add(Address(user_id=other_user.id, full_address='9 Side St',
+                               city='Test City', location='Harbour'))
+        thai = Cuisine(name='Thai')
+        db.session.add(thai)
+        other = Restaurant(user_id=other_user.id, name='Thai Corner', rating=3.2,
+                           opening_time=time(9, 0), closing_time=time(22, 0))
+        db.session.add(other)
+        db.session.flush()
+        db.session.add_all([
+            Food(restaurant_id=other.id, name='Pad Thai', price=300.0, cuisine_id=thai.id, category='Main'),
+            Food(restaurant_id=other.id, name='Margherita', price=50.0, cuisine_id=self.cuisine.id,
+                 category='Main'),
+        ])
+        db.session.commit()
+
+        with count_queries() as queries:
+            facets = get_restaurant_facets()
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(facets['location'], {'Downtown': 1, 'Harbour': 1})
+        self.assertEqual(facets['cuisine'], {'Italian': 2, 'Thai': 1})
+        self.assertEqual(facets['rating'], {4: 1, 3: 2, 2: 2, 1: 2})
+        self.assertEqual(facets['price'], {100: 1, 250: 1, 500: 0})
+
+        # the cuisine choice narrows the other facets but not the cuisine counts
+        facets = get_restaurant_facets(cuisines=['Thai'], min_rating='4')
+        self.assertEqual(facets['cuisine'], {'Italian': 1})
+        self.assertEqual(facets['location'], {})
+        self.assertEqual(facets['rating'], {4: 0, 3: 1, 2: 1, 1: 1})
+
+        facets = get_restaurant_facets(name_filter='corner')
+        self.assertEqual(facets['location'], {'Harbour': 1})
+        self.assertEqual(facets['price'], {100: 1, 250: 1, 500: 0})
+
+    def test_26_filter_index_matches_sql(self):
+        """Test 26: In-memory filter index agrees with the SQL filters and follows writes"""
+        thai = Cuisine(name='Thai')
+        db.session.add(thai)
+        db.session.flush()
+        for i in range(6):
+            user = User(email=f'owner{i}@test.com', code='2', phone=f'55500000{i:02d}')
+            user.set_password('test')
+            db.session.add(user)
+            db.session.flush()
+            db.session.add(Address(user_id=user.id, full_address=f'{i} Side St', city='Test City',
+                                   location=('Harbour', 'Downtown', 'Hills')[i % 3]))
+            restaurant = Restaurant(user_id=user.id, name=f'Place {i}', rating=1.5 + i * 0.6,
+                                    opening_time=time(9, 0), closing_time=time(22, 0))
+            db.session.add(restaurant)
+            db.session.flush()
+            db.session.add(Food(restaurant_id=restaurant.id, name=f'Dish {i}', price=60.0 * (i + 1),
+                                cuisine_id=(self.cuisine.id, thai.id)[i % 2], category='Main'))
+        db.session.commit()
+
+        combinations = [
+            {'locations': ['Harbour', 'Hills']}, {'cuisines': ['Thai']}, {'min_rating': '3'},
+            {'min_price': 200}, {'min_price': 'bad', 'locations': ['Downtown']},
+            {'locations': ['Downtown'], 'cuisines': ['Italian', 'Thai'], 'min_rating': 2, 'min_price': 100},
+        ]
+        for filters in combinations:
+            expected = [r.id for r in Restaurant.query.filter(
+                *get_restaurant_filter_conditions(**filters)).order_by(Restaurant.id)]
+            self.assertEqual(match_restaurant_ids(**filters), expected, filters)
+            self.assertEqual(get_indexed_facets(RATING_FACETS, PRICE_FACETS, **filters),
+                             get_restaurant_facets(**filters), filters)
+        self.assertIsNone(match_restaurant_ids())
+
+        # only the matching restaurants are loaded
+        customer_id = self.customer.id
+        with count_queries() as queries:
+            listing = get_restaurant_listing(customer_id, cuisines=['Thai'], min_price=200)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual([card['name'] for card in listing], ['Place 3', 'Place 5'])
+
+        # committed writes update the same index, rolled back ones do not
+        index = get_filter_index()
+        place = Restaurant.query.filter_by(name='Place 0').one()
+        db.session.add(Food(restaurant_id=place.id, name='Feast', price=900.0,
+                            cuisine_id=thai.id, category='Main'))
+        order = OrderList(customer_id=customer_id, restaurant_id=place.id, total_price=900.0, status='d')
+        db.session.add(order)
+        db.session.flush()
+        db.session.add(RestaurantReview(customer_id=customer_id, restaurant_id=place.id,
+                                        order_id=order.id, rating=5, review='Great'))
+        db.session.commit()
+        self.food.price = 1000.0
+        db.session.flush()
+        db.session.rollback()
+        self.assertIs(get_filter_index(), index)
+        self.assertEqual(match_restaurant_ids(min_price=800), [place.id])
+        self.assertIn(place.id, match_restaurant_ids(min_rating=5, cuisines=['Thai']))
+
+        # arbitrary minimums from the query string do not grow the index
+        for minimum in range(100):
+            match_restaurant_ids(min_price=minimum + 0.5)
+        self.assertLessEqual(len(index.top_prices.cache), CACHED_MINIMUMS)
+        self.assertIsNone(match_restaurant_ids(min_price='nan'))
+
+        # an expired index is served as is while another thread rebuilds it
+        index.built_at -= 3600
+        lock = self.app.extensions['catalogue_view_locks']['filter_index']
+        with lock:
+            self.assertIs(get_filter_index(), index)
+        self.assertIsNot(get_filter_index(), index)
+
+    def test_27_reference_data_cache(self):
+        """Test 27: Cuisines and locations are cached and dropped on committed writes"""
+        self.assertEqual(get_cuisines(), [(self.cuisine.id, 'Italian')])
+        self.assertEqual(get_restaurant_locations(), ['Downtown'])
+        with count_queries() as queries:
+            self.assertEqual(get_cuisine_by_name('Italian').id, self.cuisine.id)
+            self.assertEqual(get_restaurant_locations(), ['Downtown'])
+        self.assertEqual(len(queries), 0)
+
+        # rolled back writes keep the cache, committed ones drop it
+        db.session.add(Cuisine(name='Thai'))
+        db.session.flush()
+        db.session.rollback()
+        with count_queries() as queries:
+            self.assertIsNone(get_cuisine_by_name('Thai'))
+        self.assertEqual(len(queries), 0)
+        db.session.add(Cuisine(name='Thai'))
+        db.session.commit()
+        self.assertEqual([cuisine.name for cuisine in get_cuisines()], ['Italian', 'Thai'])
+
+        # a new restaurant's address only counts once the restaurant exists
+        owner = User(email='owner@test.com', code='2', phone='5550000001')
+        owner.set_password('test')
+        db.session.add(owner)
+        db.session.flush()
+        db.session.add(Address(user_id=owner.id, full_address='1 Side St', city='Test City', location='Harbour'))
+        db.session.commit()
+        self.assertEqual(get_restaurant_locations(), ['Downtown'])
+        db.session.add(Restaurant(user_id=owner.id, name='Harbour Place',
+                                  opening_time=time(9, 0), closing_time=time(22, 0)))
+        db.session.commit()
+        self.assertEqual(get_restaurant_locations(), ['Downtown', 'Harbour'])
+
+        # workers sharing a Redis server see each other's invalidations
+        class SharedStore:
+            def __init__(self):
+                self.values = {}
+
+            def get(self, key):
+                return self.values.get(key)
+
+            def set(self, key, value, ex=None):
+                self.values[key] = value
+
+            def delete(self, *keys):
+                for key in keys:
+                    self.values.pop(key, None)
+
+        store = SharedStore()
+        first, second = ReferenceCache(RedisBackend(store), 60), ReferenceCache(RedisBackend(store), 60)
+        self.assertEqual(first.get('cuisines', lambda: [[1, 'Thai']]), [[1, 'Thai']])
+        self.assertEqual(second.get('cuisines', lambda: [[2, 'Stale']]), [[1, 'Thai']])
+        second.invalidate('cuisines')
+        self.assertEqual(first.get('cuisines', lambda: [[3, 'Fresh']]), [[3, 'Fresh']])
+
+    def test_30_cart_store_write_behind(self):
+        """Test 30: Cart clicks stay in the cart store until checkout or the write-behind pass"""
+        self.app.config['CART_STORE'] = 'memory'
+        init_cart_store(self.app)
+        customer_id, food_id = self.customer.id, self.food.id
+        salad = Food(restaurant_id=self.restaurant.id, name='Salad', price=4.0,
+                     cuisine_id=self.cuisine.id, category='Starter')
+        db.session.add(salad)
+        db.session.add(Cart(customer_id=customer_id, food_id=food_id, quantity=2))
+        db.session.commit()
+        salad_id = salad.id
+
+        # the cart is loaded once, clicks are store increments without SQL
+        self.assertEqual(get_cart(customer_id), {food_id: 2})
+        with count_queries() as queries:
+            self.assertEqual(add_to_cart(food_id, customer_id), (True, '+1'))
+            self.assertEqual(add_to_cart(str(salad_id), customer_id), (True, 'Item added to cart'))
+            self.assertEqual(subtract_from_cart(salad_id, customer_id), (True, 'removed item from cart'))
+            self.assertEqual(subtract_from_cart(salad_id, customer_id)[0], False)
+            add_to_cart(salad_id, customer_id)
+        self.assertEqual(queries, [])
+        self.assertEqual(Cart.query.filter_by(customer_id=customer_id).one().quantity, 2)
+        self.assertEqual({item['id']: item['quantity'] for item in build_menu_view(self.restaurant.id, customer_id)},
+                         {food_id: 3, salad_id: 1})
+
+        # write-behind makes the Cart rows match, only once per change
+        self.assertEqual(persist_dirty_carts(), 1)
+        self.assertEqual(persist_dirty_carts(), 0)
+        self.assertEqual(dict(db.session.query(Cart.food_id, Cart.quantity).filter_by(customer_id=customer_id)),
+                         {food_id: 3, salad_id: 1})
+        remove_from_cart(salad_id, customer_id)
+
+        # checkout orders what is in the store and empties it
+        success, _ = place_order(customer_id)
+        self.assertTrue(success)
+        self.assertEqual(OrderList.query.filter_by(customer_id=customer_id).one().total_price, 30.0)
+        self.assertEqual(get_cart(customer_id), {})
+        self.assertEqual(Cart.query.filter_by(customer_id=customer_id).count(), 0)
+        self.assertEqual(split_cart_by_restaurant(customer_id), (False, 'No items in the cart.'))
+
+        # a double submit that wrote the same new cart lines first is reported, not raised
+        add_to_cart(salad_id, customer_id)
+
+        def concurrent_submit(state):
+            if state.is_insert:
+                state.session.connection().execute(Cart.__table__.insert().values(
+                    customer_id=customer_id, food_id=salad_id, quantity=1))
+        event.listen(db.session, 'do_orm_execute', concurrent_submit)
+        try:
+            self.assertEqual(place_order(customer_id), (False, 'This order has already been placed.'))
+        finally:
+            event.remove(db.session, 'do_orm_execute', concurrent_submit)
+        self.assertEqual(OrderList.query.filter_by(customer_id=customer_id).count(), 1)
+
+    def test_32_order_stats_rollup(self):
+        """Test 32: Order counts and revenue come from one grouped query or the rollup kept by the writes"""
+        restaurant_id, customer_id = self.restaurant.id, self.customer.id
+        salad = Food(restaurant_id=restaurant_id, name='Salad', price=4.0,
+                     cuisine_id=self.cuisine.id, category='Starter')
+        db.session.add(salad)
+        db.session.add_all([OrderList(customer_id=customer_id, restaurant_id=restaurant_id,
+                                      total_price=price, status=status)
+                            for price, status in [(10.0, 'd'), (20.0, 'd'), (5.0, 'p'), (7.0, 'c')]])
+        db.session.add_all([Cart(customer_id=customer_id, food_id=self.food.id, quantity=1),
+                            Cart(customer_id=customer_id, food_id=salad.id, quantity=2)])
+        db.session.commit()
+        # two order lines, still one order
+        self.assertTrue(place_order(customer_id)[0])
+
+        pending = OrderList.query.filter_by(status='p').order_by(OrderList.id).first()
+        pending.status = 'd'
+        db.session.commit()
+        db.session.delete(OrderList.query.filter_by(status='c').one())
+        db.session.commit()
+        db.session.expire_all()
+
+        # pending: the 18.0 checkout, delivered: 10 + 20 + 5
+        with count_queries() as queries:
+            self.assertEqual(get_order_count_for_restaurant(restaurant_id), (1, 0, 3, 4))
+        self.assertEqual(len(queries), 1)
+        stats = get_restaurant_order_stats([restaurant_id])
+        self.assertEqual(stats.revenue, 35.0)
+        self.assertEqual(stats.status_counts(), {'p': 1, 'd': 3, 'c': 0, 'all': 4})
+
+        # the rollup agrees with counting the orders, and with a rebuild
+        self.app.config['ORDER_STATS_ROLLUP'] = False
+        counted = get_restaurant_order_stats([restaurant_id])
+        self.assertEqual((counted.counts, counted.revenue), (stats.counts, stats.revenue))
+        rollup = sorted(db.session.query(RestaurantOrderStats.status, RestaurantOrderStats.order_count,
+                                         RestaurantOrderStats.revenue).filter(
+            RestaurantOrderStats.order_count != 0))
+        rebuild_order_stats()
+        self.assertEqual(sorted(db.session.query(RestaurantOrderStats.status, RestaurantOrderStats.order_count,
+                                                 RestaurantOrderStats.revenue)), rollup)
+
+    def test_36_order_event_bus(self):
+        """Test 36: Order side effects run in consumers, a full queue slows the publisher down"""
+        customer_id, restaurant_id = self.customer.id, self.restaurant.id
+        # tests dispatch synchronously, the consumers are done when the service returns
+        with self.assertLogs('app.notifications') as logs:
+            for _ in range(2):
+                db.session.add(Cart(customer_id=customer_id, food_id=self.food.id, quantity=1))
+                db.session.commit()
+                self.assertTrue(place_order(customer_id)[0])
+            cancel_order_by_customer(OrderList.query.first().id, customer_id)
+        self.assertEqual(len(logs.records), 3)
+        self.assertIn('cancelled', logs.output[-1])
+        favourite = FavouriteRestaurant.query.filter_by(customer_id=customer_id).one()
+        self.assertEqual((favourite.restaurant_id, favourite.mode), (restaurant_id, 'a'))
+        self.assertEqual(get_restaurant_order_stats([restaurant_id]).status_counts(),
+                         {'p': 1, 'd': 0, 'c': 1, 'all': 2})
+
+        bus = OrderEventBus(self.app, queue_size=1, block_seconds=0.2)
+        gate, handled = threading.Event(), []
+
+        def slow(event):
+            if event.orders[0]['id'] == 1:
+                gate.wait(5)
+            handled.append((event.orders[0]['id'], threading.current_thread() is threading.main_thread()))
+
+        def failing(event):
+            raise RuntimeError('sink down')
+
+        bus.register(failing)
+        bus.register(slow)
+        with self.assertLogs('app.order_events', 'ERROR') as errors:
+            for order_id in (1, 2, 3):
+                bus.publish(OrderEvent(ORDER_PLACED, [{'id': order_id}], []))
+            # the worker is busy with 1 and 2 fills the queue, so the publisher ran 3 itself
+            self.assertEqual(handled, [(3, True)])
+            self.assertEqual(bus.overflows, 1)
+            gate.set()
+            bus.join()
+        bus.close()
+        self.assertEqual(handled, [(3, True), (1, False), (2, False)])
+        # a failing sink does not stop the others
+        self.assertEqual(len(errors.records), 3)
+
+        # a stuck consumer with a full queue does not hang shutdown
+        stuck = threading.Event()
+        bus = OrderEventBus(self.app, queue_size=1, block_seconds=0.2)
+        bus.register(lambda event: stuck.wait(5), name='stuck')
+        bus.publish(OrderEvent(ORDER_PLACED, [{'id': 1}], []))
+        bus.publish(OrderEvent(ORDER_PLACED, [{'id': 2}], []))
+        with self.assertLogs('app.order_events', 'WARNING'):
+            bus.close(timeout=0.1)
+        stuck.set()